@@ -0,0 +1,413 @@
+"""
+Fast decoder for the animation stream written by Packer.pack.
+
+Follows the same semantics as Packer.unpack, but dispatches op codes through a
+table built once per op layout and keeps screen and color memory in
+bytearrays. The op layout can come from a live Packer or be recovered from a
+rendered player.asm, which makes it possible to replay anim.bin from a build
+folder without the original input files.
+"""
+
+import os
+import re
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from packer import (
+    MAX_SCREEN_OFFSET,
+    PER_ROW_CODE_OFFSET,
+    PER_ROW_END_LINE_MARKER,
+    RLE_END_MARKER,
+    SCREEN_HEIGHT,
+    SCREEN_WIDTH,
+    Packer,
+)
+from utils import Size2D
+
+OP_TABLE_PATTERN = re.compile(r"^\s*\.byte\s+<(\w+)\s*;\s*code\s+(\d+)")
+CONSTANT_PATTERN = re.compile(r"^(\w+)\s*=\s*(\d+)\s*$")
+FILL_RLE_PATTERN = re.compile(r"^player_op_fill_rle(\d+)_(\d+)$")
+FILL_SAME_PATTERN = re.compile(r"^player_op_fill_same(\d+)$")
+FILL_PATTERN = re.compile(r"^player_op_fill(\d+)$")
+FILL_DICT_PATTERN = re.compile(r"^player_op_fill_dict(\d+)$")
+SAVE_HISTORY_PATTERN = re.compile(r"^player_op_save_history(\d+)$")
+COPY_HISTORY_PATTERN = re.compile(r"^player_op_copy_history(\d+)$")
+DICT_TABLE_PATTERN = re.compile(r"^player_block_dict(\d+)_(\d+)\s*$")
+BYTES_PATTERN = re.compile(r"^\s*\.byte\s+(.*)$")
+
+
+class DecodedFrame(NamedTuple):
+    screen_codes: bytes
+    color_data: bytes
+    charset: int
+    background_color: int
+    border_color: int
+    slowdown: Optional[int]
+    stream_offset: int
+
+
+class OpSpan(NamedTuple):
+    """One op as found in the stream, operands are stream[start + 1 : end]"""
+
+    op_code: int
+    name: str
+    start: int
+    end: int
+
+
+class DecoderState:
+    def __init__(self, default_color=0):
+        self.screen = bytearray(MAX_SCREEN_OFFSET)
+        self.color = bytearray([default_color] * MAX_SCREEN_OFFSET)
+        self.block_offsets: List[int] = []
+        self.block_index = 0
+        self.writing_screen = True
+        self.charset = 0
+        self.background_color = 0
+        self.border_color = 0
+        self.slowdown = None
+        # Frames saved by the player, slot to (screen, color)
+        self.history: Dict[int, tuple] = {}
+        self.frame_done = False
+        self.restart = False
+
+    def target(self) -> bytearray:
+        return self.screen if self.writing_screen else self.color
+
+
+class AnimDecoder:
+    def __init__(self, op_codes: Dict[int, str], packer: Packer):
+        self.op_codes = op_codes
+        self.block_offsets = [packer.offsets(block) for block in packer.ALL_BLOCKS]
+        self.macro_block_offsets = [
+            [packer.offsets(block) for block in packer.get_blocks(macro_block)]
+            for macro_block in packer.get_macro_blocks()
+        ]
+        self.block_dictionary = packer.BLOCK_DICTIONARY
+        self.handlers: List[Optional[Callable]] = [None] * 256
+        for op_code, name in op_codes.items():
+            self.handlers[op_code] = self._handler_for(name)
+
+    @staticmethod
+    def for_packer(packer: Packer) -> "AnimDecoder":
+        return AnimDecoder(dict(packer.OP_CODES), packer)
+
+    @staticmethod
+    def from_player_source(player_file: str) -> "AnimDecoder":
+        """Recover block size and op table from a rendered player.asm"""
+        op_codes = {}
+        constants = {}
+        # Dictionary tables by block size and cell
+        dict_tables: Dict[int, Dict[int, List[int]]] = {}
+        dict_table = None
+        with open(player_file) as f:
+            for line in f:
+                if dict_table is not None:
+                    match = BYTES_PATTERN.match(line)
+                    if match:
+                        dict_table.extend(int(v) for v in match.group(1).split(","))
+                        continue
+                    dict_table = None
+                match = OP_TABLE_PATTERN.match(line)
+                if match:
+                    op_codes[int(match.group(2))] = match.group(1)
+                    continue
+                match = CONSTANT_PATTERN.match(line)
+                if match:
+                    constants[match.group(1)] = int(match.group(2))
+                    continue
+                match = DICT_TABLE_PATTERN.match(line)
+                if match:
+                    dict_table = []
+                    size, cell = int(match.group(1)), int(match.group(2))
+                    dict_tables.setdefault(size, {})[cell] = dict_table
+
+        if not op_codes:
+            raise ValueError(f"No op code table found in {player_file}")
+
+        block_size = Size2D(constants["BLOCK_SIZE_X"], constants["BLOCK_SIZE_Y"])
+        macro_block_size = Size2D(
+            constants["X_STEP"] // block_size.x, constants["Y_STEP"] // block_size.y
+        )
+        packer = Packer(block_size, macro_block_size)
+        packer.BLOCK_DICTIONARY = {
+            size: [list(entry) for entry in zip(*(cells[i] for i in range(size)))]
+            for size, cells in dict_tables.items()
+        }
+        return AnimDecoder(op_codes, packer)
+
+    @staticmethod
+    def from_build_folder(build_folder: str) -> "AnimDecoder":
+        return AnimDecoder.from_player_source(os.path.join(build_folder, "player.asm"))
+
+    def uses_color(self) -> bool:
+        return "player_op_set_color_mode" in self.op_codes.values()
+
+    def _handler_for(self, name: str) -> Optional[Callable]:
+        fixed = {
+            "player_op_frame_done": self._op_frame_done,
+            "player_op_restart": self._op_restart,
+            "player_op_set_dest_ptr": self._op_set_dest_ptr,
+            "player_op_next_block": self._op_next_block,
+            "player_set_anim_slowndown": self._op_set_anim_slowdown,
+            "player_op_fill_rle_fullscreen": self._op_fill_rle_fullscreen,
+            "player_op_fullscreen_2x2_blocks": self._op_fullscreen_2x2_blocks,
+            "player_op_per_row_changes": self._op_per_row_changes,
+            "player_op_clear": self._op_clear,
+            "player_op_clear_color": self._op_clear_color,
+            "player_op_set_border": self._op_set_border,
+            "player_op_set_background": self._op_set_background,
+            "player_op_set_charset": self._op_set_charset,
+            "player_op_set_color_mode": self._op_set_color_mode,
+            "player_op_set_screen_mode": self._op_set_screen_mode,
+        }
+        if name in fixed:
+            return fixed[name]
+
+        # Ops with one variant per size or slot, built from the number in the name
+        sized = (
+            (FILL_RLE_PATTERN, self._make_fill_rle),
+            (FILL_SAME_PATTERN, lambda _size: self._op_fill_same),
+            (
+                FILL_DICT_PATTERN,
+                lambda size: self._make_fill_dict(self.block_dictionary[size]),
+            ),
+            (SAVE_HISTORY_PATTERN, self._make_save_history),
+            (COPY_HISTORY_PATTERN, lambda _size: self._op_copy_history),
+            (FILL_PATTERN, self._make_fill),
+        )
+        for pattern, make_handler in sized:
+            match = pattern.match(name)
+            if match:
+                return make_handler(int(match.group(1)))
+        return None
+
+    # Op handlers, each one takes the position of the op code and returns the
+    # position of the next op code
+
+    @staticmethod
+    def _op_frame_done(state, _stream, pos):
+        state.frame_done = True
+        return pos + 1
+
+    @staticmethod
+    def _op_restart(state, _stream, pos):
+        state.frame_done = True
+        state.restart = True
+        return pos + 1
+
+    def _op_set_dest_ptr(self, state, stream, pos):
+        state.block_index = stream[pos + 1]
+        state.block_offsets = self.block_offsets[state.block_index]
+        return pos + 2
+
+    def _op_next_block(self, state, _stream, pos):
+        state.block_index += 1
+        state.block_offsets = self.block_offsets[state.block_index]
+        return pos + 1
+
+    @staticmethod
+    def _op_set_anim_slowdown(state, stream, pos):
+        state.slowdown = stream[pos + 1]
+        return pos + 2
+
+    @staticmethod
+    def _make_fill(size):
+        def fill(state, stream, pos):
+            target = state.target()
+            for offset, value in zip(
+                state.block_offsets, stream[pos + 1 : pos + 1 + size]
+            ):
+                target[offset] = value
+            return pos + 1 + size
+
+        return fill
+
+    @staticmethod
+    def _op_fill_same(state, stream, pos):
+        target = state.target()
+        value = stream[pos + 1]
+        for offset in state.block_offsets:
+            target[offset] = value
+        return pos + 2
+
+    @staticmethod
+    def _make_fill_dict(entries):
+        def fill_dict(state, stream, pos):
+            target = state.target()
+            for offset, value in zip(state.block_offsets, entries[stream[pos + 1]]):
+                target[offset] = value
+            return pos + 2
+
+        return fill_dict
+
+    @staticmethod
+    def _make_save_history(slot):
+        def save_history(state, _stream, pos):
+            state.history[slot] = (bytes(state.screen), bytes(state.color))
+            return pos + 1
+
+        return save_history
+
+    @staticmethod
+    def _op_copy_history(state, stream, pos):
+        screen, color = state.history[stream[pos + 1]]
+        saved = screen if state.writing_screen else color
+        target = state.target()
+        for offset in state.block_offsets:
+            target[offset] = saved[offset]
+        return pos + 2
+
+    @staticmethod
+    def _make_fill_rle(encoded_size):
+        def fill_rle(state, stream, pos):
+            target = state.target()
+            offsets = iter(state.block_offsets)
+            encoded = stream[pos + 1 : pos + 1 + encoded_size]
+            for idx in range(0, encoded_size, 2):
+                for _ in range(encoded[idx]):
+                    target[next(offsets)] = encoded[idx + 1]
+            return pos + 1 + encoded_size
+
+        return fill_rle
+
+    @staticmethod
+    def _op_fill_rle_fullscreen(state, stream, pos):
+        target = state.target()
+        pos += 1
+        screen_offset = 0
+        while True:
+            count = stream[pos]
+            if count == RLE_END_MARKER:
+                return pos + 1
+            if screen_offset + count > MAX_SCREEN_OFFSET:
+                raise ValueError(f"Full screen RLE overflows the screen at {pos}")
+            target[screen_offset : screen_offset + count] = (
+                bytes([stream[pos + 1]]) * count
+            )
+            screen_offset += count
+            pos += 2
+
+    def _op_fullscreen_2x2_blocks(self, state, stream, pos):
+        target = state.target()
+        pos += 1
+        for blocks in self.macro_block_offsets:
+            changes = stream[pos]
+            pos += 1
+            for block_idx, offsets in enumerate(blocks):
+                if changes & (1 << block_idx):
+                    for offset in offsets:
+                        target[offset] = stream[pos]
+                        pos += 1
+        return pos
+
+    @staticmethod
+    def _op_per_row_changes(state, stream, pos):
+        target = state.target()
+        pos += 1
+        for y in range(SCREEN_HEIGHT):
+            row_offset = y * SCREEN_WIDTH
+            code = stream[pos]
+            pos += 1
+            while code != PER_ROW_END_LINE_MARKER:
+                if code > PER_ROW_CODE_OFFSET:
+                    count = code - PER_ROW_CODE_OFFSET
+                    start = row_offset + stream[pos]
+                    value = stream[pos + 1]
+                    pos += 2
+                    for screen_offset in range(
+                        start, min(start + count, MAX_SCREEN_OFFSET)
+                    ):
+                        target[screen_offset] = value
+                else:
+                    screen_offset = row_offset + code
+                    if screen_offset < MAX_SCREEN_OFFSET:
+                        target[screen_offset] = stream[pos]
+                    pos += 1
+                code = stream[pos]
+                pos += 1
+        return pos
+
+    @staticmethod
+    def _op_clear(state, stream, pos):
+        state.target()[:] = bytes([stream[pos + 1]]) * MAX_SCREEN_OFFSET
+        return pos + 2
+
+    @staticmethod
+    def _op_clear_color(state, stream, pos):
+        state.color[:] = bytes([stream[pos + 1]]) * MAX_SCREEN_OFFSET
+        return pos + 2
+
+    @staticmethod
+    def _op_set_border(state, stream, pos):
+        state.border_color = stream[pos + 1]
+        return pos + 2
+
+    @staticmethod
+    def _op_set_background(state, stream, pos):
+        state.background_color = stream[pos + 1]
+        return pos + 2
+
+    @staticmethod
+    def _op_set_charset(state, stream, pos):
+        state.charset = stream[pos + 1]
+        return pos + 2
+
+    @staticmethod
+    def _op_set_color_mode(state, _stream, pos):
+        state.writing_screen = False
+        return pos + 1
+
+    @staticmethod
+    def _op_set_screen_mode(state, _stream, pos):
+        state.writing_screen = True
+        return pos + 1
+
+    def _step(self, state: DecoderState, stream, pos: int) -> int:
+        op_code = stream[pos]
+        handler = self.handlers[op_code]
+        if handler is None:
+            name = self.op_codes.get(op_code, "unknown")
+            raise ValueError(f"Unhandled op code {op_code}, {name} at offset {pos}")
+        return handler(state, stream, pos)
+
+    def iter_ops(self, stream, offset: int = 0) -> Iterator[List[OpSpan]]:
+        """Yield the ops of every frame until the restart op or end of stream"""
+        state = DecoderState()
+        pos = offset
+        while pos < len(stream):
+            ops = []
+            state.frame_done = False
+            state.writing_screen = True
+            while not state.frame_done:
+                end = self._step(state, stream, pos)
+                ops.append(OpSpan(stream[pos], self.op_codes[stream[pos]], pos, end))
+                pos = end
+            if state.restart:
+                if len(ops) > 1:
+                    yield ops
+                return
+            yield ops
+
+    def frames(
+        self, stream, offset: int = 0, default_color: int = 0
+    ) -> Iterator[DecodedFrame]:
+        """Yield the state of screen and color memory after every frame"""
+        state = DecoderState(default_color)
+        pos = offset
+        while pos < len(stream):
+            frame_offset = pos
+            state.frame_done = False
+            state.writing_screen = True
+            while not state.frame_done:
+                pos = self._step(state, stream, pos)
+            if state.restart:
+                return
+            yield DecodedFrame(
+                bytes(state.screen),
+                bytes(state.color),
+                state.charset,
+                state.background_color,
+                state.border_color,
+                state.slowdown,
+                frame_offset,
+            )
@@ -0,0 +1,155 @@
+"""
+Convert animations in memory.
+
+convert takes PIL images, or pixel arrays Image.fromarray reads, with
+options made by cli_parser.default_arguments, and returns the packed
+animation, the charsets and the rendered player sources as buffers. It does
+not write to the build folder, so an asset pipeline can convert many
+animations in one process. Assembling the test .prg runs 64tass, which
+reads and writes files: with assemble=True the sources go to a temporary
+folder removed afterwards. Errors are raised, PackerError when packing
+fails, ValueError for unusable input or options and RuntimeError when 64tass
+fails to assemble the test program.
+
+    from api import convert
+    from cli_parser import default_arguments
+
+    result = convert(images, default_arguments(color_aberration_mode=False))
+    anim_bin, charsets = result.anim_bin, result.charsets
+"""
+
+import argparse
+import os
+import tempfile
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from build_cache import BuildCache
+from build_utils import build
+from cli_parser import default_arguments
+from main import (
+    build_charsets,
+    expand_collapsed_runs,
+    pack_with_dedup,
+    transform_screens,
+)
+from packer import Packer
+import petscii
+from PIL import Image
+from pipeline_context import PipelineContext, use_context
+import utils
+from utils import Size2D
+
+
+class ConversionResult(NamedTuple):
+    anim_bin: bytes
+    charsets: List[bytes]
+    # Player, test program and fill color sources by file name
+    sources: Dict[str, str]
+    # Assembled test program, None unless assembled
+    prg: Optional[bytes]
+    block_size: Size2D
+
+
+def _to_image(frame) -> Image.Image:
+    if isinstance(frame, Image.Image):
+        return frame
+    return Image.fromarray(frame)
+
+
+def assemble_prg(
+    name: str,
+    packer: Packer,
+    anim_bin: bytes,
+    charsets: List[bytes],
+    sources: Dict[str, str],
+    non_linear_prg: bool = False,
+    cache: Optional[BuildCache] = None,
+) -> bytes:
+    """
+    Test program built by 64tass from the buffers, in a temporary folder.
+    Raises RuntimeError when assembling fails.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, "anim.bin"), "wb") as f:
+            f.write(anim_bin)
+        for idx, charset in enumerate(charsets):
+            with open(os.path.join(folder, f"charset_{idx}.bin"), "wb") as f:
+                f.write(charset)
+        for file_name, source in sources.items():
+            with open(os.path.join(folder, file_name), "w") as f:
+                f.write(source)
+        test_music = packer.find_test_music()
+        if test_music:
+            utils.copy_file(test_music, folder)
+
+        with use_context(PipelineContext(folder, None, folder)):
+            if not build(name, non_linear_prg, cache):
+                raise RuntimeError(f"Assembling {name}.prg failed, see the log")
+        with open(os.path.join(folder, f"{name}.prg"), "rb") as f:
+            return f.read()
+
+
+def convert(
+    frames: Iterable,
+    options: Optional[argparse.Namespace] = None,
+    charset: Optional[bytes] = None,
+    name: str = "anim",
+    assemble: bool = False,
+    context: Optional[PipelineContext] = None,
+) -> ConversionResult:
+    """
+    Convert frames, one animation frame per image, with options or the
+    command line defaults. charset is a charset of 8 bytes per character to
+    match the cells against instead of building charsets from the images.
+    name is the name of the test program and its source. context keeps
+    caches between conversions, a new one is used by default.
+    """
+    options = argparse.Namespace(**vars(options or default_arguments()))
+    images = [_to_image(frame) for frame in frames]
+    if not images:
+        raise ValueError("No frames to convert")
+
+    default_charset = None
+    if charset is not None:
+        default_charset = petscii.charset_from_bytes(charset)
+        if not default_charset:
+            raise ValueError("Charset has no characters")
+
+    with use_context(context or PipelineContext()):
+        decoded = petscii.decode_images(
+            images,
+            default_charset,
+            options.background_color,
+            options.inverse,
+            options.cleanup,
+        )
+        screens = petscii.frames_to_screens(
+            decoded, default_charset, options.background_color, options.border_color
+        )
+        screens, anim_change_index, collapsed_runs = transform_screens(
+            screens, [0], default_charset, options
+        )
+        screens, charsets = build_charsets(screens, default_charset, options)
+        packed = pack_with_dedup(
+            screens, charsets, anim_change_index, name, options, collapsed_runs
+        )
+        if not packed.runs_collapsed:
+            screens, _ = expand_collapsed_runs(screens, collapsed_runs, options)
+        sources = packed.packer.render_player(
+            screens, charsets, options.anim_slowdown_frames, options.use_color
+        )
+
+    anim_bin = bytes(packed.anim_stream)
+    charset_bins = [petscii.charset_to_bytes(charset) for charset in charsets]
+    prg = None
+    if assemble:
+        prg = assemble_prg(
+            name,
+            packed.packer,
+            anim_bin,
+            charset_bins,
+            sources,
+            options.non_linear_prg,
+            BuildCache(options.build_cache_folder) if options.build_cache else None,
+        )
+    return ConversionResult(anim_bin, charset_bins, sources, prg, packed.block_size)
@@ -0,0 +1,223 @@
+"""
+Convert many configs at once.
+
+Every config is a job, converted by a worker process in a pipeline context
+of its own: a build folder, an output folder for the .prg and a log file
+under the batch output folder, named after the config file. Jobs can not
+wipe or overwrite each other's files, so they run in parallel. Frame decode
+and pack workers of a job default to one process, the batch workers already
+use the CPUs. When all jobs are done a summary table lists time and output
+sizes of every job.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import multiprocessing
+import os
+import sys
+import time
+from typing import List, NamedTuple, Optional, Sequence
+
+from cli_parser import parse_arguments
+import colorama
+from logger import get_logger, setup_logging
+from main import run
+from pipeline_context import PipelineContext
+import utils
+
+logger = get_logger()
+
+DEFAULT_OUTPUT_FOLDER = "batch"
+
+
+class BatchJob(NamedTuple):
+    name: str
+    config: str
+    build_folder: str
+    output_folder: str
+    log_file: str
+
+
+class BatchResult(NamedTuple):
+    name: str
+    ok: bool
+    seconds: float
+    anim_size: Optional[int]
+    prg_size: Optional[int]
+    error: Optional[str]
+
+
+def make_jobs(configs: Sequence[str], output_folder: str) -> List[BatchJob]:
+    """One job per config, configs with the same file name get a numbered name"""
+    jobs = []
+    names = set()
+    for config in configs:
+        base_name = os.path.splitext(os.path.basename(config))[0]
+        name = base_name
+        number = 2
+        while name in names:
+            name = f"{base_name}_{number}"
+            number += 1
+        names.add(name)
+        job_folder = os.path.join(output_folder, name)
+        jobs.append(
+            BatchJob(
+                name,
+                config,
+                os.path.join(job_folder, "build"),
+                job_folder,
+                os.path.join(job_folder, f"{name}.log"),
+            )
+        )
+    return jobs
+
+
+def _file_size(path: str) -> Optional[int]:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return None
+
+
+def _prg_size(output_folder: str) -> Optional[int]:
+    prg_files = glob.glob(os.path.join(output_folder, "*.prg"))
+    if not prg_files:
+        return None
+    return sum(os.path.getsize(prg_file) for prg_file in prg_files)
+
+
+def _init_worker(verbose: bool):
+    # Job logs go to their log files, the console only shows errors
+    setup_logging(verbose=verbose, quiet=not verbose)
+
+
+def run_job(job: BatchJob, extra_args: Sequence[str]) -> BatchResult:
+    """Convert job.config with extra_args, in a context of its own"""
+    start = time.perf_counter()
+    error = None
+    try:
+        args = parse_arguments(["--config", job.config, *extra_args])
+        if args.decode_workers is None:
+            args.decode_workers = 1
+        if args.pack_workers is None:
+            args.pack_workers = 1
+        utils.create_folder_if_not_exists(job.output_folder)
+        context = PipelineContext(job.build_folder, job.log_file, job.output_folder)
+        ok = run(args, context) == 0
+    except SystemExit as e:
+        ok = False
+        error = f"exit code {e.code}"
+    except Exception as e:
+        # One failing job does not stop the batch
+        ok = False
+        error = str(e)
+    if not ok and error is None:
+        error = f"see {job.log_file}"
+
+    return BatchResult(
+        job.name,
+        ok,
+        time.perf_counter() - start,
+        _file_size(os.path.join(job.build_folder, "anim.bin")),
+        _prg_size(job.output_folder),
+        error,
+    )
+
+
+def run_batch(
+    jobs: Sequence[BatchJob],
+    extra_args: Sequence[str] = (),
+    workers: Optional[int] = None,
+    verbose: bool = False,
+) -> List[BatchResult]:
+    """Run jobs in worker processes, results in job order"""
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    logger.info(f"Converting {len(jobs)} configs with {workers} workers")
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(verbose,)
+    ) as executor:
+        futures = [executor.submit(run_job, job, extra_args) for job in jobs]
+        results = []
+        for future in futures:
+            result = future.result()
+            if result.ok:
+                logger.success(f"{result.name}: done in {result.seconds:.1f}s")
+            else:
+                logger.error(f"{result.name}: failed, {result.error}")
+            results.append(result)
+    return results
+
+
+def _format_size(size: Optional[int]) -> str:
+    return "-" if size is None else str(size)
+
+
+def report_batch(results: Sequence[BatchResult], seconds: float):
+    name_width = max([len("job"), *(len(result.name) for result in results)])
+    logger.info(
+        f"{'job':<{name_width}}  {'status':<6}  {'seconds':>8}  "
+        f"{'anim.bin':>8}  {'prg':>8}"
+    )
+    for result in results:
+        status = "ok" if result.ok else "failed"
+        logger.info(
+            f"{result.name:<{name_width}}  {status:<6}  {result.seconds:>8.1f}  "
+            f"{_format_size(result.anim_size):>8}  {_format_size(result.prg_size):>8}"
+        )
+    failed = sum(1 for result in results if not result.ok)
+    job_seconds = sum(result.seconds for result in results)
+    logger.info(
+        f"{len(results) - failed} of {len(results)} jobs converted in {seconds:.1f}s, "
+        f"{job_seconds:.1f}s of job time"
+    )
+
+
+def main():
+    colorama.init(autoreset=True)
+
+    parser = argparse.ArgumentParser(
+        description="Convert many config files in parallel worker processes",
+        epilog="Arguments after -- are passed to every job, e.g. -- --skip-build true",
+    )
+    parser.add_argument("configs", nargs="+", help="YAML config files")
+    parser.add_argument(
+        "--output-folder",
+        default=DEFAULT_OUTPUT_FOLDER,
+        help="Every job writes to a folder named after its config in here",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Jobs converted at the same time, defaults to CPU count",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+
+    argv = sys.argv[1:]
+    extra_args = []
+    if "--" in argv:
+        separator = argv.index("--")
+        argv, extra_args = argv[:separator], argv[separator + 1 :]
+    args = parser.parse_args(argv)
+
+    setup_logging(verbose=args.verbose)
+
+    missing = [config for config in args.configs if not os.path.isfile(config)]
+    if missing:
+        logger.error(f"Config files not found: {', '.join(missing)}")
+        return 1
+
+    start = time.perf_counter()
+    results = run_batch(
+        make_jobs(args.configs, args.output_folder),
+        extra_args,
+        args.workers,
+        args.verbose,
+    )
+    report_batch(results, time.perf_counter() - start)
+    return 0 if all(result.ok for result in results) else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
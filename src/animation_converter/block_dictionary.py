@@ -0,0 +1,99 @@
+"""
+Dictionary of recurring block contents.
+
+Animations often show the same block again and again, a sprite cycling over
+a static background writes identical fills every time it comes back. The
+stream of a first packing pass is used as statistics: every block written
+with a fill or RLE fill is counted by its contents. Entries are picked by
+bytes saved, uses times payload size minus the one byte entry index, until
+the RAM budget for dictionary data and player routines is used. Blocks found
+in the dictionary are then written with player_op_fill_dict{size}.
+"""
+
+from collections import Counter
+from typing import Dict, List, NamedTuple, Tuple
+
+from anim_decoder import FILL_PATTERN, FILL_RLE_PATTERN, AnimDecoder
+from logger import get_logger
+from packer import Packer
+from rle_codec import RLECodec
+
+logger = get_logger()
+
+# One byte index into 256 entries per block size
+MAX_DICTIONARY_ENTRIES = 256
+# read_next_byte, tax and rts of player_op_fill_dict and the op table bytes
+DICT_ROUTINE_BYTES = 8 + 1 + 1 + 2
+# lda abs,x, ldy #, sta (zp),y for every cell
+DICT_ROUTINE_CELL_BYTES = 3 + 2 + 2
+
+Payload = Tuple[int, ...]
+
+
+class BlockDictionary(NamedTuple):
+    entries: Dict[int, List[Payload]]
+    data_bytes_saved: int
+    ram_bytes: int
+
+
+def collect_block_payloads(
+    packer: Packer, anim_stream: List[int]
+) -> Tuple[Counter, Dict[Payload, int]]:
+    """Count block fills of anim_stream by contents, with their payload size"""
+    decoder = AnimDecoder.for_packer(packer)
+    stream = bytes(anim_stream)
+    counts = Counter()
+    payload_sizes = {}
+    for ops in decoder.iter_ops(stream):
+        for op in ops:
+            operands = stream[op.start + 1 : op.end]
+            if FILL_RLE_PATTERN.match(op.name):
+                payload = tuple(RLECodec.decode(operands))
+            elif FILL_PATTERN.match(op.name):
+                payload = tuple(operands)
+            else:
+                continue
+            counts[payload] += 1
+            payload_sizes[payload] = len(operands)
+    return counts, payload_sizes
+
+
+def choose_dictionary(
+    counts: Counter, payload_sizes: Dict[Payload, int], ram_budget: int
+) -> BlockDictionary:
+    """Pick the entries saving most bytes that fit in ram_budget"""
+
+    def saved(payload):
+        return counts[payload] * (payload_sizes[payload] - 1) - len(payload)
+
+    entries: Dict[int, List[Payload]] = {}
+    ram_bytes = 0
+    data_bytes_saved = 0
+    for payload in sorted(counts, key=saved, reverse=True):
+        if saved(payload) <= 0:
+            break
+        size = len(payload)
+        cost = size
+        if size not in entries:
+            cost += DICT_ROUTINE_BYTES + size * DICT_ROUTINE_CELL_BYTES
+        if ram_bytes + cost > ram_budget:
+            continue
+        size_entries = entries.setdefault(size, [])
+        if len(size_entries) == MAX_DICTIONARY_ENTRIES:
+            continue
+        size_entries.append(payload)
+        ram_bytes += cost
+        data_bytes_saved += counts[payload] * (payload_sizes[payload] - 1)
+
+    return BlockDictionary(entries, data_bytes_saved, ram_bytes)
+
+
+def report_dictionary(dictionary: BlockDictionary, ram_budget: int):
+    entry_count = sum(len(entries) for entries in dictionary.entries.values())
+    logger.info(
+        f"Block dictionary: {entry_count} entries, {dictionary.ram_bytes} of "
+        f"{ram_budget} bytes of RAM, saves about {dictionary.data_bytes_saved} bytes "
+        f"of animation data"
+    )
+    for size, entries in sorted(dictionary.entries.items()):
+        logger.debug(f"  player_op_fill_dict{size}: {len(entries)} entries")
@@ -0,0 +1,96 @@
+"""
+Cache of assembled programs.
+
+64tass reads the rendered sources, anim.bin, the charsets and the music in
+the build folder, and writes the .prg, its listing and its labels. With
+--build-cache, build_utils.build hashes every file in the build folder
+together with the 64tass binary and its flags. When the hash is cached, the
+stored outputs are copied into place and 64tass is not run. Paths are not
+part of the hash, so builds in other folders, like fresh CI checkouts, share
+entries. The listing header names the command of the build that made it.
+
+Entries are one file per output, named by the hash and the output suffix.
+The least recently used entries are removed to keep the cache below its
+size limit, like the screen cache.
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+from typing import Dict, Iterable, Optional
+
+from logger import get_logger
+import utils
+
+logger = get_logger()
+
+BUILD_CACHE_VERSION = 1
+OUTPUT_SUFFIXES = (".prg", ".lst", ".labels")
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_folder() -> str:
+    return utils.user_cache_folder("builds")
+
+
+class BuildCache:
+    def __init__(
+        self, folder: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.folder = folder or default_cache_folder()
+        self.max_bytes = max_bytes
+
+    def key(
+        self,
+        build_folder: str,
+        assembler: str,
+        flags: Iterable[str],
+        outputs: Iterable[str],
+    ) -> str:
+        """Hash of the assembler, its flags and the files in build_folder but outputs"""
+        digest = hashlib.sha256(f"{BUILD_CACHE_VERSION}".encode())
+        utils.update_digest(digest, assembler)
+        digest.update(repr(list(flags)).encode())
+        skipped = {os.path.abspath(path) for path in outputs}
+        for name in sorted(os.listdir(build_folder)):
+            path = os.path.join(build_folder, name)
+            if not os.path.isfile(path) or os.path.abspath(path) in skipped:
+                continue
+            digest.update(f"\0{name}\0".encode())
+            utils.update_digest(digest, path)
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.folder, key + suffix)
+
+    def load(self, key: str, outputs: Dict[str, str]) -> bool:
+        """Copy the outputs stored under key to the paths by suffix in outputs"""
+        entries = {suffix: self._entry_path(key, suffix) for suffix in outputs}
+        if not all(os.path.isfile(path) for path in entries.values()):
+            return False
+        try:
+            for suffix, path in outputs.items():
+                shutil.copyfile(entries[suffix], path)
+        except OSError as e:
+            logger.warning(f"Could not read build cache entry {key}: {e}")
+            return False
+        # Reading counts as use for the least recently used eviction
+        for path in entries.values():
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        return True
+
+    def store(self, key: str, outputs: Dict[str, str]):
+        utils.create_folder_if_not_exists(self.folder)
+        for suffix, path in outputs.items():
+            entry = self._entry_path(key, suffix)
+            # Other builds may read the cache while this one writes
+            temp_path = f"{entry}.{os.getpid()}.tmp"
+            try:
+                shutil.copyfile(path, temp_path)
+                os.replace(temp_path, entry)
+            except OSError as e:
+                logger.warning(f"Could not write build cache entry {entry}: {e}")
+                return
+        utils.evict_least_recently_used(self.folder, OUTPUT_SUFFIXES, self.max_bytes)
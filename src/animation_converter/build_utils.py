@@ -1,15 +1,27 @@
 import os
 import platform
 import subprocess
+from typing import Optional
 
+from build_cache import BuildCache
 from logger import get_logger
+from pipeline_context import current_context
+import prg_splice
+from tracing import span
 import utils
 
 logger = get_logger()
 
 
 def get_build_path():
-    return utils.get_resource_path("build")
+    return current_context().build_folder
+
+
+def get_output_path(file_name):
+    output_folder = current_context().output_folder
+    if output_folder is None:
+        return file_name
+    return os.path.join(output_folder, file_name)
 
 
 def get_c64tass_path():
@@ -59,34 +71,80 @@ def clean_build():
             os.remove(file_path)
 
 
-def build(output_file_name, non_linear_prg=False):
+def get_labels_path(output_file_name):
+    return f"{get_build_path()}/{output_file_name}.labels"
+
+
+def build(
+    output_file_name,
+    non_linear_prg=False,
+    cache: Optional[BuildCache] = None,
+    splice: bool = False,
+):
     # -o test.prg test.asm
-    command = [get_c64tass_path(), "-B"]
+    prg_file = get_output_path(f"{output_file_name}.prg")
+    assembler = get_c64tass_path()
+    flags = ["-B"]
 
     if non_linear_prg:
-        command.append("-n")
-
-    command.extend(
-        [
+        flags.append("-n")
+        # Segments of non-linear programs are not at load address offsets
+        splice = False
+
+    outputs = {
+        ".prg": prg_file,
+        ".lst": f"{get_build_path()}/{output_file_name}.lst",
+        ".labels": get_labels_path(output_file_name),
+    }
+    if splice and prg_splice.splice_build(
+        get_build_path(), output_file_name, outputs, flags
+    ):
+        logger.success(f"Spliced new animation data into {prg_file}")
+        return True
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(
+            get_build_path(),
+            assembler,
+            [*flags, f"{output_file_name}.asm"],
+            outputs.values(),
+        )
+
+    if cache is not None and cache.load(cache_key, outputs):
+        logger.success(f"Build unchanged, copied from build cache: {prg_file}")
+    else:
+        command = [
+            assembler,
+            *flags,
             "-L",
-            f"{get_build_path()}/{output_file_name}.lst",
+            outputs[".lst"],
+            "-l",
+            outputs[".labels"],
             "-o",
-            f"{output_file_name}.prg",
+            prg_file,
             f"{get_build_path()}/{output_file_name}.asm",
         ]
-    )
-
-    result = subprocess.run(
-        command,
-        check=False,
-        capture_output=True,
-        text=True,
-    )
 
-    if result.returncode == 0:
-        logger.success(f"Build successful: {output_file_name}.prg")
+        with span("64tass"):
+            result = subprocess.run(
+                command,
+                check=False,
+                capture_output=True,
+                text=True,
+            )
+
+        if result.returncode != 0:
+            logger.error(f"Build failed with return code: {result.returncode}")
+            logger.error(f"Output: {result.stdout}")
+            logger.error(f"Errors: {result.stderr}")
+            return False
+
+        logger.success(f"Build successful: {prg_file}")
         logger.debug(f"Output: {result.stdout}")
-    else:
-        logger.error(f"Build failed with return code: {result.returncode}")
-        logger.error(f"Output: {result.stdout}")
-        logger.error(f"Errors: {result.stderr}")
+        if cache is not None:
+            cache.store(cache_key, outputs)
+
+    if splice:
+        prg_splice.record_build(get_build_path(), output_file_name, outputs, flags)
+    return True
@@ -74,7 +74,7 @@ def resolve_file_paths(
     return resolved_config
 
 
-def parse_arguments():
+def create_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Convert PNG/GIF to C64 PETSCII + charset."
     )
@@ -92,7 +92,7 @@ def parse_arguments():
         "input_files",
         type=str,
         nargs="*",  # Changed from "+" to "*" to make it optional
-        help="Input .c, PNG or GIF files (optional if defined in config)",
+        help="Input .c, PNG or GIF files, or a folder/glob of numbered PNG frames (optional if defined in config)",
         default=[],
     )
 
@@ -103,6 +103,18 @@ def parse_arguments():
         default=None,
         help="Use this charset instead (.64c or .bin)",
     )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=None,
+        help="Worker processes used to decode PNG frame sequences, defaults to CPU count",
+    )
+    parser.add_argument(
+        "--pack-workers",
+        type=int,
+        default=None,
+        help="Worker processes used to encode frames when packing, defaults to CPU count",
+    )
     parser.add_argument(
         "--cleanup",
         type=int,
@@ -183,6 +195,54 @@ def parse_arguments():
     parser.add_argument(
         "--disable-rle", type=bool, default=False, help="Disable RLE encoder"
     )
+    parser.add_argument(
+        "--disable-peephole",
+        type=bool,
+        default=False,
+        help="Disable peephole pass that removes redundant ops after packing",
+    )
+    parser.add_argument(
+        "--disable-rle-allocation",
+        type=bool,
+        default=False,
+        help="Allocate RLE fill op codes first come first served",
+    )
+    parser.add_argument(
+        "--block-dictionary-size",
+        type=int,
+        default=0,
+        help="Bytes of player RAM for a dictionary of recurring blocks (default: 0, off)",
+    )
+    parser.add_argument(
+        "--history-slots",
+        type=int,
+        default=0,
+        help="Earlier frames the player keeps to copy blocks back from (default: 0, off)",
+    )
+    parser.add_argument(
+        "--history-location",
+        type=str,
+        default="$c000",
+        help="Page aligned address of the history slots, 1KB each, 2KB with color",
+    )
+    parser.add_argument(
+        "--dedup-frames",
+        type=bool,
+        default=False,
+        help="Merge runs of identical frames into one frame with a longer slowdown",
+    )
+    parser.add_argument(
+        "--near-duplicate-cells",
+        type=int,
+        default=0,
+        help="With --dedup-frames also merge frames differing in at most this many cells",
+    )
+    parser.add_argument(
+        "--loop-closure",
+        type=bool,
+        default=False,
+        help="Decode first frame once, loop from there with first frame diffed against last",
+    )
     parser.add_argument(
         "--inverse", type=bool, default=False, help="Inverse characters"
     )
@@ -285,6 +345,12 @@ def parse_arguments():
         default="*",
         help="Set anim start address, defaults to after charsets",
     )
+    parser.add_argument(
+        "--preview",
+        type=str,
+        default=None,
+        help="Decode packed animation and write it to this .gif, or .png strip",
+    )
     parser.add_argument(
         "--write-petmate",
         type=bool,
@@ -303,6 +369,24 @@ def parse_arguments():
         default=False,
         help="Skip double buffering and try to run 50fps",
     )
+    parser.add_argument(
+        "--cycle-budget",
+        type=int,
+        default=None,
+        help="Warn about frames whose estimated unpack cycles exceed this, defaults to PAL frame minus badlines and music",
+    )
+    parser.add_argument(
+        "--emulate-player",
+        type=bool,
+        default=False,
+        help="Run built player on a 6502 emulator, measure cycles and check unpacked frames",
+    )
+    parser.add_argument(
+        "--cycle-budget-encoding",
+        type=bool,
+        default=False,
+        help="Pick faster ops or defer block updates to keep frames within cycle budget",
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -323,9 +407,90 @@ def parse_arguments():
         default=None,
         help="Write detailed logs to file",
     )
+    parser.add_argument(
+        "--build-folder",
+        type=str,
+        default=None,
+        help="Folder for generated sources and build files, defaults to build in the install folder",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=bool,
+        default=False,
+        help="Reuse results of conversion stages whose inputs did not change since the last run in the build folder",
+    )
+    parser.add_argument(
+        "--watch",
+        type=bool,
+        default=False,
+        help="Convert again whenever the config, input files or templates change",
+    )
+    parser.add_argument(
+        "--local",
+        type=bool,
+        default=False,
+        help="Convert in this process even when a conversion daemon is running",
+    )
+    parser.add_argument(
+        "--daemon-socket",
+        type=str,
+        default=None,
+        help="UNIX socket of the conversion daemon, defaults to animation-converter.sock in the user runtime folder",
+    )
+    parser.add_argument(
+        "--screen-cache",
+        type=bool,
+        default=False,
+        help="Keep decoded input frames in a cache, reruns with the same input and decode options skip decoding",
+    )
+    parser.add_argument(
+        "--screen-cache-folder",
+        type=str,
+        default=None,
+        help="Folder of the screen cache, defaults to animation-converter/screens in the user cache folder",
+    )
+    parser.add_argument(
+        "--screen-cache-size",
+        type=int,
+        default=256,
+        help="Size limit of the screen cache in MB, least recently used entries are removed (default: 256)",
+    )
+    parser.add_argument(
+        "--build-cache",
+        type=bool,
+        default=False,
+        help="Copy the .prg, listing and labels from a cache instead of assembling when the build folder files are unchanged",
+    )
+    parser.add_argument(
+        "--build-cache-folder",
+        type=str,
+        default=None,
+        help="Folder of the build cache, defaults to animation-converter/builds in the user cache folder",
+    )
+    parser.add_argument(
+        "--splice-prg",
+        type=bool,
+        default=False,
+        help="Patch new animation data into the last built .prg instead of assembling when the player sources did not change",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Write wall time, CPU time and peak memory of every stage and step to this Chrome trace JSON file",
+    )
+    parser.add_argument(
+        "--output-folder",
+        type=str,
+        default=None,
+        help="Folder for the built .prg and .petmate files, defaults to the current folder",
+    )
+
+    return parser
 
-    args = parser.parse_args()
 
+def apply_mode_options(args):
+    """Options implied by the player modes"""
     # Color aberration mode needs inverse charset
     if args.color_aberration_mode:
         args.inverse = True
@@ -338,6 +503,30 @@ def parse_arguments():
     if args.fast_mode:
         args.asm_test_runner_name = "player_50fps_test.asm"
 
+
+def default_arguments(**overrides) -> argparse.Namespace:
+    """
+    Args as parsed from a command line without options, with overrides by
+    snake_case option name, for conversions without a config file.
+    """
+    parser = create_parser()
+    args = argparse.Namespace()
+    for action in parser._actions:
+        if not isinstance(action, argparse._HelpAction):
+            setattr(args, action.dest, action.default)
+    for name, value in overrides.items():
+        if not hasattr(args, name):
+            raise ValueError(f"Unknown option {name}")
+        setattr(args, name, value)
+    apply_mode_options(args)
+    return args
+
+
+def parse_arguments(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    apply_mode_options(args)
+
     # Load and merge config file
     config_data = load_config_file(args.config)
     validate_config_against_parser(config_data, parser)
@@ -0,0 +1,392 @@
+"""
+Estimate 6502 cycles spent by player_unpack for every frame of an animation.
+
+Each player_op_* routine in player.asm has a matching cost function here,
+counted instruction by instruction from the template. Data dependent loops
+(RLE runs, per row changes) are costed from the operands in the stream.
+Callbacks provided by the test harness are not included.
+
+Page crossings are only counted for the history save copy. A taken branch
+or an indexed load that crosses a page costs a cycle more, and where that
+happens depends on where 64tass places the player code, tables and
+buffers. Measured with --emulate-player, estimates ran up to about 360
+cycles per frame low, mostly from branches in the RLE decode and per row
+loops. MODEL_ERROR_MARGIN covers that error. 2x2 block frames are
+estimated up to a few hundred cycles high, the player skips blocks that
+never change but they are costed here.
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+from anim_decoder import (
+    COPY_HISTORY_PATTERN,
+    FILL_DICT_PATTERN,
+    FILL_PATTERN,
+    FILL_RLE_PATTERN,
+    FILL_SAME_PATTERN,
+    SAVE_HISTORY_PATTERN,
+    AnimDecoder,
+)
+from logger import get_logger
+from packer import PER_ROW_CODE_OFFSET, PER_ROW_END_LINE_MARKER, RLE_END_MARKER
+
+logger = get_logger()
+
+PAL_CYCLES_PER_FRAME = 63 * 312
+BADLINE_CYCLES = 40 * 25
+MUSIC_RESERVE_CYCLES = 3000
+DEFAULT_CYCLE_BUDGET = PAL_CYCLES_PER_FRAME - BADLINE_CYCLES - MUSIC_RESERVE_CYCLES
+# Cycles per frame the estimates can run low by, see module docstring
+MODEL_ERROR_MARGIN = 400
+HISTOGRAM_BUCKETS = 8
+HISTOGRAM_WIDTH = 40
+WORST_FRAMES_REPORTED = 5
+
+# player_read_next_byte macro: ldy #, lda (zp),y, inc zp, bne
+READ_BYTE = 2 + 5 + 5 + 3
+# player_read_next_byte_slow: jsr, macro, rts
+READ_BYTE_SLOW = 6 + READ_BYTE + 6
+RTS = 6
+# unpack_loop: read op, tay, two table lookups and stores, jsr, state check
+DISPATCH = READ_BYTE + 2 + 4 + 4 + 4 + 4 + 6 + 3 + 2 + 3
+# jsr player_unpack, entry state check and exit after frame done
+FRAME_OVERHEAD = 6 + (3 + 2 + 2 + 2 + 3) + (-1 + 2 + 3 + 6)
+COLOR_FRAME_OVERHEAD = 2 + 3
+# update_screen_dest_prt macro
+ROW_DEST_PTR = 3 + 4 + 3 + 4 + 3
+
+
+def _store_loop(count: int) -> int:
+    """sta (zp),y / iny / cpy # / bne loop, also used for full screen RLE"""
+    return count * (6 + 2 + 2 + 3) - 1
+
+
+def _short_segment(count: int) -> int:
+    """sta abs,y / iny / dex / bne loop in player_rle_decode"""
+    return count * (5 + 2 + 2 + 3) - 1
+
+
+def _rle_decode_pair(count: int) -> int:
+    # sta loop_iter, read count, tax, read value, ldy buffer_pos, clc, cpx #8
+    cycles = 4 + READ_BYTE + 2 + READ_BYTE + 4 + 2 + 2
+    if count < 8:  # noqa: PLR2004
+        cycles += 3 + _short_segment(count)
+    else:
+        chunks, rest = divmod(count, 8)
+        # unrolled 8 stores with cpx #8 / bcs, then cpx #0 / beq
+        cycles += 2 + chunks * (8 * (5 + 2 + 2) + 2 + 3) - 1 + 2
+        cycles += 3 if rest == 0 else 2 + _short_segment(rest)
+    # continue: sty, lda, clc, adc, cmp, bne
+    return cycles + 4 + 4 + 2 + 2 + 2 + 3
+
+
+class CycleModel:
+    def __init__(
+        self,
+        use_color: bool = False,
+        macro_block_sizes: Optional[List[List[int]]] = None,
+    ):
+        self.use_color = use_color
+        # Cell count of every block in every macro block, for 2x2 block mode
+        self.macro_block_sizes = macro_block_sizes or []
+        # player_op_set_dest_ptr stores the block index when next block op is used
+        self.tracks_block_index = False
+
+    @staticmethod
+    def for_packer(packer, use_color: bool = False) -> "CycleModel":
+        return CycleModel(
+            use_color,
+            [
+                [len(packer.offsets(block)) for block in packer.get_blocks(macro_block)]
+                for macro_block in packer.get_macro_blocks()
+            ],
+        )
+
+    @staticmethod
+    def for_decoder(decoder: AnimDecoder, use_color: bool = False) -> "CycleModel":
+        return CycleModel(
+            use_color,
+            [
+                [len(offsets) for offsets in blocks]
+                for blocks in decoder.macro_block_offsets
+            ],
+        )
+
+    def op_cycles(
+        self, name: str, operands: Sequence[int], writing_color: bool = False
+    ) -> int:
+        """Cycles of one op routine, excluding the dispatch in unpack_loop"""
+        cost = self._fixed_costs().get(name)
+        if cost is not None:
+            return cost
+
+        handlers = {
+            "player_op_set_dest_ptr": lambda: self.set_dest_ptr(writing_color),
+            "player_op_next_block": lambda: self.next_block(writing_color),
+            "player_op_fill_rle_fullscreen": lambda: self.fill_rle_fullscreen(
+                operands, writing_color
+            ),
+            "player_op_per_row_changes": lambda: self.per_row_changes(
+                operands, writing_color
+            ),
+            "player_op_fullscreen_2x2_blocks": lambda: self.fullscreen_2x2_blocks(
+                operands
+            ),
+        }
+        if name in handlers:
+            return handlers[name]()
+
+        if FILL_RLE_PATTERN.match(name):
+            return self.fill_rle(operands)
+        sized = (
+            (FILL_SAME_PATTERN, self.fill_same),
+            (FILL_DICT_PATTERN, self.fill_dict),
+            (FILL_PATTERN, self.fill),
+            (SAVE_HISTORY_PATTERN, lambda _slot: self.save_history()),
+            (COPY_HISTORY_PATTERN, lambda size: self.copy_history(size, writing_color)),
+        )
+        for pattern, cycles in sized:
+            match = pattern.match(name)
+            if match:
+                return cycles(int(match.group(1)))
+        raise ValueError(f"No cycle model for {name}")
+
+    def _fixed_costs(self) -> Dict[str, int]:
+        color_mode = 2 + 3 + (2 + 3) + RTS if self.use_color else 0
+        return {
+            "player_op_frame_done": 2 + 3 + RTS,
+            "player_op_set_color_mode": color_mode,
+            "player_op_set_screen_mode": 2 + 3 + RTS,
+            "player_op_set_border": READ_BYTE_SLOW + 4 + RTS,
+            "player_op_set_background": READ_BYTE_SLOW + 4 + RTS,
+            "player_op_set_charset": READ_BYTE_SLOW + 6 + RTS,
+            "player_set_anim_slowndown": READ_BYTE + 6 + RTS,
+            "player_op_restart": 2 + 3 + 2 + 3 + 6 + RTS,
+            # state check, read value and 126 rounds of 8 stores
+            "player_op_clear": 3 + 2 + 3 + READ_BYTE_SLOW + 2 + 126 * 45 - 1 + RTS,
+            "player_op_clear_color": READ_BYTE_SLOW + 2 + 250 * 25 - 1 + 5 + RTS,
+        }
+
+    @staticmethod
+    def fill(size: int) -> int:
+        return size * (READ_BYTE + 2 + 6) + RTS
+
+    @staticmethod
+    def fill_same(size: int) -> int:
+        return READ_BYTE + size * (2 + 6) + RTS
+
+    @staticmethod
+    def fill_dict(size: int) -> int:
+        return READ_BYTE + 2 + size * (4 + 2 + 6) + RTS
+
+    def save_history(self) -> int:
+        # 250 rounds of four lda abs,x / sta abs,x pairs per buffer, loads
+        # from the page aligned unpack buffer cross a page for most of x
+        page_crossings = sum(
+            max(0, ((offset - 1) & 0xFF) + 250 - 0xFF) for offset in range(0, 1000, 250)
+        )
+        copy = 2 + 250 * (4 * (4 + 5) + 2 + 3) - 1 + page_crossings
+        return copy * (2 if self.use_color else 1) + RTS
+
+    def copy_history(self, size: int, writing_color: bool = False) -> int:
+        # tax, history pointer from destination pointer and slot delta
+        cycles = READ_BYTE + 2 + 3 + 3 + 3 + 2 + 4 + 3
+        if self.use_color:
+            cycles += 3 + 2 + (2 + 3 if writing_color else 3)
+        return cycles + size * (2 + 5 + 6) + RTS
+
+    @staticmethod
+    def fill_rle(encoded: Sequence[int]) -> int:
+        decoded_size = sum(encoded[0::2])
+        # lda #, jsr player_rle_decode, setup, pairs, last bne and rts
+        cycles = 2 + 6 + 10 + sum(map(_rle_decode_pair, encoded[0::2])) - 1 + RTS
+        # copy decode buffer to block: lda abs, ldy #, sta (zp),y
+        return cycles + decoded_size * (4 + 2 + 6) + RTS
+
+    def _dest_ptr_from_y(self, writing_color: bool) -> int:
+        cycles = 4 + 3 + 4 + 3 + RTS
+        if self.tracks_block_index:
+            cycles += 4
+        if self.use_color:
+            cycles += 3 + 2 + (2 if writing_color else 3)
+        return cycles
+
+    def set_dest_ptr(self, writing_color: bool = False) -> int:
+        return READ_BYTE + 2 + self._dest_ptr_from_y(writing_color)
+
+    def next_block(self, writing_color: bool = False) -> int:
+        # ldy abs, iny, jmp
+        return 4 + 2 + 3 + self._dest_ptr_from_y(writing_color)
+
+    @staticmethod
+    def fill_rle_fullscreen(
+        operands: Sequence[int], writing_color: bool = False
+    ) -> int:
+        cycles = 3 + 2 + (2 if writing_color else 3) + 2 + 3 + 2 + 3 + 3
+        for idx in range(0, len(operands), 2):
+            count = operands[idx]
+            if count == RLE_END_MARKER:
+                break
+            # read count, cmp, beq, sta, read value, store loop, advance pointer
+            cycles += READ_BYTE + 2 + 2 + 4 + READ_BYTE + _store_loop(count)
+            cycles += 2 + 2 + 3 + 3 + 3 + 3
+        return cycles + READ_BYTE + 2 + 3 + RTS
+
+    def per_row_changes(
+        self, operands: Sequence[int], writing_color: bool = False
+    ) -> int:
+        cycles = 2 + 3
+        if self.use_color:
+            cycles += 3 + 2 + (2 + 3 + 5 if writing_color else 3)
+
+        pos = 0
+        rows = 0
+        while rows < 25:  # noqa: PLR2004
+            code = operands[pos]
+            pos += 1
+            cycles += READ_BYTE_SLOW + 2
+            if code == PER_ROW_END_LINE_MARKER:
+                cycles += 3 + 5 + 3 + 2 + 3
+                rows += 1
+                continue
+            cycles += 2 + 3 + 2
+            if code > PER_ROW_CODE_OFFSET:
+                count = code - PER_ROW_CODE_OFFSET
+                cycles += 2 + ROW_DEST_PTR + 3 + 2 + 2 + 4
+                cycles += READ_BYTE + 2 + 3 + 3 + 3 + READ_BYTE + 2
+                cycles += _store_loop(count) + 3
+                pos += 2
+            else:
+                cycles += 3 + ROW_DEST_PTR + 3 + 2 + 2
+                cycles += 2 + 2 + 3 + 3 + 3 + READ_BYTE + 6 + 3
+                pos += 1
+        return cycles - 1 + RTS
+
+    def fullscreen_2x2_blocks(self, operands: Sequence[int]) -> int:
+        cycles = 3 + 2 + 3 if self.use_color else 0
+        pos = 0
+        for block_sizes in self.macro_block_sizes:
+            changes = operands[pos]
+            pos += 1
+            cycles += READ_BYTE + 4 + 2
+            if changes == 0:
+                cycles += 2 + 3
+                continue
+            cycles += 3
+            for block_idx, block_size in enumerate(block_sizes):
+                cycles += 4 + 2
+                if changes & (1 << block_idx):
+                    cycles += 2 + block_size * (READ_BYTE + 4)
+                    pos += block_size
+                else:
+                    cycles += 3
+        return cycles + RTS
+
+    def dispatched(
+        self, name: str, operands: Sequence[int], writing_color: bool = False
+    ) -> int:
+        """Cycles of one op including its dispatch in unpack_loop"""
+        return DISPATCH + self.op_cycles(name, operands, writing_color)
+
+    def fixed_frame_cycles(
+        self, leading_ops: Sequence[str], has_slowdown: bool = False
+    ) -> int:
+        """
+        Cycles of a frame without its screen and color changes: frame entry and
+        exit, leading ops like border or charset changes, color mode switches,
+        slowdown and frame done.
+        """
+        cycles = FRAME_OVERHEAD + (COLOR_FRAME_OVERHEAD if self.use_color else 0)
+        trailing_ops = ["player_op_frame_done"]
+        if self.use_color:
+            trailing_ops += ["player_op_set_color_mode", "player_op_set_screen_mode"]
+        if has_slowdown:
+            trailing_ops.append("player_set_anim_slowndown")
+        for name in [*leading_ops, *trailing_ops]:
+            cycles += self.dispatched(name, [])
+        return cycles
+
+    def frame_cycles(self, ops, stream) -> int:
+        cycles = FRAME_OVERHEAD + (COLOR_FRAME_OVERHEAD if self.use_color else 0)
+        writing_color = False
+        for op in ops:
+            operands = stream[op.start + 1 : op.end]
+            cycles += self.dispatched(op.name, operands, writing_color)
+            if op.name == "player_op_set_color_mode":
+                writing_color = True
+            elif op.name in ("player_op_set_screen_mode", "player_op_frame_done"):
+                writing_color = False
+        return cycles
+
+
+def estimate_frame_cycles(
+    decoder: AnimDecoder,
+    anim_stream: Sequence[int],
+    use_color: bool = False,
+    loop_frame: int = 0,
+) -> List[int]:
+    """
+    Estimated player_unpack cycles for every frame of anim_stream, restart op
+    jumps back to loop_frame
+    """
+    model = CycleModel.for_decoder(decoder, use_color)
+    stream = bytes(anim_stream)
+    frames = list(decoder.iter_ops(stream))
+    model.tracks_block_index = any(
+        op.name == "player_op_next_block" for ops in frames for op in ops
+    )
+    frame_cycles = [model.frame_cycles(ops, stream) for ops in frames]
+    if len(frame_cycles) > loop_frame:
+        # Loop frame is decoded in the same player_unpack call as the restart
+        frame_cycles[loop_frame] += DISPATCH + model.op_cycles("player_op_restart", [])
+    return frame_cycles
+
+
+def report_frame_cycles(
+    frame_cycles: Sequence[int],
+    budget: Optional[int] = DEFAULT_CYCLE_BUDGET,
+    fast_mode: bool = False,
+):
+    """Log cycle usage summary, histogram and frames over the cycle budget"""
+    if not frame_cycles:
+        return
+    if budget is None:
+        budget = DEFAULT_CYCLE_BUDGET
+
+    worst = sorted(range(len(frame_cycles)), key=lambda idx: -frame_cycles[idx])
+    average = sum(frame_cycles) // len(frame_cycles)
+    logger.info(
+        f"Estimated unpack cycles per frame: min {min(frame_cycles)}, "
+        f"avg {average}, max {frame_cycles[worst[0]]} (frame {worst[0]}), "
+        f"budget {budget}"
+    )
+    logger.info(
+        "Worst frames: "
+        + ", ".join(
+            f"{idx}: {frame_cycles[idx]}" for idx in worst[:WORST_FRAMES_REPORTED]
+        )
+    )
+
+    bucket_size = max(1, -(-max(*frame_cycles, budget) // HISTOGRAM_BUCKETS))
+    buckets = [0] * HISTOGRAM_BUCKETS
+    for cycles in frame_cycles:
+        buckets[min(cycles // bucket_size, HISTOGRAM_BUCKETS - 1)] += 1
+    largest = max(buckets)
+    logger.info("Cycles per frame histogram:")
+    for idx, count in enumerate(buckets):
+        bar = "#" * (count * HISTOGRAM_WIDTH // largest)
+        start = idx * bucket_size
+        logger.info(f"  {start:6d}-{start + bucket_size - 1:6d} | {bar} {count}")
+
+    over_budget = [
+        idx for idx in range(len(frame_cycles)) if frame_cycles[idx] > budget
+    ]
+    if over_budget:
+        message = (
+            f"{len(over_budget)} frames exceed cycle budget of {budget}: "
+            + ", ".join(str(idx) for idx in over_budget)
+        )
+        if fast_mode:
+            logger.warning(message)
+        else:
+            logger.info(message)
@@ -0,0 +1,264 @@
+"""
+Conversion daemon.
+
+Every run of the command line tool starts Python, imports PIL, jinja2 and
+yaml, loads the Hamming table and starts with empty caches. The daemon is
+a long running process converting jobs sent over a UNIX socket, with all of
+that already done. While it runs, main.py hands its parsed args to it and
+prints the log of the conversion as the daemon streams it back, --local
+converts in the calling process anyway.
+
+Jobs are queued and at most --jobs of them convert at the same time, in
+threads, each in a pipeline context of its own. Jobs with the same build
+folder run one after another as they would overwrite each other's files.
+Character distances, cellified frames and stage results are kept per build
+folder and reused by the next job converting there. The protocol is
+described in daemon_client.py.
+"""
+
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from typing import Callable, Dict, Iterator
+
+import colorama
+import daemon_client
+from daemon_client import default_socket_path, read_messages, send_message
+from logger import get_logger, setup_logging
+from main import run
+import petscii
+from pipeline_context import ContextLogFilter, PipelineContext
+import utils
+
+logger = get_logger()
+
+DEFAULT_JOBS = 2
+
+
+class WarmState:
+    """Caches of one build folder, reused by the jobs converting there"""
+
+    def __init__(self):
+        self.char_distance_cache = {}
+        self.frame_memo = OrderedDict()
+        self.stage_results = {}
+
+    def context(self, args) -> PipelineContext:
+        context = PipelineContext(args.build_folder, args.log_file, args.output_folder)
+        context.char_distance_cache = self.char_distance_cache
+        context.frame_memo = self.frame_memo
+        context.stage_results = self.stage_results
+        return context
+
+
+class JobQueue:
+    """First come first served, at most max_jobs at once and one per build folder"""
+
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max_jobs
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = 0
+        self.busy_folders = set()
+        self.warm_states: Dict[str, WarmState] = {}
+
+    def _can_start(self, job, build_folder: str) -> bool:
+        if self.running >= self.max_jobs or build_folder in self.busy_folders:
+            return False
+        # Jobs waiting longer go first, unless they wait for their folder
+        for earlier in self.waiting:
+            if earlier is job:
+                return True
+            if earlier[1] not in self.busy_folders:
+                return False
+        return True
+
+    @contextmanager
+    def slot(
+        self, build_folder: str, on_queued: Callable[[int], None]
+    ) -> Iterator[WarmState]:
+        """Wait for a turn to convert in build_folder, its warm state inside"""
+        job = (object(), build_folder)
+        with self.condition:
+            ahead = len(self.waiting) + self.running
+            self.waiting.append(job)
+            if ahead:
+                on_queued(ahead)
+            while not self._can_start(job, build_folder):
+                self.condition.wait()
+            self.waiting.remove(job)
+            self.running += 1
+            self.busy_folders.add(build_folder)
+            state = self.warm_states.setdefault(build_folder, WarmState())
+        try:
+            yield state
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.busy_folders.discard(build_folder)
+                self.condition.notify_all()
+
+
+class JobLogHandler(logging.Handler):
+    """Log records of one job as events to its client"""
+
+    def __init__(self, connection: socket.socket, level: int):
+        super().__init__(level)
+        self.connection = connection
+        self.connected = True
+
+    def emit(self, record):
+        if not self.connected:
+            return
+        try:
+            send_message(
+                self.connection,
+                {
+                    "event": "log",
+                    "level": record.levelname,
+                    "message": record.getMessage(),
+                },
+            )
+        except OSError:
+            # Client went away, the job still finishes for its output files
+            self.connected = False
+
+
+def _log_level(args) -> int:
+    if args.quiet:
+        return logging.ERROR
+    if args.verbose:
+        return logging.DEBUG
+    return logging.INFO
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = next(read_messages(self.connection))
+            args = argparse.Namespace(**request["args"])
+        except (StopIteration, KeyError, TypeError, ValueError) as e:
+            logger.error(f"Ignoring malformed job: {e}")
+            return
+
+        queue: JobQueue = self.server.queue
+        build_folder = os.path.abspath(
+            args.build_folder or utils.get_resource_path("build")
+        )
+        try:
+            with queue.slot(
+                build_folder,
+                lambda ahead: send_message(
+                    self.connection, {"event": "queued", "ahead": ahead}
+                ),
+            ) as state:
+                send_message(self.connection, {"event": "started"})
+                code = self.convert(args, state)
+            send_message(self.connection, {"event": "done", "code": code})
+        except OSError as e:
+            logger.warning(f"Lost client of {args.config}: {e}")
+
+    def convert(self, args, state: WarmState) -> int:
+        logger.info(f"Converting {args.config}")
+        context = state.context(args)
+        handler = JobLogHandler(self.connection, _log_level(args))
+        handler.addFilter(ContextLogFilter(context))
+        logger.add_handler(handler)
+        try:
+            code = run(args, context)
+        except (Exception, SystemExit) as e:
+            # A failing job must not take the daemon down
+            logger.error(f"Conversion of {args.config} failed: {e}")
+            code = 1
+        finally:
+            logger.remove_handler(handler)
+        logger.info(f"Finished {args.config}, exit code {code}")
+        return code
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, max_jobs: int):
+        self.queue = JobQueue(max_jobs)
+        super().__init__(socket_path, JobHandler)
+
+
+def remove_stale_socket(socket_path: str) -> bool:
+    """Remove socket_path left by a daemon that is gone, False when one runs"""
+    connection = daemon_client.connect(socket_path)
+    if connection is not None:
+        connection.close()
+        return False
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return True
+
+
+def serve(socket_path: str, max_jobs: int) -> int:
+    if not remove_stale_socket(socket_path):
+        logger.error(f"A daemon is already running on {socket_path}")
+        return 1
+
+    # Loaded once for all jobs
+    petscii.init_hamming_lookup()
+    server = DaemonServer(socket_path, max_jobs)
+    os.chmod(socket_path, 0o600)
+
+    def stop(_signum, _frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    logger.success(f"Daemon listening on {socket_path}, {max_jobs} jobs at a time")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping daemon")
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
+
+
+def main():
+    colorama.init(autoreset=True)
+
+    parser = argparse.ArgumentParser(
+        description="Keep a converter running and convert jobs sent by main.py"
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help=f"UNIX socket to listen on (default: {default_socket_path()})",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Jobs converted at the same time (default: {DEFAULT_JOBS})",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log errors")
+    args = parser.parse_args()
+
+    setup_logging(verbose=args.verbose, quiet=args.quiet)
+    # Forking a process running job threads could copy locks held by them
+    multiprocessing.set_start_method("forkserver")
+
+    if not daemon_client.daemon_supported():
+        logger.error("The daemon needs UNIX sockets, not available on this system")
+        return 1
+    return serve(args.socket or default_socket_path(), max(args.jobs, 1))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
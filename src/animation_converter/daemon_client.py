@@ -0,0 +1,128 @@
+"""
+Client side of the conversion daemon, see daemon.py.
+
+Messages are JSON objects, one per line. A client sends one job:
+
+    {"args": {parsed command line args, paths absolute}}
+
+and reads events until the job is done:
+
+    {"event": "queued", "ahead": jobs waiting or running before this one}
+    {"event": "started"}
+    {"event": "log", "level": "INFO", "message": "..."}
+    {"event": "done", "code": exit code}
+
+Only light modules are imported here, the command line tool imports this
+to hand its conversion to a running daemon.
+"""
+
+import json
+import os
+import socket
+import tempfile
+from typing import Any, Dict, Iterator, Optional
+
+from logger import get_logger
+
+logger = get_logger()
+
+SOCKET_NAME = "animation-converter"
+
+# Options naming files or folders written by a conversion, made absolute
+# even when they do not exist yet
+PATH_OPTIONS = (
+    "config",
+    "preview",
+    "log_file",
+    "output_sources",
+    "build_folder",
+    "output_folder",
+    "screen_cache_folder",
+    "build_cache_folder",
+    "trace",
+    "template_dir",
+)
+
+
+def daemon_supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, f"{SOCKET_NAME}.sock")
+    # The temp folder is shared by all users
+    user = getattr(os, "getuid", lambda: "user")()
+    return os.path.join(tempfile.gettempdir(), f"{SOCKET_NAME}-{user}.sock")
+
+
+def send_message(connection: socket.socket, message: Dict[str, Any]):
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+def read_messages(connection: socket.socket) -> Iterator[Dict[str, Any]]:
+    """Messages from connection until it is closed"""
+    with connection.makefile("rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def connect(socket_path: Optional[str] = None) -> Optional[socket.socket]:
+    """Connection to a running daemon, None when there is none"""
+    if not daemon_supported():
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path or default_socket_path())
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def absolute_args(args, cwd: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Args as a dict for a daemon running in another folder: input files,
+    output paths and every value naming an existing file made absolute, the
+    built files go to cwd unless an output folder is given.
+    """
+    cwd = cwd or os.getcwd()
+    options = dict(vars(args))
+    for name, value in options.items():
+        if not isinstance(value, str) or os.path.isabs(value):
+            continue
+        if name in PATH_OPTIONS or os.path.exists(os.path.join(cwd, value)):
+            options[name] = os.path.join(cwd, value)
+    options["input_files"] = [
+        os.path.join(cwd, path) for path in options.get("input_files", [])
+    ]
+    if not options.get("output_folder"):
+        options["output_folder"] = cwd
+    return options
+
+
+def convert_in_daemon(args, socket_path: Optional[str] = None) -> Optional[int]:
+    """
+    Convert args in a running daemon, relaying its log, None when no daemon
+    is running. The exit code of the conversion otherwise.
+    """
+    connection = connect(socket_path)
+    if connection is None:
+        return None
+
+    with connection:
+        logger.info("Converting in the running daemon")
+        send_message(connection, {"args": absolute_args(args)})
+        for message in read_messages(connection):
+            event = message.get("event")
+            if event == "log":
+                log = getattr(logger, message["level"].lower(), logger.info)
+                log(message["message"])
+            elif event == "queued":
+                logger.info(f"Queued, {message['ahead']} jobs ahead")
+            elif event == "done":
+                return message["code"]
+    logger.error("Daemon closed the connection before the conversion was done")
+    return 1
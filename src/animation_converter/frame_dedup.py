@@ -0,0 +1,175 @@
+"""
+Collapse runs of identical and nearly identical frames.
+
+GIF exports often repeat a frame to hold it on screen. Every repeat still
+costs a frame end and the per frame state ops in the animation stream. Here
+frames are hashed by what they show: the glyph and color of every cell and
+the border and background colors. A run of frames showing the same thing is
+kept as its first frame, shown for the summed slowdown of the run through
+the anim slowdown table. Optionally a frame differing from the first frame of
+the run in at most a given number of cells joins the run too.
+
+The table costs a slowdown op on most frames, so collapsing can also grow
+the stream. The collapse is kept with the runs needed to expand it again,
+the frames are packed both ways and the smaller stream wins.
+"""
+
+from typing import List, NamedTuple, Optional, Sequence
+
+from logger import get_logger
+from petscii import MAX_SCREEN_OFFSET, PetsciiScreen
+
+logger = get_logger()
+
+# Slowdown is written as a single byte
+MAX_SLOWDOWN = 255
+
+
+class DedupResult(NamedTuple):
+    screens: List[PetsciiScreen]
+    slowdown_table: List[int]
+    # Frames merged into every kept frame, the kept frame included
+    run_lengths: List[int]
+    anim_change_index: List[int]
+    identical_frames: int
+    near_duplicate_frames: int
+    merged_cells: int
+
+
+class CollapsedRuns(NamedTuple):
+    """Runs and the options from before collapsing them, to undo it"""
+
+    run_lengths: List[int]
+    anim_change_index: List[int]
+    slowdown_table: Optional[List[int]]
+    slowdown_frames: int
+
+
+def frame_key(screen: PetsciiScreen) -> tuple:
+    """Glyph and color of every cell, screen codes only mean something with the charset"""
+    if screen.charset:
+        cells = tuple(screen.charset[code] for code in screen.screen_codes)
+    else:
+        cells = tuple(screen.screen_codes)
+    return (
+        cells,
+        tuple(screen.color_data),
+        screen.border_color,
+        screen.background_color,
+    )
+
+
+def cell_difference(key1: tuple, key2: tuple) -> int:
+    """Cells that differ in glyph or color, every cell when border or background differ"""
+    if key1[2:] != key2[2:]:
+        return MAX_SCREEN_OFFSET
+    return sum(
+        1
+        for cell1, cell2, color1, color2 in zip(key1[0], key2[0], key1[1], key2[1])
+        if cell1 != cell2 or color1 != color2
+    )
+
+
+def dedup_screens(
+    screens: List[PetsciiScreen],
+    slowdown_table: Sequence[int],
+    slowdown_frames: int,
+    anim_change_index: Sequence[int],
+    max_cell_difference: int = 0,
+) -> DedupResult:
+    """
+    Merge runs of matching frames, slowdown of a frame comes from
+    slowdown_table like the packer reads it, or slowdown_frames without a
+    table. Frames without slowdown count as one video frame. Runs do not
+    cross the first frame of an input file.
+    """
+    kept_screens = []
+    kept_keys = []
+    durations = []
+    run_lengths = []
+    new_change_index = []
+    identical_frames = 0
+    near_duplicate_frames = 0
+    merged_cells = 0
+
+    for idx, screen in enumerate(screens):
+        if slowdown_table:
+            duration = slowdown_table[idx % len(slowdown_table)]
+        else:
+            duration = slowdown_frames
+        duration = max(1, duration)
+        key = frame_key(screen)
+
+        if kept_keys and idx not in anim_change_index:
+            run_key = kept_keys[-1]
+            run_duration = durations[-1] + duration
+            if run_duration <= MAX_SLOWDOWN:
+                if key == run_key:
+                    durations[-1] = run_duration
+                    run_lengths[-1] += 1
+                    identical_frames += 1
+                    continue
+                if max_cell_difference > 0:
+                    difference = cell_difference(key, run_key)
+                    if difference <= max_cell_difference:
+                        durations[-1] = run_duration
+                        run_lengths[-1] += 1
+                        near_duplicate_frames += 1
+                        merged_cells += difference
+                        continue
+
+        if idx in anim_change_index:
+            new_change_index.append(len(kept_screens))
+        kept_screens.append(screen)
+        kept_keys.append(key)
+        durations.append(duration)
+        run_lengths.append(1)
+
+    return DedupResult(
+        kept_screens,
+        durations,
+        run_lengths,
+        new_change_index,
+        identical_frames,
+        near_duplicate_frames,
+        merged_cells,
+    )
+
+
+def report_dedup(result: DedupResult, frame_count: int):
+    eliminated = frame_count - len(result.screens)
+    logger.info(
+        f"Frame dedup: {frame_count} -> {len(result.screens)} frames, "
+        f"{eliminated} eliminated, {result.identical_frames} identical and "
+        f"{result.near_duplicate_frames} near duplicate frames merged"
+    )
+    if result.near_duplicate_frames:
+        logger.info(
+            f"Frame dedup: {result.merged_cells} cells differ from shown frames"
+        )
+
+
+def expand_runs(
+    screens: Sequence[PetsciiScreen], run_lengths: Sequence[int]
+) -> List[PetsciiScreen]:
+    """Every kept frame repeated for its run, near duplicates show the kept frame"""
+    return [
+        screen
+        for screen, run_length in zip(screens, run_lengths)
+        for _ in range(run_length)
+    ]
+
+
+def report_stream_change(collapsed_size: int, expanded_size: int) -> bool:
+    """Log the animation data collapsing saves, False when it does not shrink it"""
+    if collapsed_size < expanded_size:
+        logger.info(
+            f"Frame dedup: {expanded_size} -> {collapsed_size} bytes of animation "
+            f"data, {expanded_size - collapsed_size} bytes eliminated"
+        )
+        return True
+    logger.warning(
+        f"Frame dedup: {collapsed_size} bytes of animation data with the runs "
+        f"collapsed, {expanded_size} without, keeping every frame"
+    )
+    return False
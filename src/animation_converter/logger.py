@@ -129,16 +129,29 @@ class AnimationToolLogger:
         if self._file_handler:
             self.logger.removeHandler(self._file_handler)
 
-        # Create new file handler
-        self._file_handler = logging.FileHandler(filepath, mode="w", encoding="utf-8")
-        self._file_handler.setLevel(level)
+        self._file_handler = self.create_file_handler(filepath, level)
+        self.logger.addHandler(self._file_handler)
+
+    @staticmethod
+    def create_file_handler(
+        filepath: str, level: int = logging.DEBUG
+    ) -> logging.Handler:
+        """
+        Create a file handler without adding it.
+
+        Args:
+            filepath: Path to log file
+            level: Minimum log level to write to file (default: DEBUG)
+        """
+        handler = logging.FileHandler(filepath, mode="w", encoding="utf-8")
+        handler.setLevel(level)
 
         # File logs don't need color codes
         formatter = logging.Formatter(
             "%(asctime)s - %(levelname)s - %(message)s", datefmt="%H:%M:%S"
         )
-        self._file_handler.setFormatter(formatter)
-        self.logger.addHandler(self._file_handler)
+        handler.setFormatter(formatter)
+        return handler
 
     def add_handler(self, handler: logging.Handler):
         """
@@ -149,6 +162,15 @@ class AnimationToolLogger:
         """
         self.logger.addHandler(handler)
 
+    def remove_handler(self, handler: logging.Handler):
+        """
+        Remove a handler added with add_handler.
+
+        Args:
+            handler: logging.Handler instance to remove
+        """
+        self.logger.removeHandler(handler)
+
     def set_level(self, level: int):
         """
         Set the console output level.
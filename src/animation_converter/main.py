@@ -1,57 +1,147 @@
+import argparse
 import multiprocessing
 import os
 import sys
+from typing import List, NamedTuple, Optional
 
+from anim_decoder import AnimDecoder
 from anim_reorder import reorder_screens_by_similarity
-from build_utils import build, clean_build, get_build_path
+import block_dictionary
+from build_cache import BuildCache
+from build_utils import (
+    build,
+    clean_build,
+    get_build_path,
+    get_labels_path,
+    get_output_path,
+)
 from cli_parser import parse_arguments
 import color_data_utils
 import colorama
+import cycle_model
+from daemon_client import convert_in_daemon
+import frame_dedup
 from logger import get_logger, setup_logging
-from packer import Packer
+from packer import PACKER_MAX_OP_CODES, Packer, PackerError
 from packer_config import set_packer_options
+import peephole
 import petscii
+from pipeline_context import PipelineContext, current_context, use_context
+from player_harness import verify_player
+from preview import DEFAULT_COLOR, write_preview
+import rle_allocation
+from screen_cache import ScreenCache
+from screen_renderer import glyphs_from_charset
+import stage_cache
+from stage_cache import StageCache
+from step_graph import StepGraph
+from tracing import Tracer, span
 import utils
 from utils import Size2D
+from watch import watch
+
+
+def pack_animation(
+    block_size: Size2D,
+    screens,
+    charsets,
+    anim_change_index,
+    output_file_name: str,
+    args,
+    report: bool = False,
+):
+    """
+    Pack with given block size: a statistics pass for RLE fill variant
+    allocation and the block dictionary, the final pass and the peephole pass
+    """
+    with span("pack block size", block_size=block_size, final=report):
+        return _pack_animation(
+            block_size,
+            screens,
+            charsets,
+            anim_change_index,
+            output_file_name,
+            args,
+            report,
+        )
 
 
-def main():
-    # Initialize colorama for cross-platform colored output
-    colorama.init(autoreset=True)
+def _pack_animation(
+    block_size, screens, charsets, anim_change_index, output_file_name, args, report
+):
+    packer = Packer(block_size=block_size)
+    set_packer_options(anim_change_index, output_file_name, packer, args)
+    anim_stream = packer.pack(screens, charsets, args.use_color)
 
-    # Parse command-line arguments
-    args = parse_arguments()
+    allocate_rle = not args.disable_rle_allocation and packer.FILL_RLE_OP_CODES
+    if allocate_rle or args.block_dictionary_size:
+        shapes = rle_allocation.collect_rle_shapes(packer, anim_stream)
+        counts, payload_sizes = block_dictionary.collect_block_payloads(
+            packer, anim_stream
+        )
 
-    # Setup logging based on verbosity flags
-    setup_logging(
-        verbose=getattr(args, "verbose", False),
-        quiet=getattr(args, "quiet", False),
-        log_file=getattr(args, "log_file", None),
-    )
-    logger = get_logger()
+        packer = Packer(block_size=block_size)
+        set_packer_options(anim_change_index, output_file_name, packer, args)
+        if args.block_dictionary_size:
+            dictionary = block_dictionary.choose_dictionary(
+                counts, payload_sizes, args.block_dictionary_size
+            )
+            packer.set_block_dictionary(dictionary.entries)
+            if report:
+                block_dictionary.report_dictionary(
+                    dictionary, args.block_dictionary_size
+                )
+        if allocate_rle:
+            allocation = rle_allocation.allocate_rle_variants(
+                shapes, PACKER_MAX_OP_CODES - packer.player_next_free_op
+            )
+            packer.set_rle_variants(allocation.variants)
+            if report:
+                rle_allocation.report_allocation(allocation, shapes)
+        anim_stream = packer.pack(screens, charsets, args.use_color)
 
-    default_charset = None
+    if not args.disable_peephole:
+        packed_size = len(anim_stream)
+        anim_stream, saved = peephole.optimize_stream(
+            packer, anim_stream, args.use_color
+        )
+        if report:
+            peephole.report_savings(saved, packed_size, len(anim_stream))
 
-    build_folder = get_build_path()
+    return packer, anim_stream
 
-    if args.charset:
-        if not os.path.exists(args.charset):
-            logger.error(f"File {args.charset} does not exist")
-            return 1
 
-        skip_first_bytes = args.charset.endswith(".64c")
+class IngestResult(NamedTuple):
+    screens: List[petscii.PetsciiScreen]
+    default_charset: Optional[List[petscii.PetsciiChar]]
+    anim_change_index: List[int]
+    output_file_name: str
+    anim_slowdown_table: Optional[List[int]]
+    anim_slowdown_frames: int
+    # Runs frame dedup collapsed, None when it kept every frame
+    collapsed_runs: Optional[frame_dedup.CollapsedRuns]
 
-        logger.info(f"Reading charset from file {args.charset}")
-        default_charset = petscii.read_charset(args.charset, skip_first_bytes)
-        logger.info(f"{len(default_charset)} characters found.")
 
-    utils.create_folder_if_not_exists(build_folder)
-    clean_build()
+def ingest(args, default_charset) -> Optional[IngestResult]:
+    """
+    Read the input files and apply the frame transforms, None when an input
+    does not exist. Frames of image inputs get their border color later.
+    """
+    logger = get_logger()
+    build_folder = get_build_path()
 
     anim_change_index = []
 
     output_file_name = None
 
+    read_screens = petscii.read_screens
+    cache = None
+    if args.screen_cache:
+        cache = ScreenCache(
+            args.screen_cache_folder, args.screen_cache_size * 1024 * 1024
+        )
+        read_screens = cache.read_screens
+
     screens = []
     for input_file in args.input_files:
         logger.info(f"Processing {input_file}, writing output to folder {build_folder}")
@@ -61,34 +151,73 @@ def main():
             logger.info("No default charset provided, using c64_charset.bin")
             default_charset = petscii.read_charset(f"{script_dir}/data/c64_charset.bin")
 
-        if not os.path.exists(input_file):
+        frame_files = petscii.find_frame_sequence(input_file)
+        if frame_files is None and not os.path.exists(input_file):
             logger.error(f"File {input_file} does not exist")
-            return 1
-        screens_in_file = petscii.read_screens(
-            input_file,
-            default_charset,
-            args.background_color,
-            args.border_color,
-            args.inverse,
-            args.cleanup,
-        )
+            return None
+        if frame_files == []:
+            logger.error(f"No PNG frames found in {input_file}")
+            return None
+        with span("read_screens", file=input_file):
+            screens_in_file = read_screens(
+                input_file,
+                default_charset,
+                args.background_color,
+                None,
+                args.inverse,
+                args.cleanup,
+                args.decode_workers,
+            )
         anim_change_index.append(len(screens))
         logger.info(f"Found {len(screens_in_file)} screens in file")
         screens.extend(screens_in_file)
 
         if output_file_name is None:
-            output_file_name = os.path.splitext(os.path.basename(input_file))[0]
+            if frame_files is not None and not os.path.isdir(input_file):
+                # Name glob patterns after the folder holding the frames
+                input_file = os.path.dirname(input_file)
+            output_file_name = os.path.splitext(
+                os.path.basename(os.path.normpath(input_file))
+            )[0]
+
+    screens, anim_change_index, collapsed_runs = transform_screens(
+        screens, anim_change_index, default_charset, args, read_screens
+    )
 
-    charsets = [default_charset]
+    if cache is not None:
+        cache.report()
+
+    return IngestResult(
+        screens,
+        default_charset,
+        anim_change_index,
+        output_file_name,
+        args.anim_slowdown_table,
+        args.anim_slowdown_frames,
+        collapsed_runs,
+    )
+
+
+def transform_screens(
+    screens, anim_change_index, default_charset, args, read_screens=None
+):
+    """
+    Reorder, color and dedup frames as args say. Sets the slowdown options of
+    args to the frames kept, returns the screens, animation change indexes and
+    the runs frame dedup collapsed, None when it kept every frame.
+    """
+    logger = get_logger()
+    read_screens = read_screens or petscii.read_screens
 
     if args.allow_reorder_frames:
         screens = reorder_screens_by_similarity(screens)
 
     if args.color_data:
         logger.info(f"Reading color data from {args.color_data}")
-        color_data_frames = petscii.read_screens(
-            args.color_data, default_charset, args.background_color, args.border_color
-        )
+        with span("read_screens", file=args.color_data):
+            color_data_frames = read_screens(
+                args.color_data, default_charset, args.background_color
+            )
         for idx, screen in enumerate(screens):
             color_frame = idx % len(color_data_frames)
             screen.color_data = [*color_data_frames[color_frame].color_data]
@@ -112,9 +241,50 @@ def main():
             screens, args.randomize_color_frames
         )
 
+    collapsed_runs = None
+    if args.dedup_frames:
+        dedup = frame_dedup.dedup_screens(
+            screens,
+            args.anim_slowdown_table or [],
+            args.anim_slowdown_frames,
+            anim_change_index,
+            args.near_duplicate_cells,
+        )
+        frame_dedup.report_dedup(dedup, len(screens))
+        if len(dedup.screens) < len(screens):
+            collapsed_runs = frame_dedup.CollapsedRuns(
+                dedup.run_lengths,
+                anim_change_index,
+                args.anim_slowdown_table,
+                args.anim_slowdown_frames,
+            )
+            screens = dedup.screens
+            anim_change_index = dedup.anim_change_index
+            args.anim_slowdown_table = dedup.slowdown_table
+            args.anim_slowdown_frames = dedup.slowdown_table[0]
+
+    return screens, anim_change_index, collapsed_runs
+
+
+def expand_collapsed_runs(screens, collapsed_runs, args):
+    """
+    Undo frame dedup: sets the slowdown options of args back, returns every
+    frame and the animation change indexes from before.
+    """
+    args.anim_slowdown_table = collapsed_runs.slowdown_table
+    args.anim_slowdown_frames = collapsed_runs.slowdown_frames
+    screens = frame_dedup.expand_runs(screens, collapsed_runs.run_lengths)
+    return screens, collapsed_runs.anim_change_index
+
+
+def build_charsets(screens, default_charset, args, debug_output_folder=None):
+    """Merge frame charsets, and compress them to args.limit_charsets"""
+    logger = get_logger()
+    charsets = [default_charset]
+
     if default_charset is None:
         logger.info("Remove duplicate characters")
-        screens, charsets = petscii.merge_charsets(screens, build_folder)
+        screens, charsets = petscii.merge_charsets(screens, debug_output_folder)
 
     for idx, screen in enumerate(screens):
         logger.debug(f"  screen {idx}: characters={screen.charset_size()}")
@@ -127,6 +297,24 @@ def main():
         else:
             logger.info(f"No need to limit charsets, already at {len(charsets)}")
 
+    return screens, charsets
+
+
+class PackResult(NamedTuple):
+    packer: Packer
+    anim_stream: List[int]
+    block_size: Size2D
+    # Border color of every screen when packed, see stage_cache.recolor_border_ops
+    borders: List[Optional[int]]
+    # False when the runs frame dedup collapsed were expanded again
+    runs_collapsed: bool = True
+
+
+def pack_smallest(
+    screens, charsets, anim_change_index, output_file_name, args
+) -> PackResult:
+    """Pack with every block size and again with the one giving the smallest stream"""
+    logger = get_logger()
     logger.info(f"Packing, use_color = {args.use_color}")
 
     smallest_size = None
@@ -145,23 +333,217 @@ def main():
 
     no_color_support = Size2D(2, 2)
 
+    context = current_context()
+    if context.reuse_block_size and context.selected_block_size is not None:
+        logger.info(
+            f"Packing with block size {context.selected_block_size} of the last search"
+        )
+        block_sizes = []
+        selected_block_size = context.selected_block_size
+
     for block_size in block_sizes:
 
         if args.use_color and block_size == no_color_support:
             continue
 
-        packer = Packer(block_size=block_size)
-        set_packer_options(anim_change_index, output_file_name, packer, args)
-        anim_stream = packer.pack(screens, charsets, args.use_color)
+        _, anim_stream = pack_animation(
+            block_size, screens, charsets, anim_change_index, output_file_name, args
+        )
 
         if smallest_size is None or len(anim_stream) < smallest_size:
             smallest_size = len(anim_stream)
             selected_block_size = block_size
 
-    packer = Packer(block_size=selected_block_size)
-    set_packer_options(anim_change_index, output_file_name, packer, args)
-    anim_stream = packer.pack(
-        screens, charsets, args.use_color, allow_debug_output=False
+    packer, anim_stream = pack_animation(
+        selected_block_size,
+        screens,
+        charsets,
+        anim_change_index,
+        output_file_name,
+        args,
+        report=True,
+    )
+    context.selected_block_size = selected_block_size
+
+    return PackResult(
+        packer,
+        anim_stream,
+        selected_block_size,
+        [screen.border_color for screen in screens],
+    )
+
+
+def pack_with_dedup(
+    screens, charsets, anim_change_index, output_file_name, args, collapsed_runs
+) -> PackResult:
+    """
+    pack_smallest, then with runs collapsed by frame dedup every frame again
+    at the selected block size. The collapse is undone when the slowdown ops
+    it adds outweigh the frames it eliminates.
+    """
+    packed = pack_smallest(screens, charsets, anim_change_index, output_file_name, args)
+    if collapsed_runs is None:
+        return packed
+
+    expanded_args = argparse.Namespace(**vars(args))
+    expanded_screens, expanded_change_index = expand_collapsed_runs(
+        screens, collapsed_runs, expanded_args
+    )
+    packer, anim_stream = pack_animation(
+        packed.block_size,
+        expanded_screens,
+        charsets,
+        expanded_change_index,
+        output_file_name,
+        expanded_args,
+    )
+    if frame_dedup.report_stream_change(len(packed.anim_stream), len(anim_stream)):
+        return packed
+    return PackResult(
+        packer,
+        anim_stream,
+        packed.block_size,
+        [screen.border_color for screen in expanded_screens],
+        runs_collapsed=False,
+    )
+
+
+def main():
+    # Initialize colorama for cross-platform colored output
+    colorama.init(autoreset=True)
+
+    # Parse command-line arguments
+    args = parse_arguments()
+
+    # Setup logging based on verbosity flags, the log file goes with the context
+    setup_logging(
+        verbose=getattr(args, "verbose", False),
+        quiet=getattr(args, "quiet", False),
+    )
+
+    if args.watch:
+        return watch(args, run)
+    if not args.local:
+        code = convert_in_daemon(args, args.daemon_socket)
+        if code is not None:
+            return code
+    try:
+        return run(args)
+    except PackerError as e:
+        get_logger().error(str(e))
+        return 1
+
+
+def run(args, context: Optional[PipelineContext] = None) -> int:
+    """
+    Convert with parsed command line args in context, a new context from
+    args by default. Conversions in different contexts can run at the same
+    time in threads of one process.
+    """
+    if context is None:
+        context = PipelineContext(
+            getattr(args, "build_folder", None),
+            getattr(args, "log_file", None),
+            getattr(args, "output_folder", None),
+        )
+    with use_context(context):
+        if not getattr(args, "trace", None):
+            return _run(args)
+
+        context.tracer = Tracer()
+        context.tracer.start()
+        try:
+            with span("conversion", config=args.config):
+                return _run(args)
+        finally:
+            context.tracer.stop()
+            context.tracer.write(args.trace)
+            get_logger().info(f"Trace written to {args.trace}")
+            context.tracer = None
+
+
+def _run(args) -> int:
+    logger = get_logger()
+
+    default_charset = None
+
+    build_folder = get_build_path()
+
+    if args.charset:
+        if not os.path.exists(args.charset):
+            logger.error(f"File {args.charset} does not exist")
+            return 1
+
+        skip_first_bytes = args.charset.endswith(".64c")
+
+        logger.info(f"Reading charset from file {args.charset}")
+        default_charset = petscii.read_charset(args.charset, skip_first_bytes)
+        logger.info(f"{len(default_charset)} characters found.")
+
+    utils.create_folder_if_not_exists(build_folder)
+    clean_build()
+    output_folder = current_context().output_folder
+    if output_folder:
+        utils.create_folder_if_not_exists(output_folder)
+
+    stages = StageCache(build_folder, args.incremental, current_context().stage_results)
+
+    ingest_fingerprint = stages.fingerprint(
+        stage_cache.stage_options(args, stage_cache.INGEST_OPTIONS)
+    )
+    ingested = stages.run(
+        "ingest", ingest_fingerprint, lambda: ingest(args, default_charset)
+    )
+    if ingested is None:
+        return 1
+    anim_change_index = ingested.anim_change_index
+    output_file_name = ingested.output_file_name
+    args.anim_slowdown_table = ingested.anim_slowdown_table
+    args.anim_slowdown_frames = ingested.anim_slowdown_frames
+
+    charsets_fingerprint = stages.fingerprint(
+        ingest_fingerprint,
+        stage_cache.stage_options(args, stage_cache.CHARSETS_OPTIONS),
+    )
+    screens, charsets = stages.run(
+        "charsets",
+        charsets_fingerprint,
+        lambda: build_charsets(
+            ingested.screens, ingested.default_charset, args, build_folder
+        ),
+    )
+
+    for screen in screens:
+        if screen.border_color is None:
+            screen.border_color = args.border_color
+    borders = [screen.border_color for screen in screens]
+
+    pack_fingerprint = stages.fingerprint(
+        charsets_fingerprint,
+        stage_cache.pack_options(args),
+        stage_cache.border_groups(borders),
+    )
+    packed = stages.run(
+        "pack",
+        pack_fingerprint,
+        lambda: pack_with_dedup(
+            screens,
+            charsets,
+            anim_change_index,
+            output_file_name,
+            args,
+            ingested.collapsed_runs,
+        ),
+    )
+    if not packed.runs_collapsed:
+        screens, anim_change_index = expand_collapsed_runs(
+            screens, ingested.collapsed_runs, args
+        )
+        borders = [screen.border_color for screen in screens]
+    packer = packed.packer
+    selected_block_size = packed.block_size
+    anim_stream = stage_cache.recolor_border_ops(
+        packer, packed.anim_stream, packed.borders, borders
     )
 
     logger.info(
@@ -170,41 +552,123 @@ def main():
         f"generated {len(anim_stream)} bytes of animation data"
     )
 
-    utils.write_bin(f"{build_folder}/anim.bin", anim_stream)
+    for tradeoff in packer.CYCLE_TRADEOFFS:
+        logger.info(f"Cycle budget, {tradeoff}")
 
-    packer.write_player(
-        screens,
-        charsets,
-        build_folder,
-        args.anim_slowdown_frames,
-        args.use_color,
+    frame_cycles = cycle_model.estimate_frame_cycles(
+        AnimDecoder.for_packer(packer), anim_stream, args.use_color, packer.LOOP_FRAME
     )
+    cycle_model.report_frame_cycles(frame_cycles, args.cycle_budget, args.fast_mode)
 
-    logger.info("Writing charsets")
-    for idx, charset in enumerate(charsets):
-        logger.debug(f"{build_folder}/charset_{idx}.bin")
-        petscii.write_charset(
-            charset,
-            f"{build_folder}/charset_{idx}.bin",
+    steps = StepGraph()
+    steps.add(
+        "anim.bin", lambda: utils.write_bin(f"{build_folder}/anim.bin", anim_stream)
+    )
+    steps.add(
+        "player",
+        lambda: packer.write_player(
+            screens,
+            charsets,
+            build_folder,
+            args.anim_slowdown_frames,
+            args.use_color,
+        ),
+    )
+    steps.add("charsets", lambda: write_charsets(charsets, build_folder))
+    build_inputs = ("anim.bin", "player", "charsets")
+
+    if args.preview:
+        steps.add(
+            "preview",
+            lambda: write_preview(
+                AnimDecoder.for_packer(packer),
+                anim_stream,
+                [glyphs_from_charset(charset) for charset in charsets],
+                args.preview,
+                slowdown_frames=args.anim_slowdown_frames,
+                default_color=0 if args.color_aberration_mode else DEFAULT_COLOR,
+            ),
         )
 
     if args.output_sources:
-        logger.success(f"Output sources to {args.output_sources}")
-        utils.create_folder_if_not_exists(args.output_sources)
-        for filename in os.listdir(build_folder):
-            file_path = os.path.join(build_folder, filename)
-            if os.path.isfile(file_path):
-                utils.copy_file(file_path, args.output_sources)
+        # 64tass writes its outputs meanwhile, they were never copied
+        build_outputs = {f"{output_file_name}.lst", f"{output_file_name}.labels"}
+        steps.add(
+            "output sources",
+            lambda: copy_sources(build_folder, args.output_sources, build_outputs),
+            after=build_inputs,
+        )
 
     if not args.skip_build:
-        build(output_file_name, args.non_linear_prg)
+        steps.add(
+            "build",
+            lambda: build_and_verify(
+                packer, anim_stream, output_file_name, frame_cycles, args
+            ),
+            after=build_inputs,
+        )
 
     if args.write_petmate:
-        petscii.write_petmate(screens, f"{output_file_name}.petmate", True)
+        steps.add(
+            "petmate",
+            lambda: petscii.write_petmate(
+                screens, get_output_path(f"{output_file_name}.petmate"), True
+            ),
+        )
+
+    with span("stage output"):
+        results = steps.run()
+    if results.get("build") is False:
+        return 1
 
     return 0
 
 
+def write_charsets(charsets, build_folder: str):
+    get_logger().info("Writing charsets")
+    for idx, charset in enumerate(charsets):
+        get_logger().debug(f"{build_folder}/charset_{idx}.bin")
+        petscii.write_charset(
+            charset,
+            f"{build_folder}/charset_{idx}.bin",
+        )
+
+
+def copy_sources(build_folder: str, destination: str, skipped):
+    get_logger().success(f"Output sources to {destination}")
+    utils.create_folder_if_not_exists(destination)
+    for filename in os.listdir(build_folder):
+        file_path = os.path.join(build_folder, filename)
+        if os.path.isfile(file_path) and filename not in skipped:
+            utils.copy_file(file_path, destination)
+
+
+def build_and_verify(packer, anim_stream, output_file_name, frame_cycles, args) -> bool:
+    """
+    Build the .prg and run it on the emulator, False when 64tass fails or the
+    player is broken
+    """
+    build_ok = build(
+        output_file_name,
+        args.non_linear_prg,
+        BuildCache(args.build_cache_folder) if args.build_cache else None,
+        args.splice_prg,
+    )
+    if not build_ok:
+        return False
+    if not args.emulate_player:
+        return True
+    return verify_player(
+        get_output_path(f"{output_file_name}.prg"),
+        get_labels_path(output_file_name),
+        list(AnimDecoder.for_packer(packer).frames(anim_stream)),
+        args.use_color,
+        frame_cycles,
+        args.non_linear_prg,
+        packer.LOOP_FRAME if args.loop_closure else None,
+    )
+
+
 if __name__ == "__main__":
     multiprocessing.freeze_support()
     sys.exit(main())
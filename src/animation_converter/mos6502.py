@@ -0,0 +1,510 @@
+"""
+Minimal cycle counting NMOS 6502 core.
+
+Implements all documented opcodes with their base cycle counts, the extra
+cycle for indexed reads crossing a page and the branch penalties. Memory is a
+flat 64KB bytearray without I/O, which is enough to run the animation player
+headless and measure how long it takes to unpack frames.
+"""
+
+from typing import Callable, List, Optional, Tuple
+
+MEMORY_SIZE = 0x10000
+BYTE_MAX = 0xFF
+NIBBLE_MAX = 0x0F
+BCD_DIGIT_MAX = 9
+STACK_BASE = 0x100
+RETURN_TRAP = 0xFFFF
+
+FLAG_C = 0x01
+FLAG_Z = 0x02
+FLAG_I = 0x04
+FLAG_D = 0x08
+FLAG_B = 0x10
+FLAG_U = 0x20
+FLAG_V = 0x40
+FLAG_N = 0x80
+
+# Addressing modes
+IMP, ACC, IMM, ZP, ZPX, ZPY, ABS, ABSX, ABSY, IND, INDX, INDY, REL = range(13)
+
+# Operand bytes per addressing mode
+MODE_SIZES = [0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 1, 1, 1]
+
+# Group 1 opcodes aaabbb01, indexed by bbb: mode, cycles
+_GROUP1_MODES = [
+    (INDX, 6),
+    (ZP, 3),
+    (IMM, 2),
+    (ABS, 4),
+    (INDY, 5),
+    (ZPX, 4),
+    (ABSY, 4),
+    (ABSX, 4),
+]
+_STORE_CYCLES = {INDX: 6, ZP: 3, ABS: 4, INDY: 6, ZPX: 4, ABSY: 5, ABSX: 5}
+
+# Read-modify-write opcodes aaabbb10, indexed by bbb
+_RMW_MODES = {1: (ZP, 5), 2: (ACC, 2), 3: (ABS, 6), 5: (ZPX, 6), 7: (ABSX, 7)}
+
+
+class CpuError(Exception):
+    pass
+
+
+class CPU:
+    def __init__(self, memory: Optional[bytearray] = None):
+        self.memory = memory if memory is not None else bytearray(MEMORY_SIZE)
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0xFF
+        self.pc = 0
+        self.p = FLAG_U | FLAG_I
+        self.cycles = 0
+        self._table: List[Optional[Tuple[Callable, int, int, bool]]] = [None] * 256
+        self._address_modes = [
+            self._implied,
+            self._implied,
+            self._immediate,
+            self._zero_page,
+            self._zero_page_x,
+            self._zero_page_y,
+            self._absolute,
+            self._absolute_x,
+            self._absolute_y,
+            self._indirect,
+            self._indexed_indirect,
+            self._indirect_indexed,
+            self._immediate,
+        ]
+        self._build_table()
+
+    # Memory helpers
+
+    def load(self, address: int, data: bytes):
+        self.memory[address : address + len(data)] = data
+
+    def read_word(self, address: int) -> int:
+        return self.memory[address & 0xFFFF] | (
+            self.memory[(address + 1) & 0xFFFF] << 8
+        )
+
+    def push(self, value: int):
+        self.memory[STACK_BASE + self.sp] = value & 0xFF
+        self.sp = (self.sp - 1) & 0xFF
+
+    def pull(self) -> int:
+        self.sp = (self.sp + 1) & 0xFF
+        return self.memory[STACK_BASE + self.sp]
+
+    def call(self, address: int, max_cycles: int = 10_000_000) -> int:
+        """Run subroutine at address until it returns, returns cycles used"""
+        trap = RETURN_TRAP - 1
+        self.push(trap >> 8)
+        self.push(trap & 0xFF)
+        self.pc = address
+        start = self.cycles
+        # jsr into the routine
+        self.cycles += 6
+        limit = start + max_cycles
+        while self.pc != RETURN_TRAP:
+            self.step()
+            if self.cycles > limit:
+                raise CpuError(
+                    f"Subroutine ${address:04x} did not return in {max_cycles} cycles, "
+                    f"pc ${self.pc:04x}"
+                )
+        return self.cycles - start
+
+    # Execution
+
+    def step(self):
+        op_code = self.memory[self.pc]
+        entry = self._table[op_code]
+        if entry is None:
+            raise CpuError(f"Illegal opcode ${op_code:02x} at ${self.pc:04x}")
+        handler, mode, cycles, page_penalty = entry
+        address, crossed = self._operand_address(mode)
+        self.cycles += cycles
+        if crossed and page_penalty:
+            self.cycles += 1
+        handler(address)
+
+    def _operand_address(self, mode: int) -> Tuple[Optional[int], bool]:
+        pc = self.pc
+        self.pc = (pc + 1 + MODE_SIZES[mode]) & 0xFFFF
+        return self._address_modes[mode](pc + 1)
+
+    # Addressing modes, each takes the address of the operand bytes and
+    # returns the effective address and whether indexing crossed a page
+
+    @staticmethod
+    def _implied(_operand):
+        return None, False
+
+    @staticmethod
+    def _immediate(operand):
+        return operand & 0xFFFF, False
+
+    def _zero_page(self, operand):
+        return self.memory[operand], False
+
+    def _zero_page_x(self, operand):
+        return (self.memory[operand] + self.x) & 0xFF, False
+
+    def _zero_page_y(self, operand):
+        return (self.memory[operand] + self.y) & 0xFF, False
+
+    def _absolute(self, operand):
+        return self.read_word(operand), False
+
+    def _absolute_indexed(self, base, index):
+        address = (base + index) & 0xFFFF
+        return address, (base & 0xFF00) != (address & 0xFF00)
+
+    def _absolute_x(self, operand):
+        return self._absolute_indexed(self.read_word(operand), self.x)
+
+    def _absolute_y(self, operand):
+        return self._absolute_indexed(self.read_word(operand), self.y)
+
+    def _indirect(self, operand):
+        base = self.read_word(operand)
+        # NMOS bug, pointer high byte does not cross page
+        high = (base & 0xFF00) | ((base + 1) & 0xFF)
+        return self.memory[base] | (self.memory[high] << 8), False
+
+    def _zero_page_word(self, pointer):
+        return self.memory[pointer] | (self.memory[(pointer + 1) & 0xFF] << 8)
+
+    def _indexed_indirect(self, operand):
+        return self._zero_page_word((self.memory[operand] + self.x) & 0xFF), False
+
+    def _indirect_indexed(self, operand):
+        return self._absolute_indexed(
+            self._zero_page_word(self.memory[operand]), self.y
+        )
+
+    def _set_nz(self, value: int) -> int:
+        self.p = (self.p & ~(FLAG_N | FLAG_Z)) | (value & FLAG_N)
+        if value == 0:
+            self.p |= FLAG_Z
+        return value
+
+    def _set_flag(self, flag: int, state):
+        if state:
+            self.p |= flag
+        else:
+            self.p &= ~flag
+
+    # Instructions
+
+    def _lda(self, address):
+        self.a = self._set_nz(self.memory[address])
+
+    def _ldx(self, address):
+        self.x = self._set_nz(self.memory[address])
+
+    def _ldy(self, address):
+        self.y = self._set_nz(self.memory[address])
+
+    def _sta(self, address):
+        self.memory[address] = self.a
+
+    def _stx(self, address):
+        self.memory[address] = self.x
+
+    def _sty(self, address):
+        self.memory[address] = self.y
+
+    def _ora(self, address):
+        self.a = self._set_nz(self.a | self.memory[address])
+
+    def _and(self, address):
+        self.a = self._set_nz(self.a & self.memory[address])
+
+    def _eor(self, address):
+        self.a = self._set_nz(self.a ^ self.memory[address])
+
+    def _adc(self, address):
+        value = self.memory[address]
+        carry = self.p & FLAG_C
+        result = self.a + value + carry
+        if self.p & FLAG_D:
+            low = (self.a & 0x0F) + (value & 0x0F) + carry
+            high = (self.a >> 4) + (value >> 4)
+            if low > BCD_DIGIT_MAX:
+                low += 6
+            if low > NIBBLE_MAX:
+                high += 1
+            self._set_flag(FLAG_Z, (result & 0xFF) == 0)
+            self._set_flag(FLAG_N, high & 0x08)
+            self._set_flag(FLAG_V, ~(self.a ^ value) & (self.a ^ (high << 4)) & 0x80)
+            if high > BCD_DIGIT_MAX:
+                high += 6
+            self._set_flag(FLAG_C, high > NIBBLE_MAX)
+            self.a = ((high << 4) | (low & 0x0F)) & 0xFF
+            return
+        self._set_flag(FLAG_C, result > BYTE_MAX)
+        self._set_flag(FLAG_V, ~(self.a ^ value) & (self.a ^ result) & 0x80)
+        self.a = self._set_nz(result & 0xFF)
+
+    def _sbc(self, address):
+        value = self.memory[address]
+        borrow = 1 - (self.p & FLAG_C)
+        result = self.a - value - borrow
+        self._set_flag(FLAG_V, (self.a ^ value) & (self.a ^ result) & 0x80)
+        self._set_flag(FLAG_C, result >= 0)
+        if self.p & FLAG_D:
+            self._set_nz(result & 0xFF)
+            low = (self.a & 0x0F) - (value & 0x0F) - borrow
+            high = (self.a >> 4) - (value >> 4)
+            if low & 0x10:
+                low -= 6
+                high -= 1
+            if high & 0x10:
+                high -= 6
+            self.a = ((high << 4) | (low & 0x0F)) & 0xFF
+            return
+        self.a = self._set_nz(result & 0xFF)
+
+    def _compare(self, register, address):
+        result = register - self.memory[address]
+        self._set_flag(FLAG_C, result >= 0)
+        self._set_nz(result & 0xFF)
+
+    def _cmp(self, address):
+        self._compare(self.a, address)
+
+    def _cpx(self, address):
+        self._compare(self.x, address)
+
+    def _cpy(self, address):
+        self._compare(self.y, address)
+
+    def _bit(self, address):
+        value = self.memory[address]
+        self.p = (self.p & ~(FLAG_N | FLAG_V | FLAG_Z)) | (value & (FLAG_N | FLAG_V))
+        if self.a & value == 0:
+            self.p |= FLAG_Z
+
+    def _rmw(self, operation):
+        def handler(address):
+            if address is None:
+                self.a = operation(self.a)
+            else:
+                self.memory[address] = operation(self.memory[address])
+
+        return handler
+
+    def _asl_value(self, value):
+        self._set_flag(FLAG_C, value & 0x80)
+        return self._set_nz((value << 1) & 0xFF)
+
+    def _lsr_value(self, value):
+        self._set_flag(FLAG_C, value & 0x01)
+        return self._set_nz(value >> 1)
+
+    def _rol_value(self, value):
+        result = ((value << 1) | (self.p & FLAG_C)) & 0xFF
+        self._set_flag(FLAG_C, value & 0x80)
+        return self._set_nz(result)
+
+    def _ror_value(self, value):
+        result = (value >> 1) | ((self.p & FLAG_C) << 7)
+        self._set_flag(FLAG_C, value & 0x01)
+        return self._set_nz(result)
+
+    def _inc_value(self, value):
+        return self._set_nz((value + 1) & 0xFF)
+
+    def _dec_value(self, value):
+        return self._set_nz((value - 1) & 0xFF)
+
+    def _branch(self, flag, state):
+        def handler(address):
+            if bool(self.p & flag) == state:
+                offset = self.memory[address]
+                if offset & 0x80:
+                    offset -= 0x100
+                target = (self.pc + offset) & 0xFFFF
+                self.cycles += 1 + ((target & 0xFF00) != (self.pc & 0xFF00))
+                self.pc = target
+
+        return handler
+
+    def _jmp(self, address):
+        self.pc = address
+
+    def _jsr(self, address):
+        return_address = (self.pc - 1) & 0xFFFF
+        self.push(return_address >> 8)
+        self.push(return_address & 0xFF)
+        self.pc = address
+
+    def _rts(self, _address):
+        low = self.pull()
+        self.pc = (((self.pull() << 8) | low) + 1) & 0xFFFF
+
+    def _rti(self, _address):
+        self.p = (self.pull() & ~FLAG_B) | FLAG_U
+        low = self.pull()
+        self.pc = (self.pull() << 8) | low
+
+    def _brk(self, _address):
+        return_address = (self.pc + 1) & 0xFFFF
+        self.push(return_address >> 8)
+        self.push(return_address & 0xFF)
+        self.push(self.p | FLAG_B | FLAG_U)
+        self.p |= FLAG_I
+        self.pc = self.read_word(0xFFFE)
+
+    def _build_table(self):
+        def add(op_code, handler, mode, cycles, page_penalty=False):
+            self._table[op_code] = (handler, mode, cycles, page_penalty)
+
+        group1 = [self._ora, self._and, self._eor, self._adc, self._sta, self._lda]
+        group1 += [self._cmp, self._sbc]
+        for aaa, handler in enumerate(group1):
+            for bbb, (mode, cycles) in enumerate(_GROUP1_MODES):
+                op_code = (aaa << 5) | (bbb << 2) | 0x01
+                if handler == self._sta:
+                    if mode != IMM:
+                        add(op_code, handler, mode, _STORE_CYCLES[mode])
+                else:
+                    add(op_code, handler, mode, cycles, mode in (ABSX, ABSY, INDY))
+
+        rmw = [
+            self._asl_value,
+            self._rol_value,
+            self._lsr_value,
+            self._ror_value,
+            None,
+            None,
+            self._dec_value,
+            self._inc_value,
+        ]
+        for aaa, operation in enumerate(rmw):
+            if operation is None:
+                continue
+            for bbb, (mode, cycles) in _RMW_MODES.items():
+                if mode == ACC and aaa >= 6:  # noqa: PLR2004
+                    continue
+                add((aaa << 5) | (bbb << 2) | 0x02, self._rmw(operation), mode, cycles)
+
+        loads = [
+            (0xA2, self._ldx, IMM, 2),
+            (0xA6, self._ldx, ZP, 3),
+            (0xB6, self._ldx, ZPY, 4),
+            (0xAE, self._ldx, ABS, 4),
+            (0xBE, self._ldx, ABSY, 4),
+            (0xA0, self._ldy, IMM, 2),
+            (0xA4, self._ldy, ZP, 3),
+            (0xB4, self._ldy, ZPX, 4),
+            (0xAC, self._ldy, ABS, 4),
+            (0xBC, self._ldy, ABSX, 4),
+            (0x86, self._stx, ZP, 3),
+            (0x96, self._stx, ZPY, 4),
+            (0x8E, self._stx, ABS, 4),
+            (0x84, self._sty, ZP, 3),
+            (0x94, self._sty, ZPX, 4),
+            (0x8C, self._sty, ABS, 4),
+            (0xE0, self._cpx, IMM, 2),
+            (0xE4, self._cpx, ZP, 3),
+            (0xEC, self._cpx, ABS, 4),
+            (0xC0, self._cpy, IMM, 2),
+            (0xC4, self._cpy, ZP, 3),
+            (0xCC, self._cpy, ABS, 4),
+            (0x24, self._bit, ZP, 3),
+            (0x2C, self._bit, ABS, 4),
+        ]
+        for op_code, handler, mode, cycles in loads:
+            add(op_code, handler, mode, cycles, mode in (ABSX, ABSY))
+
+        branches = [
+            (0x10, FLAG_N, False),
+            (0x30, FLAG_N, True),
+            (0x50, FLAG_V, False),
+            (0x70, FLAG_V, True),
+            (0x90, FLAG_C, False),
+            (0xB0, FLAG_C, True),
+            (0xD0, FLAG_Z, False),
+            (0xF0, FLAG_Z, True),
+        ]
+        for op_code, flag, state in branches:
+            add(op_code, self._branch(flag, state), REL, 2)
+
+        def flag_op(flag, state):
+            def handler(_address):
+                self._set_flag(flag, state)
+
+            return handler
+
+        def transfer(source, target, set_flags=True):
+            def handler(_address):
+                value = getattr(self, source)
+                setattr(self, target, value)
+                if set_flags:
+                    self._set_nz(value)
+
+            return handler
+
+        def step_register(register, delta):
+            def handler(_address):
+                setattr(
+                    self,
+                    register,
+                    self._set_nz((getattr(self, register) + delta) & 0xFF),
+                )
+
+            return handler
+
+        def pha(_address):
+            self.push(self.a)
+
+        def php(_address):
+            self.push(self.p | FLAG_B | FLAG_U)
+
+        def pla(_address):
+            self.a = self._set_nz(self.pull())
+
+        def plp(_address):
+            self.p = (self.pull() & ~FLAG_B) | FLAG_U
+
+        def nop(_address):
+            pass
+
+        implied = [
+            (0x18, flag_op(FLAG_C, False), 2),
+            (0x38, flag_op(FLAG_C, True), 2),
+            (0x58, flag_op(FLAG_I, False), 2),
+            (0x78, flag_op(FLAG_I, True), 2),
+            (0xB8, flag_op(FLAG_V, False), 2),
+            (0xD8, flag_op(FLAG_D, False), 2),
+            (0xF8, flag_op(FLAG_D, True), 2),
+            (0xAA, transfer("a", "x"), 2),
+            (0xA8, transfer("a", "y"), 2),
+            (0x8A, transfer("x", "a"), 2),
+            (0x98, transfer("y", "a"), 2),
+            (0xBA, transfer("sp", "x"), 2),
+            (0x9A, transfer("x", "sp", set_flags=False), 2),
+            (0xE8, step_register("x", 1), 2),
+            (0xC8, step_register("y", 1), 2),
+            (0xCA, step_register("x", -1), 2),
+            (0x88, step_register("y", -1), 2),
+            (0x48, pha, 3),
+            (0x08, php, 3),
+            (0x68, pla, 4),
+            (0x28, plp, 4),
+            (0xEA, nop, 2),
+            (0x60, self._rts, 6),
+            (0x40, self._rti, 6),
+            (0x00, self._brk, 7),
+        ]
+        for op_code, handler, cycles in implied:
+            add(op_code, handler, IMP, cycles)
+
+        add(0x4C, self._jmp, ABS, 3)
+        add(0x6C, self._jmp, IND, 5)
+        add(0x20, self._jsr, ABS, 6)
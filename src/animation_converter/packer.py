@@ -1,8 +1,9 @@
+from functools import lru_cache
 from io import StringIO
 from itertools import islice
+import multiprocessing
 import os
-import sys
-from typing import List
+from typing import Dict, List, Optional
 
 import color_data_utils
 from jinja2 import Environment, FileSystemLoader
@@ -10,6 +11,7 @@ from logger import get_logger
 from petscii import PetsciiChar, PetsciiScreen
 from rle_codec import RLECodec
 from scroller import find_areas_with_content
+from tracing import span
 import utils
 from utils import Block, Size2D
 
@@ -23,6 +25,48 @@ MAX_SCREEN_OFFSET = 1000
 MIN_COMPRESSION_RUN_LENGTH = 3
 PER_ROW_END_LINE_MARKER = 200
 PER_ROW_CODE_OFFSET = 100
+# Bytes a saved frame must save in later frames, saving costs ~10k cycles
+HISTORY_MIN_SAVED_BYTES = 64
+# Frames each pack worker should get, below this pool startup dominates
+MIN_FRAMES_PER_PACK_WORKER = 32
+
+
+class PackerError(Exception):
+    """Packing failed, raised instead of exiting so callers can recover"""
+
+
+@lru_cache(maxsize=None)
+def template_environment(template_dir: str) -> Environment:
+    """One Jinja environment per template folder, it reloads changed templates"""
+    return Environment(
+        loader=FileSystemLoader(template_dir), trim_blocks=True, lstrip_blocks=True
+    )
+
+
+def _diff_frame_chunk(job):
+    """
+    Encode consecutive frames on a copy of the packer. Returns the diffs, the
+    RLE fill variants added in order of first use, full screen RLE counts and
+    the changed blocks and macro blocks.
+    """
+    packer, frame_pairs, use_color = job
+    first_new_op = len(packer.FILL_RLE_OP_CODES)
+    packer.USED_RLE_COUNTS = {}
+    diffs = [packer.diff_frame_layers(*pair, use_color) for pair in frame_pairs]
+    used_blocks = set()
+    used_macro_blocks = set()
+    for pair in frame_pairs:
+        blocks, macro_blocks = packer.changed_blocks(*pair, use_color)
+        used_blocks |= blocks
+        used_macro_blocks |= macro_blocks
+    added = [
+        (
+            packer.FILL_RLE_SIZE[op],
+            packer.FILL_RLE_TEMPLATE_HELPER[packer.OP_CODES[op]]["decoded"],
+        )
+        for op in packer.FILL_RLE_OP_CODES[first_new_op:]
+    ]
+    return diffs, added, packer.USED_RLE_COUNTS, (used_blocks, used_macro_blocks)
 
 
 class Packer:
@@ -62,6 +106,27 @@ class Packer:
         self.FILL_RLE_OP_CODES = []
         self.FILL_RLE_SIZE = {}
         self.FILL_RLE_TEMPLATE_HELPER = {}
+        # Allowed (encoded size, decoded size) RLE fills, None allows all
+        self.RLE_VARIANTS = None
+        # Block contents by block size, written with player_op_fill_dict{size}
+        self.BLOCK_DICTIONARY = {}
+        self.BLOCK_DICTIONARY_INDEX = {}
+        self.FILL_DICT_SIZE = {}
+        # Ring of frames saved by the player, blocks can be copied back from it
+        self.HISTORY_SLOTS = 0
+        self.HISTORY_LOCATION = "$c000"
+        self.SAVE_HISTORY_OP_CODES = []
+        self.COPY_HISTORY_SIZE = {}
+        self.COPY_HISTORY_OP_CODE = {}
+        self.HISTORY_LOOKUP = {}
+        self.HISTORY_LOOKUPS = ({}, {})
+        self.UNPACK_HISTORY = {}
+        self.LOOP_CLOSURE = False
+        # Frame and stream offset the restart op jumps back to
+        self.LOOP_FRAME = 0
+        self.LOOP_OFFSET = 0
+        # Processes encoding frames in pack, None for CPU count
+        self.PACK_WORKERS = None
         self.BLOCK_OFFSETS_SIZES = set()
         self.USED_RLE_COUNTS = {}
         self.OPS_USED = set()
@@ -137,6 +202,9 @@ class Packer:
         self.COLOR_ABERRATION_MODE = False
         self.COLOR_ABERRATION_COLORS = []
         self.COLOR_ABERRATION_SCROLL = []
+        self.CYCLE_MODEL = None
+        self.CYCLE_BUDGET = None
+        self.CYCLE_TRADEOFFS = []
 
         self._initialize_player_ops()
 
@@ -156,6 +224,7 @@ class Packer:
         self.OP_FULL_SCREEN_2x2_BLOCKS = self.add_op("player_op_fullscreen_2x2_blocks")
         self.OP_PER_ROW_CHANGES = self.add_op("player_op_per_row_changes")
         self.OP_SET_ANIM_SLOWDOWN = self.add_op("player_set_anim_slowndown")
+        self.OP_NEXT_BLOCK = self.add_op("player_op_next_block")
 
         for macro_block in self.get_macro_blocks():
             for block in self.get_blocks(macro_block):
@@ -173,10 +242,9 @@ class Packer:
         self.USED_BLOCKS = set()
 
         if self.player_next_free_op >= PACKER_MAX_OP_CODES:
-            logger.error(
+            raise PackerError(
                 f"Player op code count is too high! {self.player_next_free_op}"
             )
-            sys.exit(1)
 
     def set_rle_encoder_enabled(self, state: bool):
         self.RLE_ENCODER_ENABLED = state
@@ -328,26 +396,132 @@ class Packer:
             anim_stream.extend(block_changes)
         return anim_stream
 
-    def encode_block(self, screen: List[int], block: Block, anim_stream: List[int]):
+    def add_fill_rle_op(self, encoded_size: int, decoded_size: int) -> str:
+        op_name = f"player_op_fill_rle{encoded_size}_{decoded_size}"
+        if op_name not in self.NAME_TO_OP_CODE:
+            op = self.add_op(op_name)
+            self.FILL_RLE_SIZE[op] = encoded_size
+            self.FILL_RLE_TEMPLATE_HELPER[op_name] = {
+                "decoded": decoded_size,
+                "encoded": encoded_size,
+            }
+            self.FILL_RLE_OP_CODES.append(op)
+        return op_name
+
+    def set_rle_variants(self, variants):
+        """
+        Limit RLE fills to the given (encoded size, decoded size) variants and
+        allocate their op codes up front
+        """
+        self.RLE_VARIANTS = set(variants)
+        for encoded_size, decoded_size in sorted(self.RLE_VARIANTS):
+            self.add_fill_rle_op(encoded_size, decoded_size)
+
+    def set_history_slots(self, slots: int, location: str):
+        """Let the player keep slots earlier frames at location"""
+        self.HISTORY_SLOTS = slots
+        self.HISTORY_LOCATION = location
+        for slot in range(slots):
+            self.SAVE_HISTORY_OP_CODES.append(
+                self.add_op(f"player_op_save_history{slot}")
+            )
+        for sz in sorted(self.BLOCK_OFFSETS_SIZES):
+            op = self.add_op(f"player_op_copy_history{sz}")
+            self.COPY_HISTORY_SIZE[op] = sz
+            self.COPY_HISTORY_OP_CODE[sz] = op
+
+    def plan_history_saves(self, screens: List[PetsciiScreen], use_color: bool):
+        """
+        Frames worth saving to history: changed blocks of later frames are
+        looked up by contents, every match is credited to the most recent
+        earlier frame that showed the same contents in the same block. A
+        frame is saved when its credit is at least HISTORY_MIN_SAVED_BYTES.
+        The cycles of the save are only weighed against CYCLE_BUDGET.
+        """
+        last_seen = {}
+        saved_bytes = {}
+        empty = [0] * MAX_SCREEN_OFFSET
+        for idx, screen in enumerate(screens):
+            layers = [(screen.screen_codes, screens[idx - 1].screen_codes)]
+            if use_color:
+                layers.append((screen.color_data, screens[idx - 1].color_data))
+            for layer, (data, prev_data) in enumerate(layers):
+                if idx == 0:
+                    prev_data = empty
+                for block in self.ALL_BLOCKS:
+                    payload = tuple(self.read_block(data, block))
+                    key = (layer, block, payload)
+                    if len(set(payload)) > 1 and payload != tuple(
+                        self.read_block(prev_data, block)
+                    ):
+                        source = last_seen.get(key)
+                        if source is not None:
+                            saved_bytes[source] = (
+                                saved_bytes.get(source, 0) + len(payload) - 1
+                            )
+                    last_seen[key] = idx
+        return {
+            idx
+            for idx, saved in saved_bytes.items()
+            if saved >= HISTORY_MIN_SAVED_BYTES
+        }
+
+    def history_lookup(self, history, layer: int):
+        """Slot by (block, contents) of the frames in history, newest wins"""
+        lookup = {}
+        for slot, frames in history:
+            for block in self.ALL_BLOCKS:
+                lookup[(block, tuple(self.read_block(frames[layer], block)))] = slot
+        return lookup
+
+    def set_block_dictionary(self, dictionary):
+        """Use dictionary of block size to list of block contents"""
+        self.BLOCK_DICTIONARY = {
+            size: [list(entry) for entry in entries]
+            for size, entries in dictionary.items()
+        }
+        for size, entries in sorted(dictionary.items()):
+            op = self.add_op(f"player_op_fill_dict{size}")
+            self.FILL_DICT_SIZE[op] = size
+            for idx, entry in enumerate(entries):
+                self.BLOCK_DICTIONARY_INDEX[tuple(entry)] = (op, idx)
+
+    def fit_rle_variant(self, encoded: List[int], data: List[int]) -> List[int]:
+        """
+        Spread encoded data to the shortest allowed variant by splitting runs,
+        returns the raw data when no variant fits
+        """
+        extra_pairs_possible = RLECodec.extra_pairs_possible(encoded)
+        for extra_pairs in range(extra_pairs_possible + 1):
+            encoded_size = len(encoded) + 2 * extra_pairs
+            if encoded_size >= len(data) - 2:
+                break
+            if (encoded_size, len(data)) in self.RLE_VARIANTS:
+                return RLECodec.split_runs(encoded, extra_pairs)
+        return data
+
+    def encode_block(
+        self,
+        screen: List[int],
+        block: Block,
+        anim_stream: List[int],
+        use_rle: bool = True,
+    ):
         data = self.read_block(screen, block)
         if len(set(data)) <= 1:
             anim_stream.append(self.NAME_TO_OP_CODE[f"player_op_fill_same{len(data)}"])
             anim_stream.append(data[0])
+        elif tuple(data) in self.BLOCK_DICTIONARY_INDEX:
+            anim_stream.extend(self.BLOCK_DICTIONARY_INDEX[tuple(data)])
+        elif (block, tuple(data)) in self.HISTORY_LOOKUP:
+            anim_stream.append(self.COPY_HISTORY_OP_CODE[len(data)])
+            anim_stream.append(self.HISTORY_LOOKUP[(block, tuple(data))])
         else:
-            encoded = RLECodec.encode(data)
+            encoded = RLECodec.encode(data) if use_rle else data
+            if use_rle and self.RLE_VARIANTS is not None:
+                encoded = self.fit_rle_variant(encoded, data)
             if len(encoded) < len(data) - 2:
-                op_name = f"player_op_fill_rle{
-                len(encoded)}_{
-                len(data)}"
-                if op_name not in self.NAME_TO_OP_CODE:
-                    op = self.add_op(op_name)
-                    self.FILL_RLE_SIZE[op] = len(encoded)
-                    self.FILL_RLE_TEMPLATE_HELPER[op_name] = {
-                        "decoded": len(data),
-                        "encoded": len(encoded),
-                    }
-                    self.FILL_RLE_OP_CODES.append(op)
-
+                op_name = self.add_fill_rle_op(len(encoded), len(data))
                 anim_stream.append(self.NAME_TO_OP_CODE[op_name])
                 anim_stream.extend(encoded)
             else:
@@ -393,6 +567,251 @@ class Packer:
 
         return anim_stream
 
+    def diff_frames_within_budget(
+        self,
+        screen1: List[int],
+        screen2: List[int],
+        use_color: bool,
+        cycle_budget: int,
+        writing_color: bool = False,
+    ):
+        """
+        Like diff_frames, but keeps the estimated decode cycles within
+        cycle_budget. When the smallest encoding is too slow, the smallest one
+        that fits is used instead. If nothing fits, changed blocks are written
+        in screen order until the budget runs out and the rest is left for the
+        next frame.
+
+        Returns the changes, their estimated cycles, the screen as shown after
+        decoding and a description of the trade-off or None.
+        """
+        model = self.CYCLE_MODEL
+
+        def single_op(stream):
+            return stream, model.dispatched(
+                self.OP_CODES[stream[0]], stream[1:], writing_color
+            )
+
+        def block_fragments(use_rle):
+            fragments = []
+            for block_index, block in enumerate(self.ALL_BLOCKS):
+                if not self.is_block_same(screen1, screen2, block):
+                    fragment = [self.OP_SET_DEST_PTR, block_index]
+                    self.encode_block(screen2, block, fragment, use_rle)
+                    cycles = model.dispatched(
+                        "player_op_set_dest_ptr", fragment[1:2], writing_color
+                    ) + model.dispatched(
+                        self.OP_CODES[fragment[2]], fragment[3:], writing_color
+                    )
+                    fragments.append((block, fragment, cycles))
+            return fragments
+
+        def joined(fragments):
+            return (
+                [value for _, fragment, _ in fragments for value in fragment],
+                sum(cycles for _, _, cycles in fragments),
+            )
+
+        single_ops = (
+            self.OP_FULL_SCREEN_2x2_BLOCKS,
+            self.OP_FULL_SCREEN_RLE,
+            self.OP_PER_ROW_CHANGES,
+            self.OP_CLEAR,
+        )
+        blocks_possible = len(self.ALL_BLOCKS) <= PACKER_MAX_OP_CODES
+
+        smallest = self.diff_frames(screen1, screen2, use_color)
+        if not smallest:
+            return smallest, 0, screen2, None
+        if smallest[0] in single_ops:
+            smallest, smallest_cycles = single_op(smallest)
+        else:
+            smallest, smallest_cycles = joined(block_fragments(True))
+        if smallest_cycles <= cycle_budget:
+            return smallest, smallest_cycles, screen2, None
+
+        candidates = {}
+        if blocks_possible:
+            candidates["blocks without RLE"] = joined(block_fragments(False))
+        if not use_color:
+            candidates["2x2 blocks"] = single_op(
+                self.diff_frames_macro(screen1, screen2)
+            )
+        if len(set(screen2)) == 1:
+            candidates["clear"] = single_op([self.OP_CLEAR, screen2[0]])
+        if self.RLE_ENCODER_ENABLED:
+            candidates["full screen RLE"] = single_op(self.rle_full_screen(screen2))
+        candidates["per row changes"] = single_op(
+            self.diff_frames_per_row(screen1, screen2)
+        )
+
+        fitting = [
+            (len(stream), name, stream, cycles)
+            for name, (stream, cycles) in candidates.items()
+            if cycles <= cycle_budget
+        ]
+        if fitting:
+            _, name, stream, cycles = min(fitting)
+            return (
+                stream,
+                cycles,
+                screen2,
+                f"{name}, {len(stream)} bytes instead of {len(smallest)}, "
+                f"{cycles} cycles instead of {smallest_cycles}",
+            )
+
+        if not blocks_possible:
+            name, (stream, cycles) = min(
+                candidates.items(), key=lambda candidate: candidate[1][1]
+            )
+            return stream, cycles, screen2, f"{name}, still over budget"
+
+        fragments = block_fragments(False)
+        written = []
+        cycles = 0
+        for block, fragment, fragment_cycles in fragments:
+            if cycles + fragment_cycles <= cycle_budget:
+                written.append((block, fragment, fragment_cycles))
+                cycles += fragment_cycles
+
+        shown = list(screen1)
+        for block, _, _ in written:
+            for offset in self.offsets(block):
+                shown[offset] = screen2[offset]
+        stream, cycles = joined(written)
+        return (
+            stream,
+            cycles,
+            shown,
+            f"deferred {len(fragments) - len(written)} of {len(fragments)} "
+            f"changed blocks to next frame, {cycles} cycles",
+        )
+
+    def _diff_frame(
+        self,
+        screen1: List[int],
+        screen2: List[int],
+        use_color: bool,
+        cycles_left,
+        writing_color: bool,
+        description: str,
+        precomputed=None,
+        finish: bool = False,
+    ):
+        """
+        diff_frames, or diff_frames_within_budget when a budget is set.
+        Precomputed changes come from diff_frames_parallel. With finish no
+        blocks are deferred, even when the frame goes over budget.
+        """
+        if precomputed is not None:
+            return precomputed, screen2, 0
+        self.HISTORY_LOOKUP = self.HISTORY_LOOKUPS[1 if writing_color else 0]
+        if cycles_left is None:
+            return self.diff_frames(screen1, screen2, use_color), screen2, 0
+
+        changes, cycles, shown, tradeoff = self.diff_frames_within_budget(
+            screen1, screen2, use_color, cycles_left, writing_color
+        )
+        if finish and shown != screen2:
+            changes = self.diff_frames(screen1, screen2, use_color)
+            shown = screen2
+            cycles = cycles_left
+            tradeoff = "wrote all changed blocks over budget to complete the frame before the loop"
+        if tradeoff:
+            self.CYCLE_TRADEOFFS.append(f"{description}: {tradeoff}")
+        return changes, shown, cycles
+
+    def changed_blocks(
+        self,
+        prev_screen: List[int],
+        screen: List[int],
+        prev_color: List[int],
+        color: List[int],
+        use_color: bool,
+    ):
+        """Blocks and macro blocks that differ between two frames"""
+        blocks = set()
+        macro_blocks = set()
+        for macro_block in self.get_macro_blocks():
+            for block in self.get_blocks(macro_block):
+                if not self.is_block_same(prev_screen, screen, block) or (
+                    use_color and not self.is_block_same(prev_color, color, block)
+                ):
+                    blocks.add(block)
+                    macro_blocks.add(macro_block)
+        return blocks, macro_blocks
+
+    def diff_frame_layers(
+        self,
+        prev_screen: List[int],
+        screen: List[int],
+        prev_color: List[int],
+        color: List[int],
+        use_color: bool,
+    ):
+        """Screen and color changes of one frame, None for layers not written"""
+        screen_changes = None
+        if not self.USE_ONLY_COLOR:
+            screen_changes = self.diff_frames(prev_screen, screen, use_color)
+        color_changes = None
+        if use_color:
+            color_changes = self.diff_frames(prev_color, color, use_color)
+        return screen_changes, color_changes
+
+    def diff_frames_parallel(self, frame_pairs, use_color: bool):
+        """
+        diff_frame_layers for every (previous screen, screen, previous color,
+        color) across a process pool, None when there are too few frames.
+        Changed blocks are collected to USED_BLOCKS on the way. RLE fill ops
+        added by the workers are merged in frame order and chunks whose op
+        codes differ from the merged table are encoded again, so the result
+        is the same as encoding the frames in order.
+        """
+        workers = self.PACK_WORKERS or os.cpu_count() or 1
+        workers = min(workers, len(frame_pairs) // MIN_FRAMES_PER_PACK_WORKER)
+        if workers <= 1:
+            return None
+
+        chunk_size = -(-len(frame_pairs) // workers)
+        chunks = [
+            frame_pairs[start : start + chunk_size]
+            for start in range(0, len(frame_pairs), chunk_size)
+        ]
+        logger.debug(f"Encoding {len(frame_pairs)} frames with {workers} workers")
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(
+                _diff_frame_chunk, [(self, chunk, use_color) for chunk in chunks]
+            )
+
+            # Workers number their new ops from the same free op code
+            first_free_op = self.player_next_free_op
+            redo = []
+            for chunk_idx, (_, added, rle_counts, used) in enumerate(results):
+                self.USED_BLOCKS |= used[0]
+                self.USED_MACRO_BLOCKS |= used[1]
+                for count, uses in rle_counts.items():
+                    self.USED_RLE_COUNTS[count] = (
+                        self.USED_RLE_COUNTS.get(count, 0) + uses
+                    )
+                codes_match = True
+                for variant_idx, variant in enumerate(added):
+                    op_name = self.add_fill_rle_op(*variant)
+                    if self.NAME_TO_OP_CODE[op_name] != first_free_op + variant_idx:
+                        codes_match = False
+                if not codes_match:
+                    redo.append(chunk_idx)
+
+            if redo:
+                logger.debug(f"Encoding {len(redo)} chunks again with merged op codes")
+                redone = pool.map(
+                    _diff_frame_chunk,
+                    [(self, chunks[chunk_idx], use_color) for chunk_idx in redo],
+                )
+                for chunk_idx, result in zip(redo, redone):
+                    results[chunk_idx] = result
+
+        return [diff for result in results for diff in result[0]]
+
     def pack(
         self,
         screens: List[PetsciiScreen],
@@ -403,38 +822,77 @@ class Packer:
         anim_stream = []
         prev_charset = -1
 
-        prev_border = 0
+        # Border of the first frame is always set, packed streams then have
+        # border ops at the same places for any border color
+        prev_border = None
         prev_background = 0
 
         self.OPS_USED = set()
         self.USED_BLOCKS = set()
         self.USED_MACRO_BLOCKS = set()
 
-        for idx, screen in enumerate(screens):
-            for macro_block in self.get_macro_blocks():
-                for block in self.get_blocks(macro_block):
-                    screen1 = [0] * MAX_SCREEN_OFFSET
-                    if idx > 0:
-                        screen1 = screens[idx - 1].screen_codes
-
-                    screen2 = screen.screen_codes
-                    if not self.is_block_same(screen1, screen2, block):
-                        self.USED_BLOCKS.add(block)
-                        self.USED_MACRO_BLOCKS.add(macro_block)
-
-                    if use_color:
-                        screen1 = [0] * MAX_SCREEN_OFFSET
-                        if idx > 0:
-                            screen1 = screens[idx - 1].color_data
-
-                        screen2 = screen.color_data
-                        if not self.is_block_same(screen1, screen2, block):
-                            self.USED_BLOCKS.add(block)
-                            self.USED_MACRO_BLOCKS.add(macro_block)
-
-        current_anim_frame_slowdown_idx = 0
+        screen_order = list(range(len(screens)))
+        self.LOOP_FRAME = 0
+        if self.LOOP_CLOSURE and len(screens) > 1:
+            # First frame is decoded once as an intro, the loop ends with the
+            # first frame again diffed against the last one and restarts
+            # from the second frame
+            screen_order.append(0)
+            self.LOOP_FRAME = 1
+
+        # (previous screen, screen, previous color, color) of every frame
+        empty = [0] * MAX_SCREEN_OFFSET
+        prev_screens = [None, *(screens[idx] for idx in screen_order[:-1])]
+        frame_pairs = [
+            (
+                prev.screen_codes if prev else empty,
+                screens[idx].screen_codes,
+                prev.color_data if prev else empty,
+                screens[idx].color_data,
+            )
+            for prev, idx in zip(prev_screens, screen_order)
+        ]
 
-        for idx, screen in enumerate(screens):
+        frame_diffs = None
+        if self.CYCLE_BUDGET is None and self.HISTORY_SLOTS == 0:
+            # Without deferred updates or history every frame is the diff of
+            # two input frames, frames can be encoded in any order
+            frame_diffs = self.diff_frames_parallel(frame_pairs, use_color)
+        if frame_diffs is None:
+            for frame_pair in frame_pairs:
+                blocks, macro_blocks = self.changed_blocks(*frame_pair, use_color)
+                self.USED_BLOCKS |= blocks
+                self.USED_MACRO_BLOCKS |= macro_blocks
+
+        self.CYCLE_TRADEOFFS = []
+
+        # Screens as they will be shown, deferred updates make these differ
+        # from the input screens when decoding is limited by a cycle budget
+        shown_screens = []
+        shown_colors = []
+        shown_screen = [0] * MAX_SCREEN_OFFSET
+        shown_color = [0] * MAX_SCREEN_OFFSET
+
+        # Frames saved by the player as (slot, (screen, color)), oldest first
+        history = []
+        history_saves = set()
+        if self.HISTORY_SLOTS > 0:
+            history_saves = self.plan_history_saves(screens, use_color)
+            if self.LOOP_FRAME > 0:
+                # Frames saved in the intro are not there on later loops
+                history_saves.discard(0)
+        self.HISTORY_LOOKUPS = ({}, {})
+
+        # Deferred blocks must be written before the player restarts, and
+        # with loop closure before the loop frame, which is diffed against
+        # the intro frame
+        finished_frames = {len(screen_order) - 1, self.LOOP_FRAME - 1}
+
+        for frame_idx, idx in enumerate(screen_order):
+            screen = screens[idx]
+            frame_start = len(anim_stream)
+            if frame_idx == self.LOOP_FRAME:
+                self.LOOP_OFFSET = frame_start
             if screen.border_color is not None and prev_border != screen.border_color:
                 anim_stream.append(self.OP_SET_BORDER)
                 anim_stream.append(screen.border_color)
@@ -459,20 +917,65 @@ class Packer:
                     anim_stream.append(current_charset)
                     prev_charset = current_charset
 
+            save_op = None
+            if frame_idx in history_saves:
+                # Saves go round the ring, replacing the oldest frame
+                slot = sum(1 for saved in history_saves if saved < frame_idx)
+                save_op = self.SAVE_HISTORY_OP_CODES[slot % self.HISTORY_SLOTS]
+
+            cycles_left = None
+            if self.CYCLE_BUDGET is not None:
+                # Ops written so far in this frame all have one operand, loop
+                # frame is decoded after the restart op when looping
+                leading_ops = [self.OP_CODES[op] for op in anim_stream[frame_start::2]]
+                if frame_idx == self.LOOP_FRAME:
+                    leading_ops.append(self.OP_CODES[self.OP_RESTART])
+                cycles_left = self.CYCLE_BUDGET - self.CYCLE_MODEL.fixed_frame_cycles(
+                    leading_ops, len(self.ANIM_SLOWDOWN_TABLE) > 0
+                )
+                if save_op is not None:
+                    # The save is written after the changes but paid up front
+                    save_cycles = self.CYCLE_MODEL.dispatched(
+                        self.OP_CODES[save_op], []
+                    )
+                    if save_cycles <= cycles_left:
+                        cycles_left -= save_cycles
+                    else:
+                        self.CYCLE_TRADEOFFS.append(
+                            f"frame {idx}: history save of {save_cycles} cycles "
+                            f"dropped, {cycles_left} cycles left"
+                        )
+                        history_saves.discard(frame_idx)
+                        save_op = None
+
             if not self.USE_ONLY_COLOR:
-                prev_petscii = [0] * MAX_SCREEN_OFFSET
-                if idx > 0:
-                    prev_petscii = screens[idx - 1].screen_codes
-                changes = self.diff_frames(prev_petscii, screen.screen_codes, use_color)
+                changes, shown_screen, cycles = self._diff_frame(
+                    shown_screen,
+                    screen.screen_codes,
+                    use_color,
+                    cycles_left,
+                    False,
+                    f"frame {idx} screen",
+                    frame_diffs[frame_idx][0] if frame_diffs else None,
+                    frame_idx in finished_frames,
+                )
                 anim_stream.extend(changes)
+                if cycles_left is not None:
+                    cycles_left -= cycles
+            shown_screens.append(shown_screen)
 
             if use_color:
                 anim_stream.append(self.OP_SET_COLOR_MODE)
-                prev_color = [0] * MAX_SCREEN_OFFSET
-                if idx > 0:
-                    prev_color = screens[idx - 1].color_data
-
-                changes = self.diff_frames(prev_color, screen.color_data, use_color)
+                changes, shown_color, _ = self._diff_frame(
+                    shown_color,
+                    screen.color_data,
+                    use_color,
+                    cycles_left,
+                    True,
+                    f"frame {idx} color",
+                    frame_diffs[frame_idx][1] if frame_diffs else None,
+                    frame_idx in finished_frames,
+                )
                 anim_stream.extend(changes)
 
                 anim_stream.append(self.OP_SET_SCREEN_MODE)
@@ -483,46 +986,85 @@ class Packer:
                     )
                     anim_stream.append(self.OP_CLEAR_COLOR)
                     anim_stream.append(screen.color_data[0])
+            shown_colors.append(shown_color)
+
+            if save_op is not None:
+                slot = self.SAVE_HISTORY_OP_CODES.index(save_op)
+                anim_stream.append(save_op)
+                history = [entry for entry in history if entry[0] != slot]
+                history.append((slot, (list(shown_screen), list(shown_color))))
+                self.HISTORY_LOOKUPS = (
+                    self.history_lookup(history, 0),
+                    self.history_lookup(history, 1),
+                )
 
             if len(self.ANIM_SLOWDOWN_TABLE) > 0:
-                slowdown = self.ANIM_SLOWDOWN_TABLE[current_anim_frame_slowdown_idx]
+                slowdown = self.ANIM_SLOWDOWN_TABLE[idx % len(self.ANIM_SLOWDOWN_TABLE)]
                 anim_stream.append(self.OP_SET_ANIM_SLOWDOWN)
                 anim_stream.append(slowdown)
 
-                current_anim_frame_slowdown_idx += 1
-                if current_anim_frame_slowdown_idx == len(self.ANIM_SLOWDOWN_TABLE):
-                    current_anim_frame_slowdown_idx = 0
-
             anim_stream.append(self.OP_FRAME_END)
 
         anim_stream.append(self.OP_RESTART)
-        self.OPS_USED.add(self.OP_CODES[self.OP_RESTART])
+        with span("unpack validation"):
+            self.validate(anim_stream, shown_screens, shown_colors, use_color)
+
+        return anim_stream
+
+    def unpack_frames(self, anim_stream: List[int], frame_count: int):
+        """Screen and color memory after each of the first frame_count frames"""
+        screens = []
+        colors = []
+        self.UNPACK_HISTORY = {}
+        offset = 0
+        screen = [0] * MAX_SCREEN_OFFSET
+        color = [0] * MAX_SCREEN_OFFSET
+        for _ in range(frame_count):
+            # unpack writes into the given lists, keep every frame separate
+            screen, color, offset = self.unpack(
+                anim_stream, offset, list(screen), list(color)
+            )
+            screens.append(screen)
+            colors.append(color)
+        return screens, colors
+
+    def validate(
+        self,
+        anim_stream: List[int],
+        expected_screens: List[List[int]],
+        expected_colors: List[List[int]],
+        use_color=False,
+    ):
+        """
+        Unpacks every frame and compares it to the expected screen and color
+        data, raises PackerError on mismatch. Also collects the ops used by the stream.
+        """
+        self.OPS_USED = {self.OP_CODES[self.OP_RESTART]}
+        self.UNPACK_HISTORY = {}
 
         offset = 0
         screen = [0] * MAX_SCREEN_OFFSET
         color = [0] * MAX_SCREEN_OFFSET
-        for idx in range(len(screens)):
+        for idx in range(len(expected_screens)):
             screen, color, offset = self.unpack(anim_stream, offset, screen, color)
 
-            if not self.USE_ONLY_COLOR and screen != screens[idx].screen_codes:
+            if not self.USE_ONLY_COLOR and screen != expected_screens[idx]:
                 logger.error("ERROR: Packer & unpacker dont work together!!!")
                 logger.error(f"SCREEN DATA IS BROKEN AT FRAME {idx}")
                 logger.error("unpacked:")
                 self.print_list(screen)
                 logger.error("expected:")
-                self.print_list(screens[idx].screen_codes)
-                sys.exit(1)
+                self.print_list(expected_screens[idx])
+                raise PackerError(f"Packed screen data is broken at frame {idx}")
 
-            if use_color and color != screens[idx].color_data:
+            if use_color and color != expected_colors[idx]:
                 logger.error("ERROR: Packer & unpacker dont work together!!!")
                 logger.error(f"COLOR DATA IS BROKEN AT FRAME {idx}")
                 logger.error("unpacked:")
                 self.print_list(color)
                 logger.error("expected:")
-                self.print_list(screens[idx].color_data)
-                sys.exit(1)
-
-        return anim_stream
+                self.print_list(expected_colors[idx])
+                raise PackerError(f"Packed color data is broken at frame {idx}")
 
     @staticmethod
     def print_list(ints, group_size=SCREEN_WIDTH):
@@ -551,7 +1093,7 @@ class Packer:
             return b
 
         def process_state_machine():
-            nonlocal offset, screen, color, block_ptr, writing_screen
+            nonlocal offset, screen, color, block_ptr, dest_block_idx, writing_screen
 
             op_code = read_next_byte()
             # if self.OP_CODES[op_code] not in self.OPS_USED:
@@ -578,8 +1120,12 @@ class Packer:
                 return False
 
             elif op_code == self.OP_SET_DEST_PTR:
-                block_idx = read_next_byte()
-                block_ptr = self.ALL_BLOCKS[block_idx]
+                dest_block_idx = read_next_byte()
+                block_ptr = self.ALL_BLOCKS[dest_block_idx]
+
+            elif op_code == self.OP_NEXT_BLOCK:
+                dest_block_idx += 1
+                block_ptr = self.ALL_BLOCKS[dest_block_idx]
 
             elif op_code == self.OP_SET_ANIM_SLOWDOWN:
                 read_next_byte()  # next byte is slowdown frame count, not used in this validation function
@@ -602,6 +1148,29 @@ class Packer:
                     else:
                         color[screen_offset] = read_next_byte()
 
+            elif op_code in self.SAVE_HISTORY_OP_CODES:
+                slot = self.SAVE_HISTORY_OP_CODES.index(op_code)
+                self.UNPACK_HISTORY[slot] = (list(screen), list(color))
+
+            elif op_code in self.COPY_HISTORY_SIZE:
+                saved_screen, saved_color = self.UNPACK_HISTORY[read_next_byte()]
+                saved = saved_screen if writing_screen else saved_color
+                for screen_offset in self.offsets(block_ptr):
+                    if writing_screen:
+                        screen[screen_offset] = saved[screen_offset]
+                    else:
+                        color[screen_offset] = saved[screen_offset]
+
+            elif op_code in self.FILL_DICT_SIZE:
+                entry = self.BLOCK_DICTIONARY[self.FILL_DICT_SIZE[op_code]][
+                    read_next_byte()
+                ]
+                for idx, screen_offset in enumerate(self.offsets(block_ptr)):
+                    if writing_screen:
+                        screen[screen_offset] = entry[idx]
+                    else:
+                        color[screen_offset] = entry[idx]
+
             elif op_code in self.FILL_SAME_VALUE_OP_CODES:
                 value = read_next_byte()
                 for screen_offset in self.offsets(block_ptr):
@@ -683,6 +1252,7 @@ class Packer:
             return False  # Continue the main loop
 
         block_ptr = None
+        dest_block_idx = None
         writing_screen = True
 
         while True:
@@ -715,6 +1285,20 @@ class Packer:
         else:
             return 0
 
+    def template_dir(self) -> str:
+        if self.OVERRIDE_TEMPLATE_DIR:
+            return os.path.abspath(self.OVERRIDE_TEMPLATE_DIR)
+        return utils.get_resource_path(os.path.join("src", "resources", "test-program"))
+
+    def find_test_music(self) -> Optional[str]:
+        """Music file of the test program, from the template folder or as given"""
+        template_music = os.path.join(self.template_dir(), self.MUSIC_FILE_NAME)
+        if os.path.exists(template_music):
+            return template_music
+        if os.path.exists(self.MUSIC_FILE_NAME):
+            return self.MUSIC_FILE_NAME
+        return None
+
     def write_player(
         self,
         screens: List[PetsciiScreen],
@@ -724,11 +1308,29 @@ class Packer:
         use_color: bool = False,
         optimize_player: bool = True,
     ):
-        template_dir = utils.get_resource_path(
-            os.path.join("src", "resources", "test-program")
-        )
+        with span("render templates"):
+            sources = self.render_player(
+                screens, charsets, anim_slowdown_frames, use_color, optimize_player
+            )
+        for file_name, source in sources.items():
+            with open(os.path.join(output_folder, file_name), "w") as fp:
+                fp.write(source)
+
+        test_music = self.find_test_music()
+        if test_music:
+            utils.copy_file(test_music, f"{output_folder}")
+
+    def render_player(
+        self,
+        screens: List[PetsciiScreen],
+        charsets: List[List[PetsciiChar]],
+        anim_slowdown_frames: int,
+        use_color: bool = False,
+        optimize_player: bool = True,
+    ) -> Dict[str, str]:
+        """Player, test program and fill color sources by file name"""
+        template_dir = self.template_dir()
         if self.OVERRIDE_TEMPLATE_DIR:
-            template_dir = os.path.abspath(self.OVERRIDE_TEMPLATE_DIR)
             logger.success(f"Reading templates and data from {template_dir}")
 
         macro_blocks = self.get_macro_blocks()
@@ -750,13 +1352,9 @@ class Packer:
             f"Animation has {len(self.USED_BLOCKS)} used blocks out of {len(self.ALL_BLOCKS)}"
         )
 
-        test_music = None
+        test_music = self.find_test_music()
         test_music_filename = None
-        if os.path.exists(os.path.join(template_dir, self.MUSIC_FILE_NAME)):
-            test_music = os.path.join(template_dir, self.MUSIC_FILE_NAME)
-        elif os.path.exists(self.MUSIC_FILE_NAME):
-            test_music = self.MUSIC_FILE_NAME
-        else:
+        if test_music is None:
             logger.warning(
                 f"WARNING: Unable to find music data file {self.MUSIC_FILE_NAME}"
             )
@@ -838,6 +1436,11 @@ class Packer:
             "used_blocks": self.USED_BLOCKS,
             "remove_unused_blocks": optimize_player,
             "FILL_RLE_TEMPLATE_HELPER": self.FILL_RLE_TEMPLATE_HELPER,
+            "block_dictionary": self.BLOCK_DICTIONARY,
+            "history_slots": self.HISTORY_SLOTS,
+            "history_location": self.HISTORY_LOCATION,
+            "loop_offset": self.LOOP_OFFSET,
+            "loop_closure": self.LOOP_FRAME > 0,
             "PLAYER_RLE_END_MARKER": RLE_END_MARKER,
             "TEST_SLOWDOWN": anim_slowdown_frames,
             "test_music": test_music_filename,
@@ -858,20 +1461,14 @@ class Packer:
             "color_aberration_scroll": self.COLOR_ABERRATION_SCROLL,
         }
 
-        env = Environment(
-            loader=FileSystemLoader(template_dir), trim_blocks=True, lstrip_blocks=True
-        )
+        env = template_environment(template_dir)
         test_code_template = env.get_template(self.PLAYER_TEST_HARNESS_TEMPLATE)
         player_template = env.get_template("player.asm")
 
-        player_file = f"{output_folder}/player.asm"
-        player = player_template.render(namespace)
-        with open(player_file, "w") as fp:
-            fp.write(player)
-
-        output = test_code_template.render(namespace)
-        with open(f"{output_folder}/{self.PRG_FILE_NAME}.asm", "w") as f:
-            f.write(output)
+        sources = {
+            "player.asm": player_template.render(namespace),
+            f"{self.PRG_FILE_NAME}.asm": test_code_template.render(namespace),
+        }
 
         if self.FILL_COLOR_WITH_EFFECT:
             fill_color_blocks = [
@@ -893,9 +1490,6 @@ class Packer:
                 "fill_color_palette": self.FILL_COLOR_PALETTE,
             }
 
-            fill_color_file = f"{output_folder}/fill_color.asm"
-            with open(fill_color_file, "w") as fp:
-                fp.write(template.render(namespace))
+            sources["fill_color.asm"] = template.render(namespace)
 
-        if test_music:
-            utils.copy_file(test_music, f"{output_folder}")
+        return sources
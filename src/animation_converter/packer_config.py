@@ -1,3 +1,4 @@
+import cycle_model
 import petscii
 import utils
 from utils import locations_with_same_color
@@ -66,3 +67,20 @@ def set_packer_options(anim_change_index, output_file_name, packer_to_setup, arg
             packer_to_setup.COLOR_ABERRATION_SCROLL = utils.read_color_palette(
                 args.color_aberration_scroll
             )
+    if args.pack_workers:
+        packer_to_setup.PACK_WORKERS = args.pack_workers
+    if args.history_slots:
+        packer_to_setup.set_history_slots(
+            args.history_slots,
+            parse_address(args.history_location),
+        )
+    if args.loop_closure:
+        packer_to_setup.LOOP_CLOSURE = True
+    if args.cycle_budget_encoding:
+        # Estimates can run low by the margin, keep it free
+        packer_to_setup.CYCLE_BUDGET = (
+            args.cycle_budget or cycle_model.DEFAULT_CYCLE_BUDGET
+        ) - cycle_model.MODEL_ERROR_MARGIN
+        packer_to_setup.CYCLE_MODEL = cycle_model.CycleModel.for_packer(
+            packer_to_setup, args.use_color
+        )
@@ -0,0 +1,118 @@
+"""
+Peephole pass over the animation stream written by Packer.pack.
+
+Packer.pack writes every frame on its own: color and screen mode switches and
+slowdown ops are added to every frame and every changed block gets its own
+destination pointer. This pass walks the finished stream one frame at a time
+and drops or shortens the ops that do not change player state. The result is
+validated against the original stream through Packer.unpack.
+"""
+
+from typing import Dict, List, Tuple
+
+from anim_decoder import AnimDecoder
+from logger import get_logger
+from packer import Packer
+
+logger = get_logger()
+
+RULE_EMPTY_COLOR_SECTION = "empty color section"
+RULE_SCREEN_MODE_AT_FRAME_END = "screen mode at frame end"
+RULE_REPEATED_SLOWDOWN = "repeated slowdown"
+RULE_NEXT_BLOCK = "consecutive blocks"
+RULES = (
+    RULE_EMPTY_COLOR_SECTION,
+    RULE_SCREEN_MODE_AT_FRAME_END,
+    RULE_REPEATED_SLOWDOWN,
+    RULE_NEXT_BLOCK,
+)
+
+
+def _optimize_frame(
+    packer: Packer, frame: List[List[int]], saved: Dict[str, int], slowdown
+):
+    """
+    Rewrite the ops of one frame in place, each op is a list of op code and
+    operands. Returns the slowdown in effect after the frame.
+    """
+    # Packer.unpack starts every frame without a destination block
+    prev_block = None
+    for idx, op in enumerate(frame):
+        if op[0] == packer.OP_SET_ANIM_SLOWDOWN:
+            if op[1] == slowdown:
+                frame[idx] = []
+                saved[RULE_REPEATED_SLOWDOWN] += 2
+            slowdown = op[1]
+        elif op[0] == packer.OP_SET_DEST_PTR:
+            block = op[1]
+            if prev_block is not None and block == prev_block + 1:
+                frame[idx] = [packer.OP_NEXT_BLOCK]
+                saved[RULE_NEXT_BLOCK] += 1
+            prev_block = block
+
+    frame[:] = [op for op in frame if op]
+
+    idx = 0
+    while idx < len(frame) - 1:
+        if (
+            frame[idx][0] == packer.OP_SET_COLOR_MODE
+            and frame[idx + 1][0] == packer.OP_SET_SCREEN_MODE
+        ):
+            del frame[idx : idx + 2]
+            saved[RULE_EMPTY_COLOR_SECTION] += 2
+        else:
+            idx += 1
+
+    # Player starts every frame in screen mode, switching back to it is not
+    # needed when only the slowdown op follows
+    if frame and frame[-1][0] == packer.OP_FRAME_END:
+        idx = len(frame) - 1
+        while idx > 0 and frame[idx - 1][0] == packer.OP_SET_ANIM_SLOWDOWN:
+            idx -= 1
+        if idx > 0 and frame[idx - 1][0] == packer.OP_SET_SCREEN_MODE:
+            del frame[idx - 1]
+            saved[RULE_SCREEN_MODE_AT_FRAME_END] += 1
+
+    return slowdown
+
+
+def optimize_stream(
+    packer: Packer, anim_stream: List[int], use_color: bool = False
+) -> Tuple[List[int], Dict[str, int]]:
+    """
+    Remove redundant ops from anim_stream, returns the new stream and bytes
+    saved by each rule. Raises PackerError like Packer.pack when validation
+    fails.
+    """
+    decoder = AnimDecoder.for_packer(packer)
+    stream = bytes(anim_stream)
+    frames = [
+        [list(stream[op.start : op.end]) for op in ops]
+        for ops in decoder.iter_ops(stream)
+    ]
+
+    saved = dict.fromkeys(RULES, 0)
+    # Slowdown persists over restart, first frame always sets its own
+    slowdown = None
+    for frame in frames:
+        slowdown = _optimize_frame(packer, frame, saved, slowdown)
+
+    optimized = [value for frame in frames for op in frame for value in op]
+    packer.LOOP_OFFSET = sum(
+        len(op) for frame in frames[: packer.LOOP_FRAME] for op in frame
+    )
+    optimized.append(packer.OP_RESTART)
+
+    expected_screens, expected_colors = packer.unpack_frames(anim_stream, len(frames))
+    packer.validate(optimized, expected_screens, expected_colors, use_color)
+    return optimized, saved
+
+
+def report_savings(saved: Dict[str, int], original_size: int, optimized_size: int):
+    logger.info(
+        f"Peephole pass saved {original_size - optimized_size} bytes, "
+        f"{original_size} -> {optimized_size}"
+    )
+    for rule, count in saved.items():
+        if count:
+            logger.info(f"Peephole rule {rule}: {count} bytes")
@@ -1,19 +1,24 @@
+from array import array
+import glob
+import hashlib
 from io import StringIO
 import json
+import multiprocessing
 import os
 import re
-import sys
-from typing import List, Tuple
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 
 from bitarray import bitarray
 from logger import get_logger
 from PIL import Image, ImageDraw, ImageSequence
+from pipeline_context import current_context
+from screen_renderer import render_screen, render_screens
+from tracing import span
 from utils import (
     create_folder_if_not_exists,
     get_resource_path,
-    rgb_to_idx,
+    image_to_vic_indices,
     save_images_as_gif,
-    vicPalette,
     write_bin,
 )
 
@@ -26,6 +31,9 @@ REDUCTION_RATIO_SMALL = 1.5
 REDUCTION_RATIO_MEDIUM = 3.0
 MAX_SCREEN_OFFSET = 1000
 MAX_SEED_CHARSET_SIZE = 31
+MIN_FRAMES_FOR_PARALLEL_DECODE = 4
+# Cellified frames kept by a frame memo, see PipelineContext.frame_memo
+MAX_FRAME_MEMO = 4096
 
 
 class CharUseLocation:
@@ -53,11 +61,6 @@ class CharUseLocation:
 _HAMMING_LOOKUP = None
 _HAMMING_LOOKUP_INITIALIZED = False
 
-# Character distance cache - speeds up charset compression by 3-5x
-# Key: (char1_bytes, char2_bytes) - symmetric
-# Value: distance (int)
-_CHAR_DISTANCE_CACHE = {}
-
 
 def init_hamming_lookup():
     """
@@ -150,7 +153,10 @@ def char_distance_simple(char1_data: bytes, char2_data: bytes) -> int:
 
 
 def char_hamming_distance(char1, char2):
-    """Cached character distance calculation - 3-5x faster than uncached"""
+    """
+    Cached character distance calculation - 3-5x faster than uncached. The
+    cache belongs to the current pipeline context.
+    """
     data1 = char1.data.tobytes()
     data2 = char2.data.tobytes()
 
@@ -158,20 +164,19 @@ def char_hamming_distance(char1, char2):
     cache_key = (data1, data2) if data1 < data2 else (data2, data1)
 
     # Check cache
-    if cache_key in _CHAR_DISTANCE_CACHE:
-        return _CHAR_DISTANCE_CACHE[cache_key]
+    cache = current_context().char_distance_cache
+    if cache_key in cache:
+        return cache[cache_key]
 
     # Calculate and cache
     distance = char_distance_simple(data1, data2)
-    _CHAR_DISTANCE_CACHE[cache_key] = distance
+    cache[cache_key] = distance
     return distance
 
 
 class PetsciiChar:
     BLANK_DATA = bitarray("0" * 64)  # 8x8 = 64 bits, blank character
     FULL_DATA = bitarray("1" * 64)  # Full 8x8 character (all bits set)
-    # Hack to support charset compression
-    GLOBAL_CHAR_EQUALITY_THRESHOLD_HACK = None
 
     def __init__(self, data=None):
         self.data = data if data is not None else bitarray("0" * 64)
@@ -194,17 +199,14 @@ class PetsciiChar:
         if self is other:
             return True
 
-        equal = self.data == other.data
+        if self.data == other.data:
+            return True
 
-        if PetsciiChar.GLOBAL_CHAR_EQUALITY_THRESHOLD_HACK is None:
-            return equal
-        else:
-            if not equal:
-                equal = (
-                    self.distance(other)
-                    <= PetsciiChar.GLOBAL_CHAR_EQUALITY_THRESHOLD_HACK
-                )
-            return equal
+        # Charset compression lets close enough characters compare equal
+        threshold = current_context().char_equality_threshold
+        if threshold is None:
+            return False
+        return self.distance(other) <= threshold
 
     def is_blank(self):
         if self._blank is None:
@@ -257,32 +259,29 @@ def find_closest_char(
     return closest_char, min_distance
 
 
+def charset_to_bytes(charset: List[PetsciiChar]) -> bytes:
+    return b"".join(char.data.tobytes() for char in charset)
+
+
 def write_charset(charset: List[PetsciiChar], file_name: str):
-    binary = []
-    for char in charset:
-        for b in char.data.tobytes():
-            binary.append(b)
-    write_bin(file_name, binary)
+    write_bin(file_name, list(charset_to_bytes(charset)))
 
 
-def read_charset(file_path, skipFirstBytes=False):
+def charset_from_bytes(data: bytes) -> List[PetsciiChar]:
+    """Characters of 8 bytes each, a trailing partial character is ignored"""
     petscii_chars = []
+    for pos in range(0, len(data) - 7, 8):
+        byte_data = bitarray()
+        byte_data.frombytes(data[pos : pos + 8])
+        petscii_chars.append(PetsciiChar(byte_data))
+    return petscii_chars
+
 
+def read_charset(file_path, skipFirstBytes=False):
     with open(file_path, "rb") as file:
         if skipFirstBytes:
             file.read(2)
-
-        while True:
-            char_data = file.read(8)
-            if len(char_data) < 8:  # noqa: PLR2004
-                break
-
-            byte_data = bitarray()
-            byte_data.frombytes(char_data)
-            char = PetsciiChar(byte_data)
-            petscii_chars.append(char)
-
-    return petscii_chars
+        return charset_from_bytes(file.read())
 
 
 def reduce_charset_smart(
@@ -381,18 +380,6 @@ def reduce_charset(charset: List[PetsciiChar], target_size: int) -> List[Petscii
         return reduce_charset_aggressive_sampling(charset, target_size)
 
 
-def get_rgb_from_palette(image, x, y):
-    index = image.getpixel((x, y))
-    return image.palette.palette[index * 3 : index * 3 + 3]
-
-
-def get_pixel_rgb(image, x, y):
-    if image.mode == "P":
-        return get_rgb_from_palette(image, x, y)
-    else:
-        return image.getpixel((x, y))
-
-
 class PetsciiScreen:
     def __init__(self, screen_index, background_color=None, border_color=None):
         self.screen_index = screen_index
@@ -413,6 +400,12 @@ class PetsciiScreen:
         else:
             self.charset = default_charset
 
+        color_indices = None
+        if self.background_color is not None:
+            # Quantize whole frame once, cells below pick their color from this
+            color_indices = image_to_vic_indices(image)
+            background = bytes([self.background_color])
+
         for y in range(0, height, 8):
             for x in range(0, width, 8):
                 row = y // 8
@@ -476,14 +469,15 @@ class PetsciiScreen:
                         self.color_data[offset] = 0
                     else:
                         foreground_color = None
-                        for cy in range(8):
-                            if foreground_color is not None:
+                        cell_width = min(8, width - x)
+                        for cy in range(min(8, height - y)):
+                            start = (y + cy) * width + x
+                            row_colors = color_indices[start : start + cell_width]
+                            # First non background pixel of the row, if any
+                            foreground = row_colors.lstrip(background)
+                            if foreground:
+                                foreground_color = foreground[0]
                                 break
-                            for cx in range(8):
-                                color = rgb_to_idx(get_pixel_rgb(image, x + cx, y + cy))
-                                if color != self.background_color:
-                                    foreground_color = color
-                                    break
                         if foreground_color is None:
                             foreground_color = self.background_color
                         self.color_data[offset] = foreground_color
@@ -511,9 +505,12 @@ class PetsciiScreen:
 
     def remap_characters(self, new_charset: List[PetsciiChar], allow_error=False):
         new_screen = []
+        indexes = _exact_char_indexes(new_charset)
         for code in self.screen_codes:
             char = self.charset[code]
-            if not allow_error:
+            if indexes is not None and char.data.tobytes() in indexes:
+                new_screen.append(indexes[char.data.tobytes()])
+            elif not allow_error:
                 new_index = new_charset.index(char)
                 new_screen.append(new_index)
             else:
@@ -528,34 +525,9 @@ class PetsciiScreen:
         self.charset = new_charset
 
     def render(self, char_size=8, border=0):
-        screen_width = 40 * char_size
-        screen_height = 25 * char_size
-        img = Image.new(
-            "RGB",
-            (screen_width + 2 * border, screen_height + 2 * border),
-            color=vicPalette[0],
-        )
-        for row in range(25):
-            for col in range(40):
-                offset = row * 40 + col
-                char_index = self.screen_codes[offset]
-                char = self.charset[char_index]
-                bg_color = vicPalette[0]  # Black background
-                fg_color = vicPalette[self.color_data[offset]]
-
-                char_img = char.render(char_size)
-                char_img = char_img.convert("1")
-
-                # Create colored version of the character
-                colored_char = Image.new("RGB", char_img.size, bg_color)
-                draw_char = ImageDraw.Draw(colored_char)
-                draw_char.bitmap((0, 0), char_img, fill=fg_color)
-
-                x = col * char_size + border
-                y = row * char_size + border
-                img.paste(colored_char, (x, y))
-
-        return img
+        return render_screen(
+            self.charset, self.screen_codes, self.color_data, char_size, border
+        ).convert("RGB")
 
     def charset_size(self):
         return len(self.charset)
@@ -583,10 +555,8 @@ class PetsciiScreen:
         return new_screen
 
 
-def save_debug_screens(screens, output_filename, duration=200, loop=0):
-    images = []
-    for screen in screens:
-        images.append(screen.render())
+def save_debug_screens(screens, output_filename, duration=200, loop=0, workers=None):
+    images = render_screens(screens, workers=workers)
     save_images_as_gif(images, output_filename, duration, loop)
 
 
@@ -692,11 +662,9 @@ def read_petmate(file_path: str) -> List[PetsciiScreen]:
             f"Frame {idx}, charset {charset_name}, backgroundColor {bg}, borderColor {border}"
         )
 
-        if charset_name in charsets:
-            charset = charsets[charset_name]
-        else:
-            logger.error(f"Cannot find custom charset with name {charset_name}")
-            sys.exit(1)
+        if charset_name not in charsets:
+            raise ValueError(f"Cannot find custom charset with name {charset_name}")
+        charset = charsets[charset_name]
 
         screen = PetsciiScreen(idx)
         screen.charset = [*charset]
@@ -827,6 +795,293 @@ def write_petmate(
     )
 
 
+class FrameData(NamedTuple):
+    """
+    Compact result of cellifying one frame, cheap to send between processes.
+
+    chars holds the 8 byte bitmaps of the frame local charset, or None when the
+    frame was matched against a default charset. cells holds the char index of
+    every 8x8 cell in the order PetsciiScreen.read visits them.
+    """
+
+    chars: Optional[List[bytes]]
+    cells: array
+    columns: int
+    rows: int
+    color_data: bytes
+
+    @staticmethod
+    def from_screen(screen: PetsciiScreen, image_size, own_charset: bool):
+        width, height = image_size
+        columns = (width + 7) // 8
+        rows = (height + 7) // 8
+        cells = array("H", [0] * (columns * rows))
+        for char_index, char in enumerate(screen.charset):
+            for use in char.usage:
+                if use.screen_index == screen.screen_index:
+                    cells[use.row * columns + use.col] = char_index
+        chars = (
+            [char.data.tobytes() for char in screen.charset] if own_charset else None
+        )
+        return FrameData(chars, cells, columns, rows, bytes(screen.color_data))
+
+    def to_screen(
+        self,
+        screen_index,
+        default_charset=None,
+        background_color=None,
+        border_color=None,
+    ) -> PetsciiScreen:
+        screen = PetsciiScreen(screen_index, background_color, border_color)
+        if self.chars is None:
+            screen.charset = default_charset
+        else:
+            screen.charset = []
+            for char_bytes in self.chars:
+                char_data = bitarray()
+                char_data.frombytes(char_bytes)
+                screen.charset.append(PetsciiChar(char_data))
+
+        for row in range(self.rows):
+            for col in range(self.columns):
+                char_index = self.cells[row * self.columns + col]
+                screen.charset[char_index].add_usage(screen_index, row, col)
+                offset = row * 40 + col
+                if offset < MAX_SCREEN_OFFSET:
+                    screen.screen_codes[offset] = char_index
+        screen.color_data = list(self.color_data)
+        return screen
+
+
+def is_screen_file(filename) -> bool:
+    """PETSCII .c and .petmate files hold screens, other inputs are images"""
+    return filename.endswith((".c", ".petmate"))
+
+
+def _frame_number_key(path):
+    parts = re.split(r"(\d+)", os.path.basename(path))
+    return [int(part) if part.isdigit() else part.lower() for part in parts]
+
+
+def find_frame_sequence(path: str) -> Optional[List[str]]:
+    """
+    Resolve a directory or glob pattern to numbered PNG frames in frame order.
+
+    Returns None when path is a single input file.
+    """
+    if os.path.isdir(path):
+        files = glob.glob(os.path.join(path, "*.png"))
+    elif glob.has_magic(path):
+        files = glob.glob(path)
+    else:
+        return None
+    return sorted(files, key=_frame_number_key)
+
+
+# Per worker process state for parallel decoding, set by _init_decode_worker
+_DECODE_WORKER_OPTIONS = None
+
+
+def _init_decode_worker(charset_bytes, background_color, inverse, cleanup):
+    global _DECODE_WORKER_OPTIONS
+    _DECODE_WORKER_OPTIONS = _decode_options(
+        charset_bytes, background_color, inverse, cleanup
+    )
+
+
+def _decode_options(charset_bytes, background_color, inverse, cleanup):
+    charset = None
+    if charset_bytes is not None:
+        charset = []
+        for char_bytes in charset_bytes:
+            char_data = bitarray()
+            char_data.frombytes(char_bytes)
+            charset.append(PetsciiChar(char_data))
+    return charset, background_color, inverse, cleanup
+
+
+def _decode_frame_file(job, options=None) -> FrameData:
+    screen_index, path = job
+    charset, background_color, inverse, cleanup = options or _DECODE_WORKER_OPTIONS
+    with Image.open(path) as img:
+        screen = PetsciiScreen(screen_index, background_color)
+        screen.read(img, charset, inverse, cleanup)
+        frame = FrameData.from_screen(screen, img.size, charset is None)
+
+    if charset is not None:
+        # Usage is rebuilt on the caller side, dont let it pile up between frames
+        for char in charset:
+            char.usage.clear()
+            char.used_in_screen.clear()
+    return frame
+
+
+def _frame_memo_options(charset_bytes, background_color, inverse, cleanup):
+    charset_hash = None
+    if charset_bytes is not None:
+        charset_hash = hashlib.sha1(b"".join(charset_bytes)).digest()
+    return (charset_hash, background_color, inverse, cleanup)
+
+
+def _frame_memo_get(key) -> Optional[FrameData]:
+    memo = current_context().frame_memo
+    if memo is None or key not in memo:
+        return None
+    memo.move_to_end(key)
+    return memo[key]
+
+
+def _frame_memo_put(key, frame: FrameData):
+    """Remember a cellified frame while the context keeps a frame memo"""
+    memo = current_context().frame_memo
+    if memo is None or key is None:
+        return
+    memo[key] = frame
+    while len(memo) > MAX_FRAME_MEMO:
+        memo.popitem(last=False)
+
+
+def decode_frame_sequence(
+    files: List[str],
+    charset=None,
+    background_color=None,
+    inverse=False,
+    cleanup=1,
+    workers=None,
+) -> List[FrameData]:
+    """
+    Decode numbered PNG frames, one frame per file, across a process pool.
+
+    Workers return compact FrameData in frame order, frames_to_screens
+    rebuilds the screens so the later charset merge sees the same data as
+    the serial reader.
+    """
+    charset_bytes = None
+    if charset is not None:
+        charset_bytes = [char.data.tobytes() for char in charset]
+    init_args = (charset_bytes, background_color, inverse, cleanup)
+
+    memo_keys = [None] * len(files)
+    frames = [None] * len(files)
+    if current_context().frame_memo is not None:
+        options_key = _frame_memo_options(*init_args)
+        for idx, path in enumerate(files):
+            with open(path, "rb") as f:
+                memo_keys[idx] = (options_key, hashlib.sha1(f.read()).digest())
+            frames[idx] = _frame_memo_get(memo_keys[idx])
+    jobs = [(idx, path) for idx, path in enumerate(files) if frames[idx] is None]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1 or len(jobs) < MIN_FRAMES_FOR_PARALLEL_DECODE:
+        # Not through the worker globals, other threads may decode too
+        options = _decode_options(*init_args)
+        decoded = [_decode_frame_file(job, options) for job in jobs]
+    else:
+        logger.info(f"Decoding {len(jobs)} frames with {workers} workers")
+        with multiprocessing.Pool(
+            workers, initializer=_init_decode_worker, initargs=init_args
+        ) as pool:
+            decoded = pool.map(_decode_frame_file, jobs)
+
+    for (idx, _), frame in zip(jobs, decoded):
+        frames[idx] = frame
+        _frame_memo_put(memo_keys[idx], frame)
+    return frames
+
+
+def decode_image_frames(
+    filename,
+    charset=None,
+    background_color=None,
+    inverse=False,
+    cleanup=1,
+    workers=None,
+) -> List[FrameData]:
+    """Cellify every frame of an image file, or of a PNG frame sequence"""
+    frame_files = find_frame_sequence(filename)
+    if frame_files is not None:
+        if len(frame_files) == 0:
+            raise ValueError(f"No PNG frames found in {filename}")
+        return decode_frame_sequence(
+            frame_files, charset, background_color, inverse, cleanup, workers
+        )
+
+    with Image.open(filename) as img:
+        return decode_images(
+            ImageSequence.Iterator(img), charset, background_color, inverse, cleanup
+        )
+
+
+def decode_images(
+    images: Iterable[Image.Image],
+    charset=None,
+    background_color=None,
+    inverse=False,
+    cleanup=1,
+) -> List[FrameData]:
+    """Cellify images in memory, one frame per image"""
+    options_key = None
+    if current_context().frame_memo is not None:
+        charset_bytes = None
+        if charset is not None:
+            charset_bytes = [char.data.tobytes() for char in charset]
+        options_key = _frame_memo_options(
+            charset_bytes, background_color, inverse, cleanup
+        )
+
+    frames = []
+    for idx, image in enumerate(images):
+        memo_key = None
+        if options_key is not None:
+            pixels = image.convert("RGB").tobytes()
+            memo_key = (options_key, image.size, hashlib.sha1(pixels).digest())
+            frame = _frame_memo_get(memo_key)
+            if frame is not None:
+                frames.append(frame)
+                continue
+
+        screen = PetsciiScreen(idx, background_color)
+        screen.read(image, charset, inverse, cleanup)
+        frame = FrameData.from_screen(screen, image.size, charset is None)
+        frames.append(frame)
+        _frame_memo_put(memo_key, frame)
+        if charset is not None:
+            for char in charset:
+                char.usage.clear()
+                char.used_in_screen.clear()
+    return frames
+
+
+def frames_to_screens(
+    frames: List[FrameData], charset=None, background_color=None, border_color=None
+) -> List[PetsciiScreen]:
+    screens = [
+        frame.to_screen(idx, charset, background_color, border_color)
+        for idx, frame in enumerate(frames)
+    ]
+    if len(screens) == 1:
+        screens = [screens[0], screens[0]]
+    return screens
+
+
+def read_frame_sequence(
+    files: List[str],
+    charset=None,
+    background_color=None,
+    border_color=None,
+    inverse=False,
+    cleanup=1,
+    workers=None,
+) -> List[PetsciiScreen]:
+    frames = decode_frame_sequence(
+        files, charset, background_color, inverse, cleanup, workers
+    )
+    return frames_to_screens(frames, charset, background_color, border_color)
+
+
 def read_screens(
     filename,
     charset=None,
@@ -834,35 +1089,59 @@ def read_screens(
     border_color=None,
     inverse=False,
     cleanup=1,
+    workers=None,
 ) -> List[PetsciiScreen]:
-    if filename.endswith(".c"):
-        return read_petscii(filename, charset)
-    if filename.endswith(".petmate"):
+    if find_frame_sequence(filename) is None and is_screen_file(filename):
+        if filename.endswith(".c"):
+            return read_petscii(filename, charset)
         return read_petmate(filename)
-    else:
-        screens = []
-        img = Image.open(filename)
-        for idx, frame in enumerate(ImageSequence.Iterator(img)):
-            screen = PetsciiScreen(idx, background_color, border_color)
-            screen.read(frame, charset, inverse, cleanup)
-            screens.append(screen)
-        if len(screens) == 1:
-            screens = [screens[0], screens[0]]
-        return screens
+    frames = decode_image_frames(
+        filename, charset, background_color, inverse, cleanup, workers
+    )
+    return frames_to_screens(frames, charset, background_color, border_color)
+
+
+def _exact_char_indexes(chars: List[PetsciiChar]) -> Optional[dict]:
+    """
+    First index of every bitmap in chars, None while charset compression
+    lets close characters compare equal and lists have to be searched.
+    """
+    if current_context().char_equality_threshold is not None:
+        return None
+    indexes = {}
+    for idx, char in enumerate(chars):
+        indexes.setdefault(char.data.tobytes(), idx)
+    return indexes
+
+
+def _char_index(char: PetsciiChar, chars: List[PetsciiChar], indexes) -> Optional[int]:
+    """First index of char in chars, looked up in indexes when there are some"""
+    if indexes is not None:
+        return indexes.get(char.data.tobytes())
+    if char in chars:
+        return chars.index(char)
+    return None
+
+
+def _append_char(char: PetsciiChar, chars: List[PetsciiChar], indexes):
+    if indexes is not None:
+        indexes.setdefault(char.data.tobytes(), len(chars))
+    chars.append(char)
 
 
 def merge_charsets(screens, debug_output_folder=None):
     """Optimized charset merging with better performance"""
     all_characters = []
+    all_indexes = _exact_char_indexes(all_characters)
 
     total_chars = 0
     for screen in screens:
         total_chars += len(screen.charset)
         for char in screen.charset:
-            if char not in all_characters:
-                all_characters.append(char)
+            char_idx = _char_index(char, all_characters, all_indexes)
+            if char_idx is None:
+                _append_char(char, all_characters, all_indexes)
             else:
-                char_idx = all_characters.index(char)
                 existing = all_characters[char_idx]
                 for use in char.usage:
                     existing.used_in_screen.add(use.screen_index)
@@ -880,10 +1159,11 @@ def merge_charsets(screens, debug_output_folder=None):
     )
 
     seed_charset = [*chars_used_in_all]
+    seed_indexes = _exact_char_indexes(seed_charset)
     sorted_chars = sorted(all_characters, key=lambda ch: len(ch.usage), reverse=True)
     for char in sorted_chars:
-        if char not in seed_charset:
-            seed_charset.append(char)
+        if _char_index(char, seed_charset, seed_indexes) is None:
+            _append_char(char, seed_charset, seed_indexes)
         if len(seed_charset) > MAX_SEED_CHARSET_SIZE:
             break
 
@@ -892,17 +1172,19 @@ def merge_charsets(screens, debug_output_folder=None):
 
     for _idx, screen in enumerate(screens):
         new_charset = [*charset]
+        indexes = _exact_char_indexes(charset)
 
         for char in screen.charset:
-            if char not in charset:
+            if _char_index(char, charset, indexes) is None:
                 new_charset.append(char)
 
         if len(new_charset) > MAX_BYTE_VALUE:
             charsets.append(charset)
             charset = [*seed_charset]
+            indexes = _exact_char_indexes(charset)
             for char in screen.charset:
-                if char not in charset:
-                    charset.append(char)
+                if _char_index(char, charset, indexes) is None:
+                    _append_char(char, charset, indexes)
         else:
             charset.clear()
             charset.extend(new_charset)
@@ -936,7 +1218,8 @@ def compress_charsets(
     start_threshold=1,
 ) -> Tuple[List[PetsciiScreen], List[List[PetsciiChar]], float]:
     """Simplified charset compression"""
-    PetsciiChar.GLOBAL_CHAR_EQUALITY_THRESHOLD_HACK = start_threshold
+    context = current_context()
+    context.char_equality_threshold = start_threshold
     found_threshold = start_threshold
 
     new_screens = screens[:]
@@ -946,11 +1229,12 @@ def compress_charsets(
         logger.info(
             f"  Trying to compress_charsets, now at threshold={found_threshold}, charsets={len(new_charsets)}"
         )
-        new_screens, new_charsets = merge_charsets(new_screens, debug_output_folder)
-        PetsciiChar.GLOBAL_CHAR_EQUALITY_THRESHOLD_HACK += 1
+        with span("compress_charsets iteration", threshold=found_threshold):
+            new_screens, new_charsets = merge_charsets(new_screens, debug_output_folder)
+        context.char_equality_threshold += 1
         found_threshold += 1
 
-    PetsciiChar.GLOBAL_CHAR_EQUALITY_THRESHOLD_HACK = None
+    context.char_equality_threshold = None
     return new_screens, new_charsets, found_threshold
 
 
@@ -0,0 +1,90 @@
+"""
+State of one conversion.
+
+The character distance cache, the character equality threshold used while
+compressing charsets, the build folder and the output folder used to be
+module globals, so two conversions could not run in one process at the same
+time, and every process started from the same install shared one build
+folder. A PipelineContext holds them for one conversion. use_context makes a
+context current for the running thread or asyncio task, code below looks it
+up with current_context. Code running outside use_context shares a default
+context, which is what the command line tool does.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import logging
+from typing import Dict, Iterator, Optional, Tuple
+
+from logger import get_logger
+import utils
+
+
+class PipelineContext:
+    def __init__(
+        self,
+        build_folder: Optional[str] = None,
+        log_file: Optional[str] = None,
+        output_folder: Optional[str] = None,
+    ):
+        self.build_folder = build_folder or utils.get_resource_path("build")
+        # Built .prg and .petmate files, the current folder by default
+        self.output_folder = output_folder
+        # Only log records of this context are written to log_file
+        self.log_file = log_file
+        # Hamming distance by the bitmaps of two characters, smaller first
+        self.char_distance_cache: Dict[Tuple[bytes, bytes], int] = {}
+        # Characters this close compare equal, only set while compressing
+        self.char_equality_threshold: Optional[int] = None
+        # Pickled stage results by stage name, with their fingerprint
+        self.stage_results: Dict[str, Tuple[str, bytes]] = {}
+        # Cellified frames by image and decode options, only kept when set
+        self.frame_memo: Optional[OrderedDict] = None
+        # Pack with the block size of the last search instead of searching
+        self.reuse_block_size = False
+        self.selected_block_size = None
+        # tracing.Tracer recording spans, only set with --trace
+        self.tracer = None
+
+
+_DEFAULT_CONTEXT = PipelineContext()
+_CURRENT_CONTEXT: contextvars.ContextVar = contextvars.ContextVar(
+    "pipeline_context", default=None
+)
+
+
+def current_context() -> PipelineContext:
+    context = _CURRENT_CONTEXT.get()
+    if context is None:
+        return _DEFAULT_CONTEXT
+    return context
+
+
+class ContextLogFilter(logging.Filter):
+    """Pass log records emitted while context is current"""
+
+    def __init__(self, context: PipelineContext):
+        super().__init__()
+        self.context = context
+
+    def filter(self, _record) -> bool:
+        return _CURRENT_CONTEXT.get() is self.context
+
+
+@contextmanager
+def use_context(context: PipelineContext) -> Iterator[PipelineContext]:
+    """Make context current, and log to its log file, until the block ends"""
+    token = _CURRENT_CONTEXT.set(context)
+    handler = None
+    if context.log_file:
+        handler = get_logger().create_file_handler(context.log_file)
+        handler.addFilter(ContextLogFilter(context))
+        get_logger().add_handler(handler)
+    try:
+        yield context
+    finally:
+        if handler is not None:
+            get_logger().remove_handler(handler)
+            handler.close()
+        _CURRENT_CONTEXT.reset(token)
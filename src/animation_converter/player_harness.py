@@ -0,0 +1,155 @@
+"""
+Run the assembled player on the in-process 6502 core.
+
+Loads the .prg produced by build_utils.build, calls player_init once and then
+player_unpack for every frame, recording the exact cycles of each call and the
+unpack buffers afterwards. The results can be checked against the frames
+decoded by AnimDecoder, which follow Packer.unpack semantics.
+"""
+
+import re
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from anim_decoder import DecodedFrame
+from logger import get_logger
+from mos6502 import CPU
+from packer import MAX_SCREEN_OFFSET
+
+logger = get_logger()
+
+LABEL_PATTERN = re.compile(r"^(\w+)\s*=\s*\$([0-9a-fA-F]+)")
+REQUIRED_LABELS = (
+    "player_init",
+    "player_unpack",
+    "UNPACK_BUFFER_LOCATION",
+    "COLOR_UNPACK_BUFFER_LOCATION",
+)
+MAX_FRAME_CYCLES = 5_000_000
+
+
+class EmulatedFrame(NamedTuple):
+    cycles: int
+    screen_codes: bytes
+    color_data: bytes
+
+
+def read_labels(labels_file: str) -> Dict[str, int]:
+    """Read a label list written by 64tass -l"""
+    labels = {}
+    with open(labels_file) as f:
+        for line in f:
+            match = LABEL_PATTERN.match(line)
+            if match:
+                labels[match.group(1)] = int(match.group(2), 16)
+    return labels
+
+
+def load_prg(memory: bytearray, prg: bytes, non_linear: bool = False):
+    """Copy a linear CBM .prg, or the 64tass nonlinear variant, into memory"""
+    if not non_linear:
+        address = prg[0] | (prg[1] << 8)
+        memory[address : address + len(prg) - 2] = prg[2:]
+        return
+
+    pos = 0
+    while pos + 2 <= len(prg):
+        length = prg[pos] | (prg[pos + 1] << 8)
+        if length == 0:
+            break
+        address = prg[pos + 2] | (prg[pos + 3] << 8)
+        memory[address : address + length] = prg[pos + 4 : pos + 4 + length]
+        pos += 4 + length
+
+
+class PlayerHarness:
+    def __init__(self, prg_file: str, labels_file: str, non_linear: bool = False):
+        self.labels = read_labels(labels_file)
+        missing = [label for label in REQUIRED_LABELS if label not in self.labels]
+        if missing:
+            raise ValueError(f"Labels missing from {labels_file}: {', '.join(missing)}")
+
+        self.cpu = CPU()
+        with open(prg_file, "rb") as f:
+            load_prg(self.cpu.memory, f.read(), non_linear)
+
+        # Start from empty buffers, like Packer.unpack
+        for label in ("UNPACK_BUFFER_LOCATION", "COLOR_UNPACK_BUFFER_LOCATION"):
+            location = self.labels[label]
+            self.cpu.memory[location : location + MAX_SCREEN_OFFSET] = bytes(
+                MAX_SCREEN_OFFSET
+            )
+
+        self.cpu.call(self.labels["player_init"])
+
+    def buffer(self, label: str) -> bytes:
+        location = self.labels[label]
+        return bytes(self.cpu.memory[location : location + MAX_SCREEN_OFFSET])
+
+    def run_frame(self) -> EmulatedFrame:
+        cycles = self.cpu.call(self.labels["player_unpack"], MAX_FRAME_CYCLES)
+        return EmulatedFrame(
+            cycles,
+            self.buffer("UNPACK_BUFFER_LOCATION"),
+            self.buffer("COLOR_UNPACK_BUFFER_LOCATION"),
+        )
+
+    def run_frames(self, frame_count: int) -> List[EmulatedFrame]:
+        return [self.run_frame() for _ in range(frame_count)]
+
+
+def verify_player(
+    prg_file: str,
+    labels_file: str,
+    expected_frames: Sequence[DecodedFrame],
+    use_color: bool = False,
+    estimated_cycles: Optional[Sequence[int]] = None,
+    non_linear: bool = False,
+    loop_frame: Optional[int] = None,
+) -> bool:
+    """
+    Run the player for every expected frame and compare unpack buffers, logs
+    measured cycles and how far the cycle model estimates were off. With
+    loop_frame the frames from there are played once more after the restart.
+    """
+    harness = PlayerHarness(prg_file, labels_file, non_linear)
+    frames = harness.run_frames(len(expected_frames))
+    played_frames = list(expected_frames)
+    if loop_frame is not None:
+        frames += harness.run_frames(len(expected_frames) - loop_frame)
+        played_frames += expected_frames[loop_frame:]
+
+    mismatches = []
+    for idx, (frame, expected) in enumerate(zip(frames, played_frames)):
+        if frame.screen_codes != expected.screen_codes or (
+            use_color and frame.color_data != expected.color_data
+        ):
+            mismatches.append(idx)
+
+    cycles = [frame.cycles for frame in frames[: len(expected_frames)]]
+    worst = max(range(len(cycles)), key=cycles.__getitem__)
+    logger.info(
+        f"Emulated player: min {min(cycles)}, avg {sum(cycles) // len(cycles)}, "
+        f"max {cycles[worst]} (frame {worst}) cycles per frame"
+    )
+    if estimated_cycles:
+        # The loop frame estimate includes the restart op of looping playback
+        skipped = loop_frame or 0
+        errors = [
+            estimate - measured
+            for idx, (estimate, measured) in enumerate(zip(estimated_cycles, cycles))
+            if idx != skipped
+        ]
+        if errors:
+            logger.info(
+                f"Cycle model error against emulation: min {min(errors)}, "
+                f"max {max(errors)} cycles"
+            )
+
+    if mismatches:
+        logger.error(
+            f"Emulated player output differs from Packer.unpack at frames: "
+            f"{', '.join(str(idx) for idx in mismatches)}"
+        )
+        return False
+    logger.success(f"Emulated player output matches all {len(frames)} frames")
+    return True
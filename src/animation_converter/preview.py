@@ -0,0 +1,193 @@
+"""
+Render a preview of a packed animation straight from the build output.
+
+Decodes anim.bin with AnimDecoder, applies charset_N.bin and the decoded
+colors and writes either an animated GIF or a PNG contact sheet, so packer
+output can be checked without assembling and running the .prg.
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+from typing import List, Sequence
+
+from anim_decoder import AnimDecoder, DecodedFrame
+from logger import get_logger, setup_logging
+from PIL import Image
+from screen_renderer import CHAR_PIXELS, GlyphAtlas, frame_to_image
+
+logger = get_logger()
+
+PAL_FRAME_MS = 20
+DEFAULT_COLOR = 1
+DEFAULT_STRIP_COLUMNS = 8
+
+
+def read_charset_glyphs(build_folder: str) -> List[List[bytes]]:
+    """Read charset_N.bin files from build folder, ordered by N"""
+    charset_files = {}
+    for file_name in glob.glob(os.path.join(build_folder, "charset_*.bin")):
+        match = re.search(r"charset_(\d+)\.bin$", file_name)
+        if match:
+            charset_files[int(match.group(1))] = file_name
+
+    charsets = []
+    for idx in range(len(charset_files)):
+        with open(charset_files[idx], "rb") as f:
+            data = f.read()
+        charsets.append(
+            [data[i : i + CHAR_PIXELS] for i in range(0, len(data) - 7, CHAR_PIXELS)]
+        )
+    return charsets
+
+
+def frame_durations(
+    frames: Sequence[DecodedFrame], slowdown_frames: int = 0
+) -> List[int]:
+    """Frame durations in milliseconds, each slowdown step is one PAL frame"""
+    durations = []
+    for frame in frames:
+        slowdown = frame.slowdown if frame.slowdown is not None else slowdown_frames
+        durations.append(PAL_FRAME_MS * max(1, slowdown))
+    return durations
+
+
+def render_frames(
+    frames: Sequence[DecodedFrame],
+    charset_glyphs: Sequence[Sequence[bytes]],
+    char_size: int = CHAR_PIXELS,
+    border: int = 0,
+) -> List[Image.Image]:
+    atlases = {}
+    images = []
+    for frame in frames:
+        key = (frame.charset, frame.background_color)
+        atlas = atlases.get(key)
+        if atlas is None:
+            glyphs = charset_glyphs[frame.charset] if charset_glyphs else []
+            atlas = GlyphAtlas(glyphs, frame.background_color)
+            atlases[key] = atlas
+        images.append(
+            frame_to_image(
+                atlas.compose(frame.screen_codes, frame.color_data),
+                char_size,
+                border,
+                frame.border_color,
+            )
+        )
+    return images
+
+
+def save_strip(images: Sequence[Image.Image], output_file: str, columns: int):
+    columns = max(1, min(columns, len(images)))
+    rows = (len(images) + columns - 1) // columns
+    width, height = images[0].size
+    strip = Image.new("P", (width * columns, height * rows), 0)
+    strip.putpalette(images[0].getpalette())
+    for idx, img in enumerate(images):
+        strip.paste(img, ((idx % columns) * width, (idx // columns) * height))
+    strip.save(output_file)
+
+
+def write_preview(
+    decoder: AnimDecoder,
+    anim_stream: Sequence[int],
+    charset_glyphs: Sequence[Sequence[bytes]],
+    output_file: str,
+    char_size: int = CHAR_PIXELS,
+    border: int = 0,
+    slowdown_frames: int = 0,
+    default_color: int = DEFAULT_COLOR,
+    strip_columns: int = DEFAULT_STRIP_COLUMNS,
+):
+    """
+    Decode anim_stream and write it as an animated GIF, or as a PNG strip of
+    all frames when output file does not end with .gif
+    """
+    frames = list(decoder.frames(bytes(anim_stream), default_color=default_color))
+    if not frames:
+        raise ValueError("Animation stream has no frames")
+
+    images = render_frames(frames, charset_glyphs, char_size, border)
+
+    if output_file.lower().endswith(".gif"):
+        images[0].save(
+            output_file,
+            save_all=True,
+            append_images=images[1:],
+            optimize=False,
+            duration=frame_durations(frames, slowdown_frames),
+            loop=0,
+        )
+    else:
+        save_strip(images, output_file, strip_columns)
+
+    logger.info(f"Wrote preview of {len(frames)} frames to {output_file}")
+    return len(frames)
+
+
+def preview_build_folder(build_folder: str, output_file: str, **kwargs):
+    decoder = AnimDecoder.from_build_folder(build_folder)
+    with open(os.path.join(build_folder, "anim.bin"), "rb") as f:
+        anim_stream = f.read()
+    charset_glyphs = read_charset_glyphs(build_folder)
+    return write_preview(decoder, anim_stream, charset_glyphs, output_file, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render anim.bin from a build folder as GIF or PNG strip"
+    )
+    parser.add_argument(
+        "build_folder", help="Folder with anim.bin, charset_N.bin and player.asm"
+    )
+    parser.add_argument(
+        "output_file", help="Output .gif, any other extension is a PNG strip"
+    )
+    parser.add_argument(
+        "--char-size", type=int, default=CHAR_PIXELS, help="Pixel size of one character"
+    )
+    parser.add_argument("--border", type=int, default=0, help="Border width in pixels")
+    parser.add_argument(
+        "--anim-slowdown-frames",
+        type=int,
+        default=0,
+        help="Frames each animation frame is shown, when stream has no slowdown ops",
+    )
+    parser.add_argument(
+        "--default-color",
+        type=int,
+        default=DEFAULT_COLOR,
+        help="Color memory value before the animation starts (default: 1)",
+    )
+    parser.add_argument(
+        "--columns",
+        type=int,
+        default=DEFAULT_STRIP_COLUMNS,
+        help="Frames per row in PNG strip",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    setup_logging(verbose=args.verbose)
+
+    try:
+        preview_build_folder(
+            args.build_folder,
+            args.output_file,
+            char_size=args.char_size,
+            border=args.border,
+            slowdown_frames=args.anim_slowdown_frames,
+            default_color=args.default_color,
+            strip_columns=args.columns,
+        )
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Preview failed: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Patch new animation data into the last built .prg.
+
+After 64tass builds a .prg, record_build keeps a record in the splice
+folder of the build folder. The record holds the address and size of every
+.binary the listing shows for anim.bin and charset_*.bin, and a hash of
+every other file 64tass reads. It also keeps copies of the labels and the
+listing.
+
+With --splice-prg, the next build first tries splice_build. When the rendered
+player and test program sources, the music and the flags hash the same,
+only animation data changed. The new anim.bin and charsets are then written
+over the old ones in the .prg, and the copies of the labels and listing go
+back to the build folder. Data must fit the space it had when assembled:
+the player is placed right after anim.bin, so a longer stream or an extra
+charset means a full build, after which splicing works again. The listing
+still shows the data bytes of the assembled build.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+from typing import Dict, List, Optional
+
+from logger import get_logger
+import utils
+
+logger = get_logger()
+
+SPLICE_VERSION = 1
+SPLICE_FOLDER = "splice"
+# Assembled binaries a splice replaces
+DATA_FILE = re.compile(r"^(anim|charset_\d+)\.bin$")
+# Written to the build folder while converting, not read by 64tass
+DEBUG_FILES = ("petscii.c",)
+LISTING_BINARY = re.compile(r'^>([0-9a-fA-F]{4})\s.*\.binary\s+"([^"]+)"')
+PRG_HEADER_SIZE = 2
+
+
+def _record_path(build_folder: str, name: str, suffix: str) -> str:
+    return os.path.join(build_folder, SPLICE_FOLDER, f"{name}{suffix}")
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    utils.update_digest(digest, path)
+    return digest.hexdigest()
+
+
+def _data_files(build_folder: str) -> List[str]:
+    return sorted(name for name in os.listdir(build_folder) if DATA_FILE.match(name))
+
+
+def sources_digest(build_folder: str, name: str, flags: List[str]) -> str:
+    """Hash of the flags and the build folder files but data, debug and outputs"""
+    skipped = {f"{name}.lst", f"{name}.labels", f"{name}.prg", *DEBUG_FILES}
+    digest = hashlib.sha256(f"{SPLICE_VERSION}:{flags}".encode())
+    for file_name in sorted(os.listdir(build_folder)):
+        path = os.path.join(build_folder, file_name)
+        if (
+            not os.path.isfile(path)
+            or file_name in skipped
+            or DATA_FILE.match(file_name)
+        ):
+            continue
+        digest.update(f"\0{file_name}\0".encode())
+        utils.update_digest(digest, path)
+    return digest.hexdigest()
+
+
+def binary_segments(listing_file: str) -> Dict[str, int]:
+    """Address of every .binary in a 64tass listing, by file name"""
+    segments = {}
+    with open(listing_file) as f:
+        for line in f:
+            match = LISTING_BINARY.match(line)
+            if match:
+                segments[match.group(2)] = int(match.group(1), 16)
+    return segments
+
+
+def record_build(
+    build_folder: str, name: str, outputs: Dict[str, str], flags: List[str]
+):
+    """Remember where the data of a freshly built .prg is, for splice_build"""
+    try:
+        addresses = binary_segments(outputs[".lst"])
+        segments = {}
+        for file_name in _data_files(build_folder):
+            if file_name not in addresses:
+                logger.debug(f"Splice: {file_name} not found in listing")
+                return
+            size = os.path.getsize(os.path.join(build_folder, file_name))
+            segments[file_name] = [addresses[file_name], size]
+
+        record = {
+            "version": SPLICE_VERSION,
+            "sources": sources_digest(build_folder, name, flags),
+            "prg": _file_digest(outputs[".prg"]),
+            "segments": segments,
+        }
+        utils.create_folder_if_not_exists(os.path.join(build_folder, SPLICE_FOLDER))
+        shutil.copyfile(outputs[".labels"], _record_path(build_folder, name, ".labels"))
+        shutil.copyfile(outputs[".lst"], _record_path(build_folder, name, ".lst"))
+        with open(_record_path(build_folder, name, ".json"), "w") as f:
+            json.dump(record, f)
+    except OSError as e:
+        logger.warning(f"Could not record build for splicing: {e}")
+
+
+def _load_record(build_folder: str, name: str) -> Optional[dict]:
+    try:
+        with open(_record_path(build_folder, name, ".json")) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if record.get("version") != SPLICE_VERSION:
+        return None
+    return record
+
+
+def _check_record(
+    record: Optional[dict], build_folder: str, name: str, prg_file: str, flags
+):
+    """Raise ValueError when the recorded build can not be spliced"""
+    if record is None:
+        raise ValueError("no earlier build recorded")
+    if record["sources"] != sources_digest(build_folder, name, flags):
+        raise ValueError("player or test program changed")
+    if not os.path.isfile(prg_file) or _file_digest(prg_file) != record["prg"]:
+        raise ValueError(f"{prg_file} is not the last build")
+    if sorted(record["segments"]) != _data_files(build_folder):
+        raise ValueError("charset count changed")
+
+
+def _patched_prg(segments: Dict[str, List[int]], build_folder: str, prg_file: str):
+    with open(prg_file, "rb") as f:
+        prg = bytearray(f.read())
+    load_address = prg[0] | (prg[1] << 8)
+    for file_name, (address, size) in segments.items():
+        with open(os.path.join(build_folder, file_name), "rb") as f:
+            data = f.read()
+        if len(data) > size:
+            raise ValueError(f"{file_name} grew from {size} to {len(data)} bytes")
+        start = address - load_address + PRG_HEADER_SIZE
+        if start < PRG_HEADER_SIZE or start + size > len(prg):
+            raise ValueError(f"{file_name} is outside of {prg_file}")
+        prg[start : start + len(data)] = data
+    return prg
+
+
+def splice_build(
+    build_folder: str, name: str, outputs: Dict[str, str], flags: List[str]
+) -> bool:
+    """Patch the data files into the last built .prg, False when a build is needed"""
+    prg_file = outputs[".prg"]
+    record = _load_record(build_folder, name)
+    try:
+        _check_record(record, build_folder, name, prg_file, flags)
+        prg = _patched_prg(record["segments"], build_folder, prg_file)
+    except ValueError as e:
+        logger.info(f"Splice: {e}, assembling")
+        return False
+
+    # Written aside first, an interrupted splice must not leave half a .prg
+    temp_path = f"{prg_file}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(prg)
+    os.replace(temp_path, prg_file)
+    shutil.copyfile(_record_path(build_folder, name, ".labels"), outputs[".labels"])
+    shutil.copyfile(_record_path(build_folder, name, ".lst"), outputs[".lst"])
+
+    record["prg"] = _file_digest(prg_file)
+    with open(_record_path(build_folder, name, ".json"), "w") as f:
+        json.dump(record, f)
+    return True
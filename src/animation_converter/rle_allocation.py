@@ -0,0 +1,139 @@
+"""
+Global op code allocation for RLE block fills.
+
+Packer.encode_block adds a player_op_fill_rle{encoded}_{decoded} op the first
+time a size combination shows up, so op codes and player routines go to
+whatever variant comes first. Here the stream of an unrestricted packing pass
+is used as statistics: every RLE block is counted with the variants it could
+use, also longer ones reached by splitting runs. Variants are then picked
+greedily by data bytes saved minus the player code they need, until the op
+code budget runs out or no variant pays for itself.
+"""
+
+from collections import Counter
+from typing import Dict, List, NamedTuple, Tuple
+
+from anim_decoder import FILL_RLE_PATTERN, AnimDecoder
+from logger import get_logger
+from packer import Packer
+from rle_codec import RLECodec
+
+logger = get_logger()
+
+# lda #encoded, jsr player_rle_decode, rts and the two op table bytes
+RLE_VARIANT_CODE_BYTES = 2 + 3 + 1 + 2
+# lda abs, ldy #, sta (zp),y for every decoded cell
+RLE_VARIANT_CELL_CODE_BYTES = 3 + 2 + 2
+
+# (encoded size, decoded size, extra pairs possible by splitting runs)
+RleShape = Tuple[int, int, int]
+RleVariant = Tuple[int, int]
+
+
+class RleAllocation(NamedTuple):
+    variants: List[RleVariant]
+    candidates: int
+    data_bytes_saved: int
+    code_bytes: int
+
+
+def variant_code_bytes(variant: RleVariant) -> int:
+    return RLE_VARIANT_CODE_BYTES + variant[1] * RLE_VARIANT_CELL_CODE_BYTES
+
+
+def collect_rle_shapes(packer: Packer, anim_stream: List[int]) -> Counter:
+    """Count the RLE fills of anim_stream by shape"""
+    decoder = AnimDecoder.for_packer(packer)
+    stream = bytes(anim_stream)
+    shapes = Counter()
+    for ops in decoder.iter_ops(stream):
+        for op in ops:
+            match = FILL_RLE_PATTERN.match(op.name)
+            if match:
+                encoded = stream[op.start + 1 : op.end]
+                shapes[
+                    (
+                        len(encoded),
+                        int(match.group(2)),
+                        RLECodec.extra_pairs_possible(encoded),
+                    )
+                ] += 1
+    return shapes
+
+
+def _variants_for_shape(shape: RleShape) -> List[RleVariant]:
+    encoded_size, decoded_size, extra_pairs = shape
+    return [
+        (encoded_size + 2 * pairs, decoded_size)
+        for pairs in range(extra_pairs + 1)
+        if encoded_size + 2 * pairs < decoded_size - 2
+    ]
+
+
+def allocate_rle_variants(shapes: Dict[RleShape, int], op_budget: int) -> RleAllocation:
+    """
+    Pick the variants with the best data savings minus player code size. A
+    block uses the shortest picked variant it fits, or a plain fill.
+    """
+    users: Dict[RleVariant, List[RleShape]] = {}
+    for shape in shapes:
+        for variant in _variants_for_shape(shape):
+            users.setdefault(variant, []).append(shape)
+
+    # Data bytes of every shape with the variants picked so far
+    data_bytes = {shape: shape[1] for shape in shapes}
+    picked = []
+    data_bytes_saved = 0
+    code_bytes = 0
+    while len(picked) < op_budget:
+        best_variant = None
+        best_gain = 0
+        best_saved = 0
+        for variant, variant_users in users.items():
+            if variant in picked:
+                continue
+            saved = sum(
+                shapes[shape] * (data_bytes[shape] - variant[0])
+                for shape in variant_users
+                if variant[0] < data_bytes[shape]
+            )
+            gain = saved - variant_code_bytes(variant)
+            if gain > best_gain:
+                best_variant, best_gain, best_saved = variant, gain, saved
+        if best_variant is None:
+            break
+
+        picked.append(best_variant)
+        data_bytes_saved += best_saved
+        code_bytes += variant_code_bytes(best_variant)
+        for shape in users[best_variant]:
+            data_bytes[shape] = min(data_bytes[shape], best_variant[0])
+
+    return RleAllocation(sorted(picked), len(users), data_bytes_saved, code_bytes)
+
+
+def report_allocation(allocation: RleAllocation, shapes: Dict[RleShape, int]):
+    """Log player code and data size of allocated variants against all variants"""
+    all_variants = {(shape[0], shape[1]) for shape in shapes}
+    all_code_bytes = sum(variant_code_bytes(variant) for variant in all_variants)
+    all_data_bytes_saved = sum(
+        count * (shape[1] - shape[0]) for shape, count in shapes.items()
+    )
+    logger.info(
+        f"RLE fill variants: {len(allocation.variants)} of {allocation.candidates} "
+        f"candidates allocated, player code {allocation.code_bytes} bytes, "
+        f"data saved {allocation.data_bytes_saved} bytes"
+    )
+    total_saved = (allocation.data_bytes_saved - allocation.code_bytes) - (
+        all_data_bytes_saved - all_code_bytes
+    )
+    logger.info(
+        f"RLE fill variants without allocation: {len(all_variants)}, player code "
+        f"{all_code_bytes} bytes, data saved {all_data_bytes_saved} bytes, "
+        f"allocation saves {total_saved} bytes of code and data"
+    )
+    for variant in allocation.variants:
+        logger.debug(
+            f"  player_op_fill_rle{variant[0]}_{variant[1]}: "
+            f"{variant_code_bytes(variant)} bytes of code"
+        )
@@ -26,6 +26,29 @@ class RLECodec:
         result.extend([count, current])
         return result
 
+    @staticmethod
+    def extra_pairs_possible(encoded_data):
+        """How many more pairs the data can be spread to by splitting runs"""
+        return sum(count - 1 for count in encoded_data[0::2])
+
+    @staticmethod
+    def split_runs(encoded_data, extra_pairs):
+        """
+        Encode the same data with extra_pairs more pairs, by splitting the
+        longest runs in two
+        """
+        pairs = [
+            [encoded_data[i], encoded_data[i + 1]]
+            for i in range(0, len(encoded_data), 2)
+        ]
+        for _ in range(extra_pairs):
+            idx = max(range(len(pairs)), key=lambda i: pairs[i][0])
+            count, value = pairs[idx]
+            if count < 2:  # noqa: PLR2004
+                raise ValueError("Not enough repeated values to split runs")
+            pairs[idx : idx + 1] = [[count // 2, value], [count - count // 2, value]]
+        return [value for pair in pairs for value in pair]
+
     @staticmethod
     def decode(encoded_data):
         if len(encoded_data) % 2 != 0:
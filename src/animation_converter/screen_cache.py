@@ -0,0 +1,233 @@
+"""
+Persistent cache of cellified input frames.
+
+Decoding a GIF or PNG sequence and matching every 8x8 cell against the
+charset is the slow part of reading inputs, and its result only depends on
+the input pixels and a few options. The FrameData of every frame of an
+input is stored in the cache folder under a hash of the input file contents,
+background color, inverse, cleanup and the default charset. Packing options
+do not change the key, so a rerun with other packing options reads the
+frames from the cache.
+
+Entries are zlib compressed, in a binary format of little endian fields:
+
+    magic, version, decode seconds (double), frame count (u32), per frame:
+        columns (u16), rows (u16), char count (u16, 0xffff without own
+        charset), 8 bytes per char, u16 char index per cell, color data
+        length (u16) and color data
+
+The cache is kept below a size limit by removing the least recently used
+entries, reading an entry touches its file.
+"""
+
+from array import array
+import contextlib
+import hashlib
+import os
+import struct
+import sys
+import time
+from typing import List, NamedTuple, Optional
+import zlib
+
+from logger import get_logger
+import petscii
+from petscii import FrameData
+import utils
+
+logger = get_logger()
+
+CACHE_MAGIC = b"ACSC"
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".frames"
+# Char count of frames matched against the default charset
+NO_CHARSET = 0xFFFF
+
+_HEADER = struct.Struct("<4sBdI")
+_FRAME_HEADER = struct.Struct("<HHH")
+_COLOR_HEADER = struct.Struct("<H")
+
+
+def default_cache_folder() -> str:
+    return utils.user_cache_folder("screens")
+
+
+class CachedFrames(NamedTuple):
+    frames: List[FrameData]
+    decode_seconds: float
+
+
+def _cells_to_bytes(cells: array) -> bytes:
+    if sys.byteorder != "little":
+        cells = array("H", cells)
+        cells.byteswap()
+    return cells.tobytes()
+
+
+def _cells_from_bytes(data: bytes) -> array:
+    cells = array("H")
+    cells.frombytes(data)
+    if sys.byteorder != "little":
+        cells.byteswap()
+    return cells
+
+
+def encode_frames(frames: List[FrameData], decode_seconds: float) -> bytes:
+    parts = [_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, decode_seconds, len(frames))]
+    for frame in frames:
+        char_count = NO_CHARSET if frame.chars is None else len(frame.chars)
+        parts.append(_FRAME_HEADER.pack(frame.columns, frame.rows, char_count))
+        if frame.chars is not None:
+            parts.extend(frame.chars)
+        parts.append(_cells_to_bytes(frame.cells))
+        parts.append(_COLOR_HEADER.pack(len(frame.color_data)))
+        parts.append(frame.color_data)
+    return zlib.compress(b"".join(parts))
+
+
+def decode_frames(data: bytes) -> CachedFrames:
+    """Frames of a cache entry, ValueError when the entry is not readable"""
+    try:
+        data = zlib.decompress(data)
+        magic, version, decode_seconds, frame_count = _HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError("unknown cache entry format")
+        pos = _HEADER.size
+        frames = []
+        for _ in range(frame_count):
+            columns, rows, char_count = _FRAME_HEADER.unpack_from(data, pos)
+            pos += _FRAME_HEADER.size
+            chars = None
+            if char_count != NO_CHARSET:
+                chars = [data[pos + i * 8 : pos + i * 8 + 8] for i in range(char_count)]
+                pos += char_count * 8
+            cells_end = pos + columns * rows * 2
+            cells = _cells_from_bytes(data[pos:cells_end])
+            (color_length,) = _COLOR_HEADER.unpack_from(data, cells_end)
+            pos = cells_end + _COLOR_HEADER.size
+            color_data = data[pos : pos + color_length]
+            pos += color_length
+            if len(cells) != columns * rows or len(color_data) != color_length:
+                raise ValueError("truncated cache entry")
+            frames.append(FrameData(chars, cells, columns, rows, color_data))
+    except (zlib.error, struct.error) as e:
+        raise ValueError(f"damaged cache entry, {e}") from e
+    return CachedFrames(frames, decode_seconds)
+
+
+class ScreenCache:
+    def __init__(self, folder: Optional[str], max_bytes: int):
+        self.folder = folder or default_cache_folder()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def key(
+        self, filename: str, charset, background_color, inverse: bool, cleanup: int
+    ) -> str:
+        """Hash of the input contents and the options cellifying depends on"""
+        digest = hashlib.sha256()
+        digest.update(
+            f"{CACHE_VERSION}:{background_color}:{inverse}:{cleanup}".encode()
+        )
+        if charset is None:
+            digest.update(b"no charset")
+        else:
+            digest.update(b"".join(char.data.tobytes() for char in charset))
+
+        files = petscii.find_frame_sequence(filename)
+        if files is None:
+            files = [filename]
+        digest.update(f":{len(files)}:".encode())
+        for path in files:
+            utils.update_digest(digest, path)
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.folder, key + CACHE_SUFFIX)
+
+    def load(self, key: str) -> Optional[CachedFrames]:
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                cached = decode_frames(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring screen cache entry {path}: {e}")
+            return None
+        # Reading counts as use for the least recently used eviction
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return cached
+
+    def store(self, key: str, frames: List[FrameData], decode_seconds: float):
+        utils.create_folder_if_not_exists(self.folder)
+        path = self._entry_path(key)
+        # Other conversions may read the cache while this one writes
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(encode_frames(frames, decode_seconds))
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write screen cache entry {path}: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_bytes"""
+        utils.evict_least_recently_used(self.folder, (CACHE_SUFFIX,), self.max_bytes)
+
+    def read_screens(
+        self,
+        filename: str,
+        charset=None,
+        background_color=None,
+        border_color=None,
+        inverse=False,
+        cleanup=1,
+        workers=None,
+    ):
+        """petscii.read_screens, with frames of image inputs from the cache"""
+        if petscii.find_frame_sequence(filename) is None and petscii.is_screen_file(
+            filename
+        ):
+            return petscii.read_screens(
+                filename,
+                charset,
+                background_color,
+                border_color,
+                inverse,
+                cleanup,
+                workers,
+            )
+
+        key = self.key(filename, charset, background_color, inverse, cleanup)
+        cached = self.load(key)
+        if cached is not None:
+            self.hits += 1
+            self.saved_seconds += cached.decode_seconds
+            logger.info(
+                f"Screen cache hit for {filename}, {len(cached.frames)} frames, "
+                f"{cached.decode_seconds:.1f}s of decoding saved"
+            )
+            frames = cached.frames
+        else:
+            self.misses += 1
+            start = time.perf_counter()
+            frames = petscii.decode_image_frames(
+                filename, charset, background_color, inverse, cleanup, workers
+            )
+            self.store(key, frames, time.perf_counter() - start)
+        return petscii.frames_to_screens(
+            frames, charset, background_color, border_color
+        )
+
+    def report(self):
+        logger.info(
+            f"Screen cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.saved_seconds:.1f}s of decoding saved"
+        )
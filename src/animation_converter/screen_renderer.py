@@ -0,0 +1,171 @@
+"""
+Glyph atlas based PETSCII screen renderer.
+
+Every glyph of a charset is expanded once into 8 rows of palette indexed
+pixels. Whole frames are then composed by joining those rows, so rendering a
+screen is a few thousand byte string joins instead of 1000 image pastes.
+"""
+
+import multiprocessing
+import os
+from typing import Dict, List, Optional, Sequence
+
+from PIL import Image, ImageOps
+from utils import vicPalette
+
+SCREEN_COLUMNS = 40
+SCREEN_ROWS = 25
+CHAR_PIXELS = 8
+FRAME_WIDTH = SCREEN_COLUMNS * CHAR_PIXELS
+FRAME_HEIGHT = SCREEN_ROWS * CHAR_PIXELS
+MIN_FRAMES_FOR_PARALLEL_RENDER = 8
+
+# One byte of glyph data expanded to 8 pixels with values 0 or 1
+_BYTE_TO_PIXELS = [
+    bytes((value >> (7 - bit)) & 1 for bit in range(8)) for value in range(256)
+]
+
+_VIC_PALETTE_DATA = [component for color in vicPalette for component in color]
+
+
+def glyphs_from_charset(charset) -> List[bytes]:
+    """Convert a list of PetsciiChar to the 8 byte bitmaps used by GlyphAtlas"""
+    return [char.data.tobytes() for char in charset]
+
+
+class GlyphAtlas:
+    """
+    Pre-rendered rows of every glyph in one charset.
+
+    Rows are cached per (glyph, foreground color) pair the first time they are
+    needed. Glyph indexes outside of the charset render as blank, like the
+    memory after a short charset would on the C64.
+    """
+
+    def __init__(self, glyphs: Sequence[bytes], background_color: int = 0):
+        self.background_color = background_color & 15
+        self._masks = [
+            [_BYTE_TO_PIXELS[value] for value in glyph[:CHAR_PIXELS]]
+            for glyph in glyphs
+        ]
+        self._blank = [_BYTE_TO_PIXELS[0]] * CHAR_PIXELS
+        self._color_tables = [
+            bytes.maketrans(b"\x00\x01", bytes([self.background_color, color]))
+            for color in range(16)
+        ]
+        self._rows: Dict[int, List[bytes]] = {}
+
+    def glyph_rows(self, glyph_index: int, color: int) -> List[bytes]:
+        color &= 15
+        key = (glyph_index << 4) | color
+        rows = self._rows.get(key)
+        if rows is None:
+            mask = self._masks[glyph_index] if glyph_index < len(self._masks) else None
+            table = self._color_tables[color]
+            rows = [row.translate(table) for row in (mask or self._blank)]
+            self._rows[key] = rows
+        return rows
+
+    def compose(self, screen_codes: Sequence[int], color_data: Sequence[int]) -> bytes:
+        """Compose a 320x200 frame, one palette index byte per pixel"""
+        lines = []
+        for row in range(SCREEN_ROWS):
+            start = row * SCREEN_COLUMNS
+            cells = [
+                self.glyph_rows(screen_codes[offset], color_data[offset])
+                for offset in range(start, start + SCREEN_COLUMNS)
+            ]
+            for y in range(CHAR_PIXELS):
+                lines.append(b"".join([cell[y] for cell in cells]))
+        return b"".join(lines)
+
+
+def frame_to_image(
+    frame: bytes, char_size: int = CHAR_PIXELS, border: int = 0, border_color: int = 0
+) -> Image.Image:
+    """Wrap composed frame data in a palettized image using the VIC palette"""
+    img = Image.frombytes("P", (FRAME_WIDTH, FRAME_HEIGHT), frame)
+    img.putpalette(_VIC_PALETTE_DATA)
+    if char_size != CHAR_PIXELS:
+        img = img.resize(
+            (SCREEN_COLUMNS * char_size, SCREEN_ROWS * char_size), Image.NEAREST
+        )
+    if border > 0:
+        img = ImageOps.expand(img, border, fill=border_color & 15)
+    return img
+
+
+def render_screen(
+    charset,
+    screen_codes: Sequence[int],
+    color_data: Sequence[int],
+    char_size: int = CHAR_PIXELS,
+    border: int = 0,
+    background_color: int = 0,
+    border_color: int = 0,
+) -> Image.Image:
+    atlas = GlyphAtlas(glyphs_from_charset(charset), background_color)
+    return frame_to_image(
+        atlas.compose(screen_codes, color_data), char_size, border, border_color
+    )
+
+
+# Per worker process atlases for parallel rendering, set by _init_render_worker
+_RENDER_WORKER_ATLASES = None
+
+
+def _init_render_worker(charset_glyphs, background_color):
+    global _RENDER_WORKER_ATLASES
+    _RENDER_WORKER_ATLASES = _make_atlases(charset_glyphs, background_color)
+
+
+def _make_atlases(charset_glyphs, background_color) -> List[GlyphAtlas]:
+    return [GlyphAtlas(glyphs, background_color) for glyphs in charset_glyphs]
+
+
+def _render_worker_frame(job, atlases=None) -> bytes:
+    atlas_index, screen_codes, color_data = job
+    atlases = atlases or _RENDER_WORKER_ATLASES
+    return atlases[atlas_index].compose(screen_codes, color_data)
+
+
+def render_screens(
+    screens,
+    char_size: int = CHAR_PIXELS,
+    border: int = 0,
+    background_color: int = 0,
+    workers: Optional[int] = None,
+) -> List[Image.Image]:
+    """
+    Render many PetsciiScreens, building one atlas per distinct charset.
+
+    Frames are composed across a process pool when there are enough of them,
+    images are returned in the same order as screens.
+    """
+    charset_glyphs = []
+    charset_index = {}
+    jobs = []
+    for screen in screens:
+        key = id(screen.charset)
+        if key not in charset_index:
+            charset_index[key] = len(charset_glyphs)
+            charset_glyphs.append(glyphs_from_charset(screen.charset))
+        jobs.append((charset_index[key], screen.screen_codes, screen.color_data))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1 or len(jobs) < MIN_FRAMES_FOR_PARALLEL_RENDER:
+        # Not through the worker globals, other threads may render too
+        atlases = _make_atlases(charset_glyphs, background_color)
+        frames = [_render_worker_frame(job, atlases) for job in jobs]
+    else:
+        with multiprocessing.Pool(
+            workers,
+            initializer=_init_render_worker,
+            initargs=(charset_glyphs, background_color),
+        ) as pool:
+            frames = pool.map(_render_worker_frame, jobs)
+
+    return [frame_to_image(frame, char_size, border) for frame in frames]
@@ -0,0 +1,237 @@
+"""
+Incremental rebuilds.
+
+A conversion runs as a chain of stages:
+
+    ingest    read inputs, reorder, color and slowdown transforms, dedup
+    charsets  merge_charsets and merge_charsets_compress
+    pack      block size search and final pack
+    output    player and charset files, preview, build, emulation
+
+Every stage but output stores its pickled result in the stages folder of
+the build folder, and in memory for the next conversion in the same
+context, under a fingerprint of what it reads: the fingerprint of the stage
+before it, the options it uses and the contents of the files those options
+name. A stage whose fingerprint did not change since the last run in the
+same build folder returns its stored result, later stages are then checked
+the same way. Changing only --limit-charsets reuses ingest, options only
+read by the output stage reuse all stages.
+
+The border color of image inputs is left out of ingest and charsets. Pack
+only depends on which frames share a border color, frames showing a
+different but equally grouped set of border colors reuse the packed stream
+with the operands of its border color ops replaced.
+"""
+
+import hashlib
+import os
+import pickle
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from anim_decoder import AnimDecoder
+from logger import get_logger
+import petscii
+from tracing import span
+import utils
+
+logger = get_logger()
+
+STAGE_FORMAT_VERSION = 3
+STAGES_FOLDER = "stages"
+
+# Options the stages below read, every other option only changes the output
+INGEST_OPTIONS = (
+    "input_files",
+    "charset",
+    "background_color",
+    "inverse",
+    "cleanup",
+    "allow_reorder_frames",
+    "color_data",
+    "offset_color_frames",
+    "anim_slowdown_table",
+    "anim_slowdown_frames",
+    "randomize_color_frames",
+    "dedup_frames",
+    "near_duplicate_cells",
+)
+CHARSETS_OPTIONS = ("limit_charsets",)
+# Options pack does not read, pack reads all others through set_packer_options
+NON_PACK_OPTIONS = frozenset(
+    {
+        "border_color",
+        "skip_build",
+        "emulate_player",
+        "preview",
+        "output_sources",
+        "write_petmate",
+        "non_linear_prg",
+        "verbose",
+        "quiet",
+        "log_file",
+        "build_folder",
+        "output_folder",
+        "screen_cache",
+        "screen_cache_folder",
+        "screen_cache_size",
+        "build_cache",
+        "build_cache_folder",
+        "splice_prg",
+        "trace",
+        "decode_workers",
+        "pack_workers",
+        "incremental",
+        "watch",
+        "local",
+        "daemon_socket",
+        "config",
+    }
+)
+
+
+class InputFiles(NamedTuple):
+    """Input files option, folders and globs in it are frame sequences"""
+
+    paths: Tuple[str, ...]
+
+
+def _files_digest(files: List[str]) -> str:
+    digest = hashlib.sha256()
+    for path in files:
+        utils.update_digest(digest, path)
+    return digest.hexdigest()
+
+
+def _fingerprint_value(value):
+    """Value as hashed, paths of existing files with their contents"""
+    if isinstance(value, InputFiles):
+        inputs = []
+        for path in value.paths:
+            files = petscii.find_frame_sequence(path)
+            if files is None:
+                files = [path] if os.path.isfile(path) else []
+            inputs.append((path, _files_digest(files)))
+        return tuple(inputs)
+    if isinstance(value, dict):
+        return tuple((key, _fingerprint_value(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint_value(item) for item in value)
+    if isinstance(value, str) and os.path.isfile(value):
+        return (value, _files_digest([value]))
+    return value
+
+
+def stage_options(args, names: Iterable[str]) -> Dict[str, Any]:
+    options = {}
+    for name in names:
+        value = getattr(args, name, None)
+        if name == "input_files":
+            value = InputFiles(tuple(value))
+        options[name] = value
+    return options
+
+
+def pack_options(args) -> Dict[str, Any]:
+    names = sorted(name for name in vars(args) if name not in NON_PACK_OPTIONS)
+    return stage_options(args, names)
+
+
+def border_groups(borders: List[Optional[int]]) -> Tuple:
+    """
+    Border colors numbered by first use, None stays None. Pack always sets
+    the border of the first frame, so equal groups give border ops at the
+    same places.
+    """
+    numbers = {None: None}
+    for border in borders:
+        if border not in numbers:
+            numbers[border] = len(numbers) - 1
+    return tuple(numbers[border] for border in borders)
+
+
+def recolor_border_ops(
+    packer, anim_stream: List[int], old_borders: List, new_borders: List
+) -> List[int]:
+    """Replace border colors of old_borders by new_borders, grouped the same"""
+    colors = dict(zip(old_borders, new_borders))
+    if all(old == new for old, new in colors.items()):
+        return anim_stream
+    stream = bytes(anim_stream)
+    anim_stream = list(anim_stream)
+    for ops in AnimDecoder.for_packer(packer).iter_ops(stream):
+        for op in ops:
+            if op.name == "player_op_set_border":
+                anim_stream[op.start + 1] = colors[stream[op.start + 1]]
+    return anim_stream
+
+
+class StageCache:
+    def __init__(
+        self,
+        build_folder: str,
+        enabled: bool = True,
+        memory: Optional[Dict[str, Tuple[str, bytes]]] = None,
+    ):
+        self.folder = os.path.join(build_folder, STAGES_FOLDER)
+        self.enabled = enabled
+        # Stored results kept in memory by a process converting repeatedly
+        self.memory = memory if memory is not None else {}
+
+    def fingerprint(self, *parts) -> Optional[str]:
+        """Hash of parts with the contents of files they name, None when disabled"""
+        if not self.enabled:
+            return None
+        digest = hashlib.sha256(f"{STAGE_FORMAT_VERSION}".encode())
+        for part in parts:
+            digest.update(repr(_fingerprint_value(part)).encode())
+        return digest.hexdigest()
+
+    def _path(self, stage: str) -> str:
+        return os.path.join(self.folder, f"{stage}.pickle")
+
+    def run(
+        self, stage: str, stage_fingerprint: Optional[str], run_stage: Callable[[], Any]
+    ):
+        """Stored result of stage when stage_fingerprint matches, else run_stage()"""
+        with span(f"stage {stage}"):
+            return self._run(stage, stage_fingerprint, run_stage)
+
+    def _run(
+        self, stage: str, stage_fingerprint: Optional[str], run_stage: Callable[[], Any]
+    ):
+        if not self.enabled:
+            return run_stage()
+
+        stored = self.memory.get(stage)
+        try:
+            if stored is None:
+                with open(self._path(stage), "rb") as f:
+                    stored = pickle.load(f)
+                self.memory[stage] = stored
+            stored_fingerprint, data = stored
+            if stored_fingerprint == stage_fingerprint:
+                logger.info(f"Stage {stage}: unchanged, reusing stored result")
+                # Unpickled again on every use, later stages change their inputs
+                return pickle.loads(data)
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.PickleError, EOFError, ValueError) as e:
+            logger.warning(f"Stage {stage}: ignoring stored result, {e}")
+
+        result = run_stage()
+        if result is None:
+            return result
+        logger.info(f"Stage {stage}: rebuilt")
+        try:
+            stored = (stage_fingerprint, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        except pickle.PickleError as e:
+            logger.warning(f"Stage {stage}: could not store result, {e}")
+            return result
+        self.memory[stage] = stored
+        utils.create_folder_if_not_exists(self.folder)
+        try:
+            with open(self._path(stage), "wb") as f:
+                pickle.dump(stored, f, pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logger.warning(f"Stage {stage}: could not store result, {e}")
+        return result
@@ -0,0 +1,97 @@
+"""
+Run steps concurrently as their dependencies allow.
+
+The output stage writes anim.bin, the player sources and the charsets,
+renders the preview, copies sources, runs 64tass and writes the petmate
+file. Most of that waits on disk or on the assembler, so StepGraph runs the
+steps in a small thread pool, starting each one when the steps it depends
+on are done. Steps run in a copy of the pipeline context of the caller. The
+time of every step is logged, with the total against the time the steps
+would have taken one after another.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+from logger import get_logger
+from tracing import span
+
+logger = get_logger()
+
+DEFAULT_STEP_WORKERS = 4
+
+
+class Step(NamedTuple):
+    name: str
+    run: Callable[[], Any]
+    after: Tuple[str, ...]
+
+
+class StepGraph:
+    def __init__(self, workers: int = DEFAULT_STEP_WORKERS):
+        self.workers = workers
+        self.steps: List[Step] = []
+
+    def add(self, name: str, run: Callable[[], Any], after: Iterable[str] = ()):
+        """Add a step running run() once the steps named in after are done"""
+        after = tuple(after)
+        known = {step.name for step in self.steps}
+        missing = [dependency for dependency in after if dependency not in known]
+        if missing:
+            raise ValueError(f"Step {name} depends on unknown steps {missing}")
+        self.steps.append(Step(name, run, after))
+
+    @staticmethod
+    def _timed(step: Step) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        with span(f"step {step.name}"):
+            result = step.run()
+        return result, time.perf_counter() - start
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Results of all steps by name. When a step raises, steps depending on
+        it are not started and the exception is raised once running steps end.
+        """
+        results: Dict[str, Any] = {}
+        seconds: Dict[str, float] = {}
+        pending = list(self.steps)
+        running = {}
+        error = None
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            while pending or running:
+                if error is None:
+                    for step in [s for s in pending if set(s.after) <= set(results)]:
+                        pending.remove(step)
+                        # A context can only be entered by one thread at a time
+                        context = contextvars.copy_context()
+                        future = executor.submit(context.run, self._timed, step)
+                        running[future] = step
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        results[step.name], seconds[step.name] = future.result()
+                    except Exception as e:
+                        error = error or e
+                        logger.debug(f"Step {step.name} failed: {e}")
+
+        if error is not None:
+            raise error
+        self.report(seconds, time.perf_counter() - start)
+        return results
+
+    @staticmethod
+    def report(seconds: Dict[str, float], total: float):
+        for name, step_seconds in seconds.items():
+            logger.debug(f"Step {name}: {step_seconds:.2f}s")
+        logger.info(
+            f"Output steps done in {total:.2f}s, "
+            f"{sum(seconds.values()):.2f}s when run one after another"
+        )
@@ -0,0 +1,101 @@
+"""
+Timing and memory trace of a conversion.
+
+--trace out.json records a span for every pipeline stage and notable step:
+each read_screens call, each compress_charsets iteration, each block size
+candidate, the unpack validation, template rendering, the output steps and
+the 64tass run. Every span has its wall time, the CPU time of its thread
+and the peak memory traced by tracemalloc while it ran. The file is in the
+Chrome trace event format and opens in chrome://tracing, Perfetto or
+speedscope.
+
+Code marks a span with `with span("name", key=value):`, which costs nothing
+while the current pipeline context has no tracer. Memory tracing slows the
+conversion down. Work done in pack and decode worker processes or in 64tass
+only shows as wall time of the span waiting for it, and spans running in
+parallel threads share one memory peak.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List
+
+from pipeline_context import current_context
+
+
+class Tracer:
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.start_ns = time.perf_counter_ns()
+        # Open spans of every thread, with the peak memory seen inside them
+        self.local = threading.local()
+        self.started_tracemalloc = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def stop(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def _stack(self) -> List[int]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name: str, **args) -> Iterator[None]:
+        stack = self._stack()
+        if stack:
+            # The peak is reset for the span, keep the one of the enclosing span
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        stack.append(0)
+        start_ns = time.perf_counter_ns()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            cpu_seconds = time.thread_time() - start_cpu
+            end_ns = time.perf_counter_ns()
+            peak = max(stack.pop(), tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": "pipeline",
+                    "ph": "X",
+                    "ts": (start_ns - self.start_ns) / 1000,
+                    "dur": (end_ns - start_ns) / 1000,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {
+                        **{key: str(value) for key, value in args.items()},
+                        "cpu_ms": round(cpu_seconds * 1000, 3),
+                        "peak_traced_bytes": peak,
+                    },
+                }
+            )
+
+    def write(self, file_name: str):
+        with open(file_name, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+@contextmanager
+def span(name: str, **args) -> Iterator[None]:
+    """Trace the block as a span while the current context has a tracer"""
+    tracer = current_context().tracer
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name, **args):
+        yield
@@ -3,7 +3,7 @@ import math
 import os
 from pathlib import Path
 import shutil
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Tuple
 
 from logger import get_logger
 from PIL import Image
@@ -47,12 +47,77 @@ def rgb_to_idx(rgb):
     return idx
 
 
+def image_to_vic_indices(image) -> bytes:
+    """
+    Quantize a whole image to VIC palette indices in one pass.
+
+    rgb_to_idx is only evaluated once per distinct color, the per pixel mapping
+    is done with a lookup table. Returns one byte per pixel, row by row.
+    """
+    if image.mode == "P":
+        palette = image.palette.palette
+        lut = bytearray(256)
+        for index in range(min(256, len(palette) // 3)):
+            lut[index] = rgb_to_idx(tuple(palette[index * 3 : index * 3 + 3]))
+        return image.tobytes().translate(lut)
+
+    rgb_image = image.convert("RGB")
+    width, height = rgb_image.size
+    lut = {
+        color: rgb_to_idx(color)
+        for _, color in rgb_image.getcolors(max(1, width * height))
+    }
+    return bytes(map(lut.__getitem__, rgb_image.getdata()))
+
+
 def write_bin(file_name, byte_list):
     with open(file_name, "wb") as sd:
         for v in byte_list:
             sd.write(v.to_bytes(1, "big"))
 
 
+def update_digest(digest, file_path, chunk_size=1 << 20):
+    """Add the contents of file_path to a hashlib digest"""
+    with open(file_path, "rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(chunk_size)
+
+
+def user_cache_folder(name: str) -> str:
+    """Outside the install folder, single file builds unpack to a new folder each run"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "animation-converter", name)
+
+
+def evict_least_recently_used(folder: str, suffixes: Tuple[str, ...], max_bytes: int):
+    """Remove files ending in suffixes, oldest modified first, until they fit max_bytes"""
+    entries = []
+    for name in os.listdir(folder):
+        if not name.endswith(suffixes):
+            continue
+        path = os.path.join(folder, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        logger.debug(f"Evicted {path} from cache")
+
+
 def create_folder_if_not_exists(folder_path):
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
@@ -120,10 +185,8 @@ def get_resource_path(relative_path):
 
 def read_palette_from_file(source: str) -> List[int]:
     cols = Image.open(source)
-    palette = []
     (width, _) = cols.size
-    for x in range(width):
-        palette.append(rgb_to_idx(cols.getpixel((x, 0))))
+    palette = list(image_to_vic_indices(cols)[:width])
     return palette[:255]
 
 
@@ -136,14 +199,8 @@ def read_color_palette(source: str) -> List[int]:
 
 def locations_with_same_color(screen_for_color_data):
     points = {}
-    for y in range(25):
-        for x in range(40):
-            offset = y * 40 + x
-            color = screen_for_color_data.color_data[offset]
-            if color in points:
-                points[color].append(y * 40 + x)
-            else:
-                points[color] = [y * 40 + x]
+    for offset, color in enumerate(screen_for_color_data.color_data[:1000]):
+        points.setdefault(color, []).append(offset)
     return points
 
 
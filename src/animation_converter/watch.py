@@ -0,0 +1,126 @@
+"""
+Rebuild when inputs change.
+
+--watch converts once and then polls the config, the input files, every file
+named by an option and the files of the template folder. After a change the
+config is read again and the conversion runs in the same process and
+pipeline context, with incremental stages, so unchanged stages, already
+cellified frames, character distances and Jinja environments are reused.
+Only the block size search is skipped after the first build: the block size
+it picked is used until watching stops, so a rebuild can be a little larger
+than a fresh conversion.
+"""
+
+from collections import OrderedDict
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cli_parser import parse_arguments
+from logger import get_logger
+import petscii
+from pipeline_context import PipelineContext
+
+logger = get_logger()
+
+# Seconds between polls of the watched files
+WATCH_POLL_INTERVAL = 0.2
+
+# Files written by the conversion, watching them would rebuild forever
+OUTPUT_OPTIONS = ("preview", "log_file", "output_sources", "trace")
+
+Snapshot = Dict[str, Optional[Tuple[int, int]]]
+
+
+def watched_files(args) -> List[str]:
+    """Config, inputs, folders of frame sequences, option files and templates"""
+    files = [args.config]
+    for input_file in args.input_files:
+        frame_files = petscii.find_frame_sequence(input_file)
+        if frame_files is None:
+            files.append(input_file)
+            continue
+        # Folder modification time changes when frames are added or removed
+        folder = (
+            input_file if os.path.isdir(input_file) else os.path.dirname(input_file)
+        )
+        files.append(folder or ".")
+        files.extend(frame_files)
+
+    for name, value in vars(args).items():
+        if name in OUTPUT_OPTIONS:
+            continue
+        if isinstance(value, str) and os.path.isfile(value):
+            files.append(value)
+
+    if args.template_dir and os.path.isdir(args.template_dir):
+        for name in os.listdir(args.template_dir):
+            files.append(os.path.join(args.template_dir, name))
+
+    return list(dict.fromkeys(files))
+
+
+def take_snapshot(files: List[str]) -> Snapshot:
+    snapshot = {}
+    for path in files:
+        try:
+            stat = os.stat(path)
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            snapshot[path] = None
+    return snapshot
+
+
+def wait_for_change(files: List[str], snapshot: Snapshot) -> List[str]:
+    """Block until files differ from snapshot and stay unchanged for one poll"""
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        current = take_snapshot(files)
+        if current == snapshot:
+            continue
+        # Editors often write a file in steps, wait for it to settle
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            settled = take_snapshot(files)
+            if settled == current:
+                break
+            current = settled
+        return [path for path in files if current[path] != snapshot[path]]
+
+
+def watch(args, run: Callable) -> int:
+    """Convert with run(args, context) on every change, until interrupted"""
+    context = PipelineContext(args.build_folder, args.log_file, args.output_folder)
+    context.frame_memo = OrderedDict()
+    context.reuse_block_size = True
+
+    try:
+        while True:
+            args.incremental = True
+            # Taken before converting, files saved meanwhile trigger the next run
+            files = watched_files(args)
+            snapshot = take_snapshot(files)
+            start = time.perf_counter()
+            try:
+                if run(args, context) == 0:
+                    logger.success(
+                        f"Rebuilt in {time.perf_counter() - start:.2f}s, watching for changes"
+                    )
+                else:
+                    logger.error("Conversion failed, watching for changes")
+            except (Exception, SystemExit) as e:
+                # A half saved input must not end the session
+                logger.error(f"Conversion failed: {e}, watching for changes")
+
+            while True:
+                changed = wait_for_change(files, snapshot)
+                logger.info(f"Changed: {', '.join(changed)}")
+                snapshot = take_snapshot(files)
+                try:
+                    args = parse_arguments()
+                    break
+                except (ValueError, OSError, SystemExit) as e:
+                    logger.error(f"Could not read config: {e}, watching for changes")
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    return 0
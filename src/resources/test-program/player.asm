@@ -32,6 +32,10 @@ player_state         = $62 ;
 player_row           = $63
 player_code          = $64
 player_color_changes = $65 ; Player has changed color data, shmaybe
+player_history_ptr   = $56 ; And $57, history block pointer
+{% if history_slots > 0 %}
+HISTORY_BUFFER_LOCATION = {{history_location}} ; Frames saved by the player
+{% endif %}
 .endweak
 
 {% for define in op_use_defines %}
@@ -451,9 +455,21 @@ player_op_set_screen_mode
 	rts
 
 {% if "player_op_set_dest_ptr" in ops_in_use %}
+{% if "player_op_next_block" in ops_in_use %}
+; Continue with the block after the previous destination block
+player_op_next_block
+	ldy player_block_index
+	iny
+	jmp player_set_dest_ptr_y
+{% endif %}
+
 player_op_set_dest_ptr
 	#player_read_next_byte
 	tay
+player_set_dest_ptr_y
+{% if "player_op_next_block" in ops_in_use %}
+	sty player_block_index
+{% endif %}
 {% if use_color %}
 	lda player_state
 	cmp #PLAYER_STATE_WRITE_TO_SCREEN_BUF
@@ -470,6 +486,11 @@ player_op_set_dest_ptr
 	lda player_offsets_hi,y
 	sta player_dest_ptr + 1
 	rts
+{% if "player_op_next_block" in ops_in_use %}
+
+player_block_index
+.byte 0
+{% endif %}
 {% endif %}
 
 {% if "player_op_set_border" in ops_in_use %}
@@ -528,7 +549,12 @@ color
 {% endif %}
 
 player_op_restart
+{% if loop_closure %}
+	; Loop body starts after the first frame, it is only decoded once
+	#player_setup_data_ptr ANIM_LOCATION + {{loop_offset}}
+{% else %}
 	#player_setup_data_ptr ANIM_LOCATION
+{% endif %}
 	jsr RESTART_CALLBACK
 	rts
 
@@ -702,6 +728,102 @@ player_op_fill_same{{size}}
 {% endif %}
 {% endfor %}
 
+{% if history_slots > 0 %}
+{% set history_stride = 2048 if use_color else 1024 %}
+.cerror (<HISTORY_BUFFER_LOCATION) != (<UNPACK_BUFFER_LOCATION), "History buffer must be page aligned like the unpack buffer"
+
+player_copy_screen .macro
+	ldx #250
+-	lda \1 - 1 + 000, x
+	sta \2 - 1 + 000, x
+	lda \1 - 1 + 250, x
+	sta \2 - 1 + 250, x
+	lda \1 - 1 + 500, x
+	sta \2 - 1 + 500, x
+	lda \1 - 1 + 750, x
+	sta \2 - 1 + 750, x
+	dex
+	bne -
+.endmacro
+
+{% for slot in range(history_slots) %}
+{% if "player_op_save_history" ~ slot in ops_in_use %}
+; Save the unpack buffers to history slot {{slot}}
+player_op_save_history{{slot}}
+	#player_copy_screen UNPACK_BUFFER_LOCATION, HISTORY_BUFFER_LOCATION + {{slot * history_stride}}
+{% if use_color %}
+	#player_copy_screen COLOR_UNPACK_BUFFER_LOCATION, HISTORY_BUFFER_LOCATION + {{slot * history_stride + 1024}}
+{% endif %}
+	rts
+
+{% endif %}
+{% endfor %}
+; High byte from unpack buffer to each history slot, low bytes are the same
+player_history_delta
+{% for slot in range(history_slots) %}
+	.byte >((HISTORY_BUFFER_LOCATION + {{slot * history_stride}} - UNPACK_BUFFER_LOCATION) & $ffff)
+{% endfor %}
+{% if use_color %}
+player_history_color_delta
+{% for slot in range(history_slots) %}
+	.byte >((HISTORY_BUFFER_LOCATION + {{slot * history_stride + 1024}} - COLOR_UNPACK_BUFFER_LOCATION) & $ffff)
+{% endfor %}
+{% endif %}
+
+{% for size in block_offsets_sizes %}
+{% if "player_op_copy_history" ~ size in ops_in_use %}
+; Copy destination block from the history slot given in next byte
+player_op_copy_history{{size}} .block
+	#player_read_next_byte
+	tax
+	lda player_dest_ptr
+	sta player_history_ptr
+	lda player_dest_ptr + 1
+{% if use_color %}
+	ldy player_state
+	cpy #PLAYER_STATE_WRITE_TO_SCREEN_BUF
+	beq screen
+	clc
+	adc player_history_color_delta, x
+	jmp copy
+screen
+{% endif %}
+	clc
+	adc player_history_delta, x
+copy
+	sta player_history_ptr + 1
+{% for idx in range(0, size) %}
+	ldy #{{block_offsets[idx]}}
+	lda (player_history_ptr), y
+	sta (player_dest_ptr), y
+{% endfor %}
+	rts
+.endblock
+
+{% endif %}
+{% endfor %}
+{% endif %}
+
+{% for size, entries in block_dictionary.items() %}
+{% if "player_op_fill_dict" ~ size in ops_in_use %}
+; Fill block with dictionary entry, entries are stored one table per cell
+player_op_fill_dict{{size}}
+	#player_read_next_byte
+	tax
+{% for idx in range(0, size) %}
+	lda player_block_dict{{size}}_{{idx}}, x
+	ldy #{{block_offsets[idx]}}
+	sta (player_dest_ptr), y
+{% endfor %}
+	rts
+
+{% for idx in range(0, size) %}
+player_block_dict{{size}}_{{idx}}
+	.byte {{ entries | map(attribute=idx) | join(", ") }}
+{% endfor %}
+{% endif %}
+{% endfor %}
+
 {% if rle_decode_needed %}
 player_rle_decode_buffer
 {% for i in range(255) %}
@@ -150,6 +150,10 @@ setup_raster_irq .macro
 
 * = EFFECT_LOCATION
 ; Variables
+{% if TEST_SLOWDOWN > 0 %}
+test_slowdown                 .byte {{ TEST_SLOWDOWN - 1 }}
+test_slowndown_frames         .byte {{ TEST_SLOWDOWN }}
+{% endif %}
 test_charset_index            .byte 0
 test_current_buffer           .byte 0
 test_draw_next_frame          .byte 0
@@ -208,10 +212,23 @@ start
 forever
 
 	jsr player_unpack
+{% if TEST_SLOWDOWN > 0 %}
+	; Show the frame for the number of video frames set by the player
+	lda test_slowndown_frames
+	bne +
+	lda #1
++	sta test_slowdown
+-	jsr wait_for_next_frame
+	lda #0
+	sta test_draw_next_frame
+	dec test_slowdown
+	bne -
+{% else %}
 	jsr wait_for_next_frame
 
 	lda #0
 	sta test_draw_next_frame
+{% endif %}
 
 +	jmp forever
 
@@ -291,7 +308,9 @@ test_setcharset_index
 
 ; Called by player
 test_anim_restarted
+{% if not loop_closure %}
     #clear_screen 1, UNPACK_BUFFER_LOCATION
+{% endif %}
 	rts
 
 ; A = Charset index
@@ -708,6 +708,10 @@ test_setcharset_index
 	rts
 
 test_anim_restarted
+{% if loop_closure %}
+	; Loop body continues from the last frame in the unpack buffers
+	rts
+{% endif %}
 
 clear_unpack_buffers
 {% if use_color %}